@@ -92,37 +92,1658 @@ rasterio==1.4.3""".format(find_links_file_path=temporary_file)
 
 pip_install(requirements_txt)
 
-def pandas_append(df, row, ignore_index=False):
+# ==== Detection core (begin) ====
+# Everything till the end of this section doesn't use Metashape and Qt - it is saved as a standalone script for worker processes
+
+def suppress_overlapping_boxes(a_boxes, a_scores, b_boxes, b_scores, suppress_ties, area_overlap_threshold, score_margin=0.2, max_pairs_per_batch=2**20):
+    # Returns mask of boxes from a that should be suppressed by overlapping boxes from b.
+    # Box from a is suppressed if its overlap with some box from b is bigger than area_overlap_threshold of the smallest of them and
+    # if that box from b has noticeably bigger score, or similar score and bigger area (or the same area and suppress_ties=True).
+    # Boxes are Nx4 arrays of integer [xmin, ymin, xmax, ymax], pairs are processed in batches to limit memory usage.
+    import numpy as np
+
+    suppressed = np.zeros(len(a_boxes), bool)
+    if len(a_boxes) == 0 or len(b_boxes) == 0:
+        return suppressed
+
+    b_xmin, b_ymin, b_xmax, b_ymax = [b_boxes[None, :, i] for i in range(4)]
+    b_area = (b_xmax - b_xmin) * (b_ymax - b_ymin)
+    b_scores = np.asarray(b_scores, np.float64)[None, :]
+
+    batch_size = max(1, max_pairs_per_batch // len(b_boxes))
+    for batch_from in range(0, len(a_boxes), batch_size):
+        batch_to = min(len(a_boxes), batch_from + batch_size)
+        a_xmin, a_ymin, a_xmax, a_ymax = [a_boxes[batch_from:batch_to, i, None] for i in range(4)]
+        a_area = (a_xmax - a_xmin) * (a_ymax - a_ymin)
+        a_batch_scores = np.asarray(a_scores[batch_from:batch_to], np.float64)[:, None]
+
+        intersection_x = np.maximum(0, np.minimum(a_xmax, b_xmax) - np.maximum(a_xmin, b_xmin))
+        intersection_y = np.maximum(0, np.minimum(a_ymax, b_ymax) - np.maximum(a_ymin, b_ymin))
+        is_overlapped = intersection_x * intersection_y > np.minimum(a_area, b_area) * area_overlap_threshold
+
+        is_similar_score = ~(b_scores + score_margin < a_batch_scores)
+        is_b_better = (a_batch_scores + score_margin < b_scores) | (is_similar_score & (a_area < b_area))
+        if suppress_ties:
+            is_b_better |= is_similar_score & (a_area == b_area)
+
+        suppressed[batch_from:batch_to] = np.any(is_overlapped & is_b_better, axis=1)
+
+    return suppressed
+
+def trees_to_boxes(trees):
+    import numpy as np
+
+    if len(trees) == 0:
+        return np.zeros((0, 4), np.int64), np.zeros(0, np.float64)
+    boxes = trees[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(np.float64).reshape(-1, 4).astype(np.int64)
+    scores = trees['score'].to_numpy(np.float64)
+    return boxes, scores
+
+class DetectedBoxes:
+    # Growable columnar storage of detected boxes: xmin, ymin, xmax, ymax (in pixels), score and suppression mask.
+    # Appending is amortized O(1) per box, conversion to pandas.DataFrame is expected only for debug output and export.
+
+    def __init__(self, capacity=64):
+        import numpy as np
+
+        self.size = 0
+        self.xyxy = np.zeros((capacity, 4), np.int64)
+        self.score = np.zeros(capacity, np.float64)
+        self.suppressed = np.zeros(capacity, bool)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def boxes(self):
+        return self.xyxy[:self.size]
+
+    @property
+    def scores(self):
+        return self.score[:self.size]
+
+    @property
+    def suppressed_mask(self):
+        return self.suppressed[:self.size]
+
+    def reserve(self, capacity):
+        import numpy as np
+
+        if capacity <= len(self.score):
+            return
+        capacity = max(capacity, 2 * len(self.score))
+        self.xyxy = np.concatenate([self.xyxy, np.zeros((capacity - len(self.xyxy), 4), np.int64)])
+        self.score = np.concatenate([self.score, np.zeros(capacity - len(self.score), np.float64)])
+        self.suppressed = np.concatenate([self.suppressed, np.zeros(capacity - len(self.suppressed), bool)])
+
+    def append(self, boxes, scores, suppressed=None):
+        n = len(scores)
+        self.reserve(self.size + n)
+        self.xyxy[self.size:self.size + n] = boxes
+        self.score[self.size:self.size + n] = scores
+        self.suppressed[self.size:self.size + n] = False if suppressed is None else suppressed
+        self.size += n
+
+    def extend(self, other, selection=None):
+        if selection is None:
+            self.append(other.boxes, other.scores, other.suppressed_mask)
+        else:
+            self.append(other.boxes[selection], other.scores[selection], other.suppressed_mask[selection])
+
+    def subset(self, selection):
+        result = DetectedBoxes(capacity=0)
+        result.extend(self, selection)
+        return result
+
+    def to_dataframe(self):
+        import numpy as np
+        import pandas as pd
+
+        return pd.DataFrame({'xmin': self.boxes[:, 0], 'ymin': self.boxes[:, 1], 'xmax': self.boxes[:, 2], 'ymax': self.boxes[:, 3],
+                             'label': np.where(self.suppressed_mask, "Suppressed", "Tree"), 'score': self.scores})
+
+class BoxesGridIndex:
+    # Spatial index of integer boxes [xmin, ymin, xmax) x [ymin, ymax) - each box is registered in all grid cells it touches,
+    # so a query returns only boxes from nearby cells instead of checking all boxes
+
+    def __init__(self, boxes, cell_size):
+        import numpy as np
+
+        self.boxes = np.int64(boxes).reshape(-1, 4)
+        self.cell_size = cell_size
+        self.cells = {}
+        cells_from = self.boxes[:, :2] // cell_size
+        cells_to = np.maximum(self.boxes[:, :2], self.boxes[:, 2:] - 1) // cell_size
+        for i in range(len(self.boxes)):
+            for cell_x in range(cells_from[i, 0], cells_to[i, 0] + 1):
+                for cell_y in range(cells_from[i, 1], cells_to[i, 1] + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(i)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        # Returns sorted indices of boxes that intersect with [xmin, xmax) x [ymin, ymax)
+        import numpy as np
+
+        candidates = []
+        for cell_x in range(xmin // self.cell_size, max(xmin, xmax - 1) // self.cell_size + 1):
+            for cell_y in range(ymin // self.cell_size, max(ymin, ymax - 1) // self.cell_size + 1):
+                candidates.extend(self.cells.get((cell_x, cell_y), []))
+        candidates = np.unique(np.int64(candidates))
+        bxmin, bymin, bxmax, bymax = self.boxes[candidates].T
+        is_intersecting = (np.minimum(bxmax, xmax) > np.maximum(bxmin, xmin)) & (np.minimum(bymax, ymax) > np.maximum(bymin, ymin))
+        return candidates[is_intersecting]
+
+def intersection_areas(boxes, xmin, ymin, xmax, ymax):
+    # Areas of intersection of boxes (Nx4 array) with the box [xmin, xmax) x [ymin, ymax)
+    import numpy as np
+
+    boxes = np.int64(boxes).reshape(-1, 4)
+    w = np.minimum(boxes[:, 2], xmax) - np.maximum(boxes[:, 0], xmin)
+    h = np.minimum(boxes[:, 3], ymax) - np.maximum(boxes[:, 1], ymin)
+    return np.where((w > 0) & (h > 0), w * h, 0)
+
+def polygons_bounding_boxes(points, offsets, from_world):
+    # Pixel bounding boxes [xmin, ymin, xmax, ymax] of polygons, where vertices of i-th polygon are points[offsets[i]:offsets[i+1]] (in world coordinates)
+    import numpy as np
+
+    points_in_pixels = np.int64(np.round(apply_affine_2x3(from_world, points)))
+    boxes_from = np.minimum.reduceat(points_in_pixels, offsets[:-1], axis=0)
+    boxes_to = np.maximum.reduceat(points_in_pixels, offsets[:-1], axis=0)
+    return np.hstack([boxes_from, boxes_to])
+
+def apply_affine_2x3(matrix2x3, points):
+    # Applies affine transformation (2x3 matrix, f.e. tile to world) to Nx2 points with one matrix multiplication
+    import numpy as np
+
+    points = np.float64(points).reshape(-1, 2)
+    return points @ matrix2x3[:, :2].T + matrix2x3[:, 2]
+
+class PointsGridIndex:
+    # Spatial index of points - points are sorted by grid cells, so points of each cell are a contiguous range of the sorted order
+
+    def __init__(self, points, cell_size):
+        import numpy as np
+
+        self.points = np.float64(points).reshape(-1, 2)
+        self.cell_size = cell_size
+        cells = np.int64(np.floor(self.points / cell_size))
+        self.order = np.lexsort((cells[:, 1], cells[:, 0]))
+        sorted_cells = cells[self.order]
+        is_first = np.ones(len(sorted_cells), bool)
+        is_first[1:] = np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)
+        starts = np.flatnonzero(is_first)
+        ends = np.append(starts[1:], len(sorted_cells))
+        self.cells = {tuple(cell): (start, end) for cell, start, end in zip(sorted_cells[starts].tolist(), starts.tolist(), ends.tolist())}
+
+    def query(self, xmin, ymin, xmax, ymax):
+        # Returns indices of points inside [xmin, xmax] x [ymin, ymax]
+        import math
+        import numpy as np
+
+        cells_from = math.floor(xmin / self.cell_size), math.floor(ymin / self.cell_size)
+        cells_to = math.floor(xmax / self.cell_size), math.floor(ymax / self.cell_size)
+        if (cells_to[0] - cells_from[0] + 1) * (cells_to[1] - cells_from[1] + 1) <= len(self.cells):
+            ranges = [self.cells.get((cell_x, cell_y)) for cell_x in range(cells_from[0], cells_to[0] + 1) for cell_y in range(cells_from[1], cells_to[1] + 1)]
+        else:
+            # query region is bigger than the region with points
+            ranges = [cell_range for cell, cell_range in self.cells.items() if cells_from[0] <= cell[0] <= cells_to[0] and cells_from[1] <= cell[1] <= cells_to[1]]
+        ranges = [self.order[start:end] for start, end in filter(None, ranges)]
+        if len(ranges) == 0:
+            return np.zeros(0, np.int64)
+        candidates = np.concatenate(ranges)
+        x, y = self.points[candidates].T
+        return candidates[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+def points_in_polygon(points, ring):
+    # Even-odd rule for Nx2 points and polygon ring (Mx2 vertices, closing vertex is optional)
+    import numpy as np
+
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), bool)
+    for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intersection_x = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < intersection_x)
+    return inside
+
+def zonal_statistics(points, scores, rings_points, rings_offsets, rings_polygons, npolygons):
+    # Counts points (f.e. centers of detected objects) in polygons. Polygons consist of rings (vertices of j-th ring are rings_points[offsets[j]:offsets[j+1]],
+    # it belongs to polygon rings_polygons[j]) - holes and parts of multipolygons are rings too, point is inside of polygon by even-odd rule.
+    # Returns counts, mean scores (NaN for polygons without points or without scores) and areas of polygons
+    import numpy as np
+
+    points = np.float64(points).reshape(-1, 2)
+    scores = np.full(len(points), np.nan) if scores is None else np.float64(scores)
+    counts = np.zeros(npolygons, np.int64)
+    mean_scores = np.full(npolygons, np.nan)
+    areas = np.zeros(npolygons)
+
+    polygons_rings = [[] for polygon_i in range(npolygons)]
+    for ring_i, polygon_i in enumerate(rings_polygons):
+        ring = rings_points[rings_offsets[ring_i]:rings_offsets[ring_i + 1]]
+        if len(ring) >= 3:
+            polygons_rings[polygon_i].append(ring)
+
+    # area of ring is subtracted if it is inside of odd number of other rings (i.e. it is a hole)
+    for polygon_i, rings in enumerate(polygons_rings):
+        for ring_i, ring in enumerate(rings):
+            x, y = ring[:, 0], ring[:, 1]
+            ring_area = 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+            depth = sum(points_in_polygon(ring[:1], other)[0] for other_i, other in enumerate(rings) if other_i != ring_i)
+            areas[polygon_i] += ring_area if depth % 2 == 0 else -ring_area
+
+    if len(points) == 0 or not any(polygons_rings):
+        return counts, mean_scores, areas
+
+    # grid cells are of typical polygon size, but not so small that most of them are empty
+    polygons_sizes = [np.ptp(np.concatenate(rings), axis=0).max() for rings in polygons_rings if len(rings) > 0]
+    points_extent = np.ptp(points, axis=0)
+    cell_size = max(np.median(polygons_sizes), np.sqrt(max(points_extent[0] * points_extent[1], 1e-12) * 16 / len(points)), 1e-9)
+    index = PointsGridIndex(points, cell_size)
+
+    for polygon_i, rings in enumerate(polygons_rings):
+        if len(rings) == 0:
+            continue
+        vertices = np.concatenate(rings)
+        candidates = index.query(*vertices.min(axis=0), *vertices.max(axis=0))
+        is_inside = np.zeros(len(candidates), bool)
+        for ring in rings:
+            is_inside ^= points_in_polygon(points[candidates], ring)
+        inside = candidates[is_inside]
+        counts[polygon_i] = len(inside)
+        if len(inside) > 0 and not np.all(np.isnan(scores[inside])):
+            mean_scores[polygon_i] = np.nanmean(scores[inside])
+    return counts, mean_scores, areas
+
+def points_density_grid(points, xmin, ymin, xmax, ymax, cell_size):
+    # Numbers of points in cells of grid that starts in top-left corner (xmin, ymax) - rows go from north to south like in GeoTIFF
+    import math
+    import numpy as np
+
+    nx, ny = max(1, math.ceil((xmax - xmin) / cell_size)), max(1, math.ceil((ymax - ymin) / cell_size))
+    points = np.float64(points).reshape(-1, 2)
+    columns = np.floor((points[:, 0] - xmin) / cell_size).astype(np.int64)
+    rows = np.floor((ymax - points[:, 1]) / cell_size).astype(np.int64)
+    is_inside = (columns >= 0) & (columns < nx) & (rows >= 0) & (rows < ny)
+    return np.bincount(rows[is_inside] * nx + columns[is_inside], minlength=nx * ny).reshape(ny, nx)
+
+def geopackage_geometry_bounds(blob):
+    # Returns [minx, maxx, miny, maxy] of GeoPackage geometry (from its envelope, or from WKB point or polygon if there is no envelope)
+    import struct
+    import numpy as np
+
+    flags = blob[3]
+    envelope_type = (flags >> 1) & 0b111
+    if envelope_type > 0:
+        return struct.unpack(("<" if flags & 1 else ">") + "4d", blob[8:40])
+    wkb = blob[8:]
+    byte_order = "<" if wkb[0] == 1 else ">"
+    geometry_type, dimensions_type = divmod(struct.unpack(byte_order + "I", wkb[1:5])[0], 1000)[::-1]
+    ndims = [2, 3, 3, 4][dimensions_type]  # XY, XYZ, XYM, XYZM
+    if geometry_type == 1:
+        coordinates = np.frombuffer(wkb, byte_order + "f8", ndims, 5).reshape(1, ndims)
+    elif geometry_type == 3:
+        npoints = struct.unpack(byte_order + "I", wkb[9:13])[0]
+        coordinates = np.frombuffer(wkb, byte_order + "f8", npoints * ndims, 13).reshape(npoints, ndims)
+    else:
+        raise Exception("Unsupported geometry type {}".format(geometry_type))
+    return coordinates[:, 0].min(), coordinates[:, 0].max(), coordinates[:, 1].min(), coordinates[:, 1].max()
+
+def read_geopackage_boxes_centers(path):
+    # Returns centers of bounding boxes of features from the first features table of GeoPackage (Nx2), their scores ("score" column, None if there is no such column)
+    # and definition of coordinate system (None if it is undefined). Spatial index is used if it is available - it contains bounding boxes already
+    import sqlite3
+    import numpy as np
+
+    connection = sqlite3.connect(path)
+    try:
+        table_name, column_name, srs_id = connection.execute("SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns").fetchone()
+        definition = connection.execute("SELECT definition FROM gpkg_spatial_ref_sys WHERE srs_id = ?", (srs_id,)).fetchone()
+        definition = None if definition is None or definition[0] == "undefined" else definition[0]
+        table_info = connection.execute("PRAGMA table_info(\"{}\")".format(table_name)).fetchall()
+        columns = [row[1] for row in table_info]
+        primary_key = [row[1] for row in table_info if row[5] > 0][0]
+        score_column = ", t.score" if "score" in columns else ""
+        rtree_name = "rtree_{}_{}".format(table_name, column_name)
+        if connection.execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (rtree_name,)).fetchone()[0] > 0:
+            rows = connection.execute("SELECT r.minx, r.maxx, r.miny, r.maxy{} FROM \"{}\" r JOIN \"{}\" t ON t.\"{}\" = r.id".format(score_column, rtree_name, table_name, primary_key)).fetchall()
+            bounds = np.array([row[:4] for row in rows], np.float64).reshape(-1, 4)
+        else:
+            rows = connection.execute("SELECT t.\"{}\"{} FROM \"{}\" t WHERE t.\"{}\" IS NOT NULL".format(column_name, score_column, table_name, column_name)).fetchall()
+            bounds = np.array([geopackage_geometry_bounds(row[0]) for row in rows], np.float64).reshape(-1, 4)
+        scores = np.array([np.nan if row[-1] is None else row[-1] for row in rows], np.float64) if len(score_column) > 0 else None
+    finally:
+        connection.close()
+    centers = np.stack([(bounds[:, 0] + bounds[:, 1]) / 2, (bounds[:, 2] + bounds[:, 3]) / 2], axis=1)
+    return centers, scores, definition
+
+class DecodedTilesCache:
+    # Thread-safe LRU cache of decoded orthomosaic tiles (padded to patch size) with limited total size in bytes.
+    # Each tile is needed by several big tiles (because of the halo) and by several overlapping train tiles.
+
+    def __init__(self, max_bytes):
+        import threading
+        import collections
+
+        self.max_bytes = max_bytes
+        self.tiles = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        tile = load(key)
+        tile.flags.writeable = False  # tile is shared between all readers
+
+        with self.lock:
+            if key not in self.tiles and tile.nbytes <= self.max_bytes:
+                self.tiles[key] = tile
+                self.nbytes += tile.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted_tile = self.tiles.popitem(last=False)
+                    self.nbytes -= evicted_tile.nbytes
+        return tile
+
+def save_big_tile_checkpoint(path, big_tile_trees, idx_on_borders, big_tile_to_world, inputs_digest):
+    import numpy as np
+
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, xyxy=big_tile_trees.boxes, score=big_tile_trees.scores, idx_on_borders=idx_on_borders, to_world=big_tile_to_world,
+             inputs_digest=np.array(inputs_digest))
+    os.replace(tmp_path, path)  # so that interrupted saving doesn't leave broken checkpoint
+
+def load_big_tile_checkpoint(path):
+    import numpy as np
+
+    with np.load(path) as checkpoint:
+        big_tile_trees = DetectedBoxes(capacity=0)
+        big_tile_trees.append(checkpoint["xyxy"], checkpoint["score"])
+        inputs_digest = str(checkpoint["inputs_digest"]) if "inputs_digest" in checkpoint else None
+        return big_tile_trees, checkpoint["idx_on_borders"], checkpoint["to_world"], inputs_digest
+
+def model_weights_digest(model):
+    import hashlib
+
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+def nodata_integral_image(img):
+    # Summed-area table of no-data (white) pixels with extra zero first row and column
+    import numpy as np
+
+    nodata = np.all(img == 255, axis=-1)
+    integral = np.zeros((nodata.shape[0] + 1, nodata.shape[1] + 1), np.int32)
+    np.cumsum(nodata, axis=0, dtype=np.int32, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+def nodata_fraction(integral, xmin, ymin, xmax, ymax):
+    # Fraction of no-data pixels in rectangle(s) [xmin; xmax) x [ymin; ymax) in O(1) per rectangle (NaN for empty rectangles)
+    import numpy as np
+
+    nodata_pixels = integral[ymax, xmax] - integral[ymin, xmax] - integral[ymax, xmin] + integral[ymin, xmin]
+    area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(area > 0, nodata_pixels / np.maximum(area, 1), np.nan)
+
+def predict_images_batch(m, images_rgb):
+    # Runs DeepForest model with a single forward pass over the batch of RGB float32 images (with values from 0 to 255),
+    # returns pandas.DataFrame with predictions for each image (or None if nothing was detected) - like predict_image does.
+    # If the batch doesn't fit into GPU memory - it is processed in two halves.
+    import numpy as np
+    import torch
+
+    model = m.model
+    model.eval()
+    device = next(model.parameters()).device
+    try:
+        with torch.no_grad():
+            batch = torch.from_numpy(np.stack(images_rgb)).to(device).permute(0, 3, 1, 2) / 255.0
+            predictions = model(list(batch))
+    except torch.cuda.OutOfMemoryError:
+        if len(images_rgb) == 1:
+            raise
+        torch.cuda.empty_cache()
+        half = len(images_rgb) // 2
+        return predict_images_batch(m, images_rgb[:half]) + predict_images_batch(m, images_rgb[half:])
+
+    return predictions_to_dataframes(m, predictions)
+
+def predictions_to_dataframes(m, predictions):
     import pandas as pd
-    if isinstance(row, pd.DataFrame):
-        result = pd.concat([df, row], ignore_index=ignore_index)
-    elif isinstance(row, pd.core.series.Series):
-        result = pd.concat([df, row.to_frame().T], ignore_index=ignore_index)
-    elif isinstance(row, dict):
-        result = pd.concat([df, pd.DataFrame(row, index=[0], columns=df.columns)])
+
+    numeric_to_label = getattr(m, "numeric_to_label_dict", None)
+    if not numeric_to_label:
+        numeric_to_label = {value: key for key, value in getattr(m, "label_dict", {"Tree": 0}).items()}
+
+    results = []
+    for prediction in predictions:
+        boxes = prediction["boxes"].cpu().numpy()
+        if len(boxes) == 0:
+            results.append(None)
+            continue
+        results.append(pd.DataFrame({'xmin': boxes[:, 0], 'ymin': boxes[:, 1], 'xmax': boxes[:, 2], 'ymax': boxes[:, 3],
+                                     'label': [numeric_to_label[int(label)] for label in prediction["labels"].cpu().numpy()],
+                                     'score': prediction["scores"].cpu().numpy()}))
+    return results
+
+def replace_frozen_batch_norms(module):
+    # FrozenBatchNorm2d (used by torchvision detection backbones) can't be fused with convolutions by quantization, so it is replaced with equivalent BatchNorm2d
+    import torch
+    from torchvision.ops.misc import FrozenBatchNorm2d
+
+    for name, child in module.named_children():
+        if isinstance(child, FrozenBatchNorm2d):
+            batch_norm = torch.nn.BatchNorm2d(child.weight.shape[0], eps=child.eps)
+            with torch.no_grad():
+                batch_norm.weight.copy_(child.weight)
+                batch_norm.bias.copy_(child.bias)
+                batch_norm.running_mean.copy_(child.running_mean)
+                batch_norm.running_var.copy_(child.running_var)
+            setattr(module, name, batch_norm.eval())
+        else:
+            replace_frozen_batch_norms(child)
+
+def export_retinanet_dense(m, path, images_rgb, batch_size, quantize):
+    # Saves TorchScript of the dense part of RetinaNet (backbone with FPN and head) traced for CPU, fixed batch size and images size.
+    # With quantize=True convolutions of ResNet backbone are statically quantized to int8 (activations are calibrated on given images).
+    # Preprocessing, anchors and postprocessing stay in python (see ExportedRetinaNet).
+    import copy
+    import json
+    import numpy as np
+    import torch
+
+    class RetinaNetDense(torch.nn.Module):
+        def __init__(self, body, fpn, head):
+            super().__init__()
+            self.body, self.fpn, self.head = body, fpn, head
+
+        def forward(self, x):
+            features = list(self.fpn(self.body(x)).values())
+            head_outputs = self.head(features)
+            return head_outputs["cls_logits"], head_outputs["bbox_regression"]
+
+    model = m.model.cpu().eval()
+    images_rgb = [images_rgb[i % len(images_rgb)] for i in range(max(len(images_rgb), batch_size))]
+    with torch.no_grad():
+        batches = []
+        for batch_from in range(0, len(images_rgb) - batch_size + 1, batch_size):
+            images = torch.from_numpy(np.stack(images_rgb[batch_from:batch_from + batch_size])).permute(0, 3, 1, 2) / 255.0
+            batches.append(model.transform(list(images))[0].tensors)
+        features = list(model.backbone(batches[0]).values())
+
+        body = copy.deepcopy(model.backbone.body)
+        if quantize:
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+            replace_frozen_batch_norms(body)
+            body = prepare_fx(body.eval(), get_default_qconfig_mapping(torch.backends.quantized.engine), example_inputs=(batches[0],))
+            for batch in batches:
+                body(batch)
+            body = convert_fx(body)
+
+        dense = torch.jit.trace(RetinaNetDense(body, model.backbone.fpn, model.head).eval(), batches[0])
+        dense = torch.jit.freeze(dense) if quantize else torch.jit.optimize_for_inference(dense)
+
+    meta = {"batch_size": batch_size, "image_size": list(images_rgb[0].shape[:2]), "features_sizes": [list(feature.shape[-2:]) for feature in features]}
+    torch.jit.save(dense, path + ".tmp", _extra_files={"meta.json": json.dumps(meta)})
+    os.replace(path + ".tmp", path)
+
+class ExportedRetinaNet:
+    # CPU inference with exported dense part of RetinaNet (see export_retinanet_dense), predict has the same result format as predict_images_batch
+
+    def __init__(self, m, path):
+        import json
+        import torch
+
+        self.m = m
+        self.model = m.model.cpu().eval()
+        extra_files = {"meta.json": ""}
+        self.dense = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        meta = json.loads(extra_files["meta.json"])
+        self.batch_size = meta["batch_size"]
+        self.image_size = tuple(meta["image_size"])
+
+        # anchors depend only on sizes of images and feature maps, so they are the same for all batches
+        with torch.no_grad():
+            image_list = self.model.transform([torch.zeros((3,) + self.image_size)])[0]
+            features = [torch.zeros((1, 1, h, w)) for h, w in meta["features_sizes"]]
+            anchors = self.model.anchor_generator(image_list, features)[0]
+        nanchors_per_location = anchors.shape[0] // sum([h * w for h, w in meta["features_sizes"]])
+        self.nanchors_per_level = [h * w * nanchors_per_location for h, w in meta["features_sizes"]]
+        self.anchors_per_level = list(anchors.split(self.nanchors_per_level))
+
+    def predict(self, images_rgb):
+        import numpy as np
+        import torch
+
+        if any(image.shape[:2] != self.image_size for image in images_rgb):
+            return predict_images_batch(self.m, images_rgb)
+
+        results = []
+        for batch_from in range(0, len(images_rgb), self.batch_size):
+            batch = list(images_rgb[batch_from:batch_from + self.batch_size])
+            n = len(batch)
+            batch += [np.full_like(batch[0], 255)] * (self.batch_size - n)  # dense part was traced for fixed batch size
+            with torch.no_grad():
+                images = torch.from_numpy(np.stack(batch)).permute(0, 3, 1, 2) / 255.0
+                image_list = self.model.transform(list(images))[0]
+                cls_logits, bbox_regression = self.dense(image_list.tensors)
+                head_outputs = {"cls_logits": list(cls_logits[:n].split(self.nanchors_per_level, dim=1)),
+                                "bbox_regression": list(bbox_regression[:n].split(self.nanchors_per_level, dim=1))}
+                image_sizes = image_list.image_sizes[:n]
+                detections = self.model.postprocess_detections(head_outputs, [self.anchors_per_level] * n, image_sizes)
+                detections = self.model.transform.postprocess(detections, image_sizes, [self.image_size] * n)
+            results.extend(predictions_to_dataframes(self.m, detections))
+        return results
+
+def predictions_match(a, b, min_score, iou_threshold=0.8, score_tolerance=0.05):
+    # Checks that each box of one prediction (pandas.DataFrame or None) with confident score has the corresponding box in the other prediction
+    # (with big IoU and similar score), boxes with scores near min_score are allowed to be missing
+    import numpy as np
+
+    def boxes_and_scores(prediction):
+        if prediction is None:
+            return np.zeros((0, 4)), np.zeros(0)
+        return prediction[["xmin", "ymin", "xmax", "ymax"]].to_numpy(np.float64), prediction["score"].to_numpy(np.float64)
+
+    for (a_boxes, a_scores), (b_boxes, b_scores) in [(boxes_and_scores(a), boxes_and_scores(b)), (boxes_and_scores(b), boxes_and_scores(a))]:
+        for box, score in zip(a_boxes, a_scores):
+            if score < min_score + score_tolerance:
+                continue
+            intersection = np.prod(np.maximum(0.0, np.minimum(box[2:], b_boxes[:, 2:]) - np.maximum(box[:2], b_boxes[:, :2])), axis=1)
+            union = np.prod(box[2:] - box[:2]) + np.prod(b_boxes[:, 2:] - b_boxes[:, :2], axis=1) - intersection
+            matched = (intersection >= iou_threshold * union) & (np.abs(b_scores - score) <= score_tolerance)
+            if not np.any(matched):
+                return False
+    return True
+
+def create_colors_augmentation(augment_colors):
+    import albumentations as A
+
+    stages = []
+    if augment_colors:
+        stages.append(A.HueSaturationValue(hue_shift_limit=360, sat_shift_limit=30, val_shift_limit=20, always_apply=True))
+    stages.append(A.ISONoise(p=0.5))
+    if augment_colors:
+        stages.append(A.RandomBrightnessContrast(brightness_limit=0.4, contrast_limit=0, p=0.5))
+    return A.Compose(stages)
+
+def geometric_tile_version(tile, boxes, version_i):
+    # Returns flipped/rotated view of tile (without copying) and accordingly transformed boxes (Nx4 - xmin, ymin, xmax, ymax),
+    # versions are the same as in DetectObjectsDlg.train_on_user_data
+    import numpy as np
+
+    boxes = np.int64(boxes).reshape(-1, 4)
+    is_mirrored = ((version_i % 4) == 1)
+    n90rotation = (version_i % 4)
+    if is_mirrored:
+        # x, y -> x, h-y
+        h = tile.shape[0]
+        boxes = np.stack([boxes[:, 0], h - boxes[:, 3], boxes[:, 2], h - boxes[:, 1]], axis=1)
+        tile = tile[::-1, :, :]
+    for rotation_i in range(n90rotation):
+        # x, y -> h-y, x
+        h = tile.shape[0]
+        boxes = np.stack([h - boxes[:, 3], boxes[:, 0], h - boxes[:, 1], boxes[:, 2]], axis=1)
+        tile = np.rot90(tile, k=-1)
+    return tile, boxes
+
+class StreamingTrainDataset:
+    # Map-style dataset for torch DataLoader (used instead of augmented JPEG tiles + CSV for DeepForest):
+    # base train tiles and their annotations are kept in memory, flipped/rotated versions are views of them,
+    # and colors augmentation is applied on the fly in DataLoader worker processes - so each epoch sees new colors
+
+    def __init__(self, tiles, tiles_boxes, items, augment_colors, label_id, image_first):
+        self.tiles = tiles  # BGR images
+        self.tiles_boxes = tiles_boxes  # Nx4 boxes for each tile
+        self.items = items  # (tile index, geometric version, image name)
+        self.augment_colors = augment_colors
+        self.label_id = label_id
+        self.image_first = image_first  # DeepForest 2.x batch is (images, targets, names), DeepForest 1.x - (names, images, targets)
+        self.augmentation = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        import numpy as np
+        import torch
+
+        if self.augmentation is None:
+            self.augmentation = create_colors_augmentation(self.augment_colors)  # once per worker process
+
+        tile_i, version_i, image_name = self.items[idx]
+        tile, boxes = geometric_tile_version(self.tiles[tile_i], self.tiles_boxes[tile_i], version_i)
+        image = self.augmentation(image=np.ascontiguousarray(tile[:, :, ::-1]))["image"]  # BGR -> RGB
+        image = torch.from_numpy(np.float32(image).transpose(2, 0, 1) / 255.0)
+        targets = {"boxes": torch.from_numpy(np.float32(boxes)), "labels": torch.full((len(boxes),), self.label_id, dtype=torch.int64)}
+        if self.image_first:
+            return image, targets, image_name
+        else:
+            return image_name, image, targets
+
+def collate_tuples(batch):
+    return tuple(zip(*batch))
+
+def seed_dataloader_worker(worker_id):
+    # torch seeds python and torch random generators of each worker, but numpy (used by albumentations) is seeded only by torch>=1.9
+    import numpy as np
+    import torch
+
+    np.random.seed(torch.initial_seed() % 2**32)
+
+def save_lightning_checkpoint(module, path):
+    # Minimal checkpoint of LightningModule that can be loaded with load_from_checkpoint (for modules trained without Trainer)
+    import torch
+    import pytorch_lightning
+
+    torch.save({"state_dict": module.state_dict(), "hyper_parameters": dict(module.hparams),
+                "pytorch-lightning_version": pytorch_lightning.__version__, "epoch": 0, "global_step": 0}, path)
+
+def frozen_backbone_prefix(body):
+    # Names of the first layers of backbone body without trainable parameters and without batch norms updating their statistics in training mode
+    # (their output is the same in all epochs, so it can be cached), prefix ends on the first layer returned to FPN at the latest - only output of the last layer of prefix is cached
+    prefix = []
+    for name, module in body.named_children():
+        if any(p.requires_grad for p in module.parameters()) or any(getattr(m, "track_running_stats", False) for m in module.modules()):
+            break
+        prefix.append(name)
+        if name in body.return_layers:
+            break
+    return prefix
+
+def parse_optimizers_config(optimizers):
+    # Returns optimizer and LR scheduler config (or None) from result of LightningModule.configure_optimizers -
+    # scheduler config is a dict with the same defaults as in Lightning: interval "epoch", frequency 1, monitor None
+    scheduler, monitor = None, None
+    if isinstance(optimizers, dict):
+        optimizer, scheduler, monitor = optimizers["optimizer"], optimizers.get("lr_scheduler"), optimizers.get("monitor")
+    elif isinstance(optimizers, (list, tuple)) and len(optimizers) == 2 and isinstance(optimizers[0], (list, tuple)):
+        # ([optimizers], [schedulers])
+        optimizer, scheduler = optimizers[0][0], (optimizers[1][0] if len(optimizers[1]) > 0 else None)
+    elif isinstance(optimizers, (list, tuple)):
+        return parse_optimizers_config(optimizers[0])
+    else:
+        optimizer = optimizers
+
+    if scheduler is None:
+        return optimizer, None
+    scheduler_config = {"interval": "epoch", "frequency": 1, "monitor": monitor}
+    scheduler_config.update(scheduler if isinstance(scheduler, dict) else {"scheduler": scheduler})
+    return optimizer, scheduler_config
+
+def step_lr_scheduler(scheduler_config, metrics):
+    # Steps scheduler like Lightning does, metrics are values by names (f.e. "train_loss", "val_loss") for schedulers like ReduceLROnPlateau
+    import torch
+
+    scheduler = scheduler_config["scheduler"]
+    if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+        monitor = scheduler_config["monitor"]
+        # DeepForest monitors its validation losses ("val_classification" etc.) - they are approximated by total validation loss
+        value = metrics.get("val_loss") if monitor is None or monitor.startswith("val") else metrics.get("train_loss")
+        if value is None:
+            print("Warning, LR scheduler is not stepped - monitored metric {} is not available".format(monitor))
+            return
+        scheduler.step(value)
+    else:
+        scheduler.step()
+
+class DetectionCore:
+    # Detection of objects on big tiles of exported orthomosaic. It is used by DetectObjectsDlg (as a mixin) and by worker processes,
+    # the state is described by attributes from STATE_ATTRIBUTES (they are set by DetectObjectsDlg.export_orthomosaic and DetectObjectsDlg.detect)
+
+    STATE_ATTRIBUTES = ["patch_size", "patch_inner_border", "big_tiles_k", "tiles_paths", "tiles_to_world", "tiles_hashes",
+                        "tile_min_x", "tile_max_x", "tile_min_y", "tile_max_y", "tiles_cache_size_mb",
+                        "detection_score_threshold", "detection_skip_nodata_fraction", "detection_batch_size",
+                        "debug_tiles", "dir_detection_results", "dir_subtiles_results", "dir_detection_checkpoint"]
+
+    def detection_state(self):
+        state = {name: getattr(self, name) for name in self.STATE_ATTRIBUTES}
+        state["mosaic"] = None if self.mosaic is None else (self.mosaic.filename, self.mosaic.shape, self.mosaic_from)
+        return state
+
+    @classmethod
+    def from_detection_state(cls, state):
+        import numpy as np
+
+        core = cls()
+        for name in cls.STATE_ATTRIBUTES:
+            setattr(core, name, state[name])
+        core.tiles_cache = DecodedTilesCache(core.tiles_cache_size_mb * 1024 * 1024)
+        core.mosaic = None
+        if state["mosaic"] is not None:
+            mosaic_path, mosaic_shape, core.mosaic_from = state["mosaic"]
+            core.mosaic = np.memmap(mosaic_path, dtype=np.uint8, mode="r", shape=mosaic_shape)
+        core.inference_client = None
+        core.exported_model = None
+        core.m = None
+        return core
+
+    def predict_big_tile_subtiles(self, subtiles, nodata_integral, on_batch_processed=None):
+        # Returns predictions for each subtile (None for skipped subtiles without orthomosaic data) and number of skipped subtiles
+        subtiles_predictions = [None] * len(subtiles)
+        subtiles_to_predict = []
+        for i, (xi, yi, fromx, fromy, subtile) in enumerate(subtiles):
+            if nodata_fraction(nodata_integral, fromx, fromy, fromx + self.patch_size, fromy + self.patch_size) < self.detection_skip_nodata_fraction:
+                subtiles_to_predict.append(i)
+
+        for batch_from in range(0, len(subtiles_to_predict), self.detection_batch_size):
+            batch = subtiles_to_predict[batch_from:batch_from + self.detection_batch_size]
+            batch_predictions = self.predict_subtiles([subtiles[i][-1] for i in batch])
+            for i, subtile_predictions in zip(batch, batch_predictions):
+                subtiles_predictions[i] = subtile_predictions
+            if on_batch_processed is not None:
+                on_batch_processed()
+        return subtiles_predictions, len(subtiles) - len(subtiles_to_predict)
+
+    def detect_big_tile(self, big_tile_x, big_tile_y):
+        # The whole processing of one big tile (without pipelining) - for worker processes
+        big_tile, big_tile_to_world, nodata_integral = self.prepare_big_tile(big_tile_x, big_tile_y)
+        subtiles = self.cut_subtiles(big_tile)
+        subtiles_predictions, nsubtiles_skipped = self.predict_big_tile_subtiles(subtiles, nodata_integral)
+        return self.merge_subtiles(big_tile_x, big_tile_y, big_tile, big_tile_to_world, nodata_integral, subtiles, subtiles_predictions), nsubtiles_skipped
+
+    def read_tile(self, tile_x, tile_y):
+        if self.mosaic is not None:
+            fromx, fromy = (tile_x - self.tile_min_x) * self.patch_size, (tile_y - self.tile_min_y) * self.patch_size
+            return self.mosaic[fromy:fromy + self.patch_size, fromx:fromx + self.patch_size, :]
+        return self.tiles_cache.get((tile_x, tile_y), self.load_tile)
+
+    def load_tile(self, tile_xy):
+        import cv2
+
+        part = cv2.imread(self.tiles_paths[tile_xy])
+        part = cv2.copyMakeBorder(part, 0, self.patch_size - part.shape[0], 0, self.patch_size - part.shape[1], cv2.BORDER_CONSTANT, value=[255, 255, 255])
+        return part
+
+    def read_part(self, res_from, res_to):
+        import numpy as np
+
+        res_size = res_to - res_from
+        assert np.all(res_size >= [self.patch_size, self.patch_size])
+
+        if self.mosaic is not None:
+            return self.read_mosaic_part(res_from, res_to)
+
+        res = np.zeros((res_size[1], res_size[0], 3), np.uint8)
+        res[:, :, :] = 255
+
+        tile_xy_from = np.int32(res_from // self.patch_size)
+        tile_xy_upto = np.int32((res_to - 1) // self.patch_size)
+        assert np.all(tile_xy_from <= tile_xy_upto)
+        for tile_x in range(tile_xy_from[0], tile_xy_upto[0] + 1):
+            for tile_y in range(tile_xy_from[1], tile_xy_upto[1] + 1):
+                if (tile_x, tile_y) not in self.tiles_paths:
+                    continue
+                part = self.read_tile(tile_x, tile_y)
+                part_from = np.int32([tile_x, tile_y]) * self.patch_size - res_from
+                part_to = part_from + self.patch_size
+
+                res_inner_from = np.int32([max(0, part_from[0]), max(0, part_from[1])])
+                res_inner_to = np.int32([min(part_to[0], res_size[0]), min(part_to[1], res_size[1])])
+
+                part_inner_from = res_inner_from - part_from
+                part_inner_to = part_inner_from + res_inner_to - res_inner_from
+
+                res[res_inner_from[1]:res_inner_to[1], res_inner_from[0]:res_inner_to[0], :] = part[part_inner_from[1]:part_inner_to[1], part_inner_from[0]:part_inner_to[0], :]
+
+        return res
+
+    def read_mosaic_part(self, res_from, res_to):
+        # Returns window of memory-mapped mosaic without copying (if the window is inside the mosaic)
+        import numpy as np
+
+        mosaic_size = np.int32([self.mosaic.shape[1], self.mosaic.shape[0]])
+        res_from, res_to = res_from - self.mosaic_from, res_to - self.mosaic_from
+        if np.all(res_from >= 0) and np.all(res_to <= mosaic_size):
+            return self.mosaic[res_from[1]:res_to[1], res_from[0]:res_to[0], :]
+
+        res_size = res_to - res_from
+        res = np.zeros((res_size[1], res_size[0], 3), np.uint8)
+        res[:, :, :] = 255
+
+        inner_from = np.maximum(res_from, 0)
+        inner_to = np.minimum(res_to, mosaic_size)
+        if np.all(inner_from < inner_to):
+            res_inner_from, res_inner_to = inner_from - res_from, inner_to - res_from
+            res[res_inner_from[1]:res_inner_to[1], res_inner_from[0]:res_inner_to[0], :] = self.mosaic[inner_from[1]:inner_to[1], inner_from[0]:inner_to[0], :]
+        return res
+
+    def add_pixel_shift(self, to_world, dx, dy):
+        to_world = to_world.copy()
+        to_world[0, 2] = to_world[0, :] @ [dx, dy, 1]
+        to_world[1, 2] = to_world[1, :] @ [dx, dy, 1]
+        return to_world
+
+    def big_tile_checkpoint_path(self, big_tile_x, big_tile_y):
+        return self.dir_detection_checkpoint + "{}-{}.npz".format(big_tile_x, big_tile_y)
+
+    def shard_status_path(self, shard_i):
+        return self.dir_detection_checkpoint + "shard-{}.json".format(shard_i)
+
+    def big_tile_inputs_digest(self, big_tile_x, big_tile_y):
+        # Hash of all tiles used by big tile (including its halo), so that any change in them leads to re-processing of the big tile
+        import hashlib
+
+        digest = hashlib.sha1()
+        for xi in range(-1, self.big_tiles_k + 1):
+            for yi in range(-1, self.big_tiles_k + 1):
+                tile_x, tile_y = self.big_tiles_k * big_tile_x + xi, self.big_tiles_k * big_tile_y + yi
+                digest.update("{}-{}:{};".format(tile_x, tile_y, self.tiles_hashes.get((tile_x, tile_y))).encode())
+        return digest.hexdigest()
+
+    def prepare_big_tile(self, big_tile_x, big_tile_y):
+        # Executed by assembling threads
+        big_tile, big_tile_to_world = self.assemble_big_tile(big_tile_x, big_tile_y)
+        return big_tile, big_tile_to_world, nodata_integral_image(big_tile)
+
+    def assemble_big_tile(self, big_tile_x, big_tile_y):
+        import numpy as np
+
+        big_tiles_k = self.big_tiles_k
+        border = self.patch_inner_border
+
+        if self.mosaic is not None:
+            big_tile_from = np.int32([big_tile_x, big_tile_y]) * big_tiles_k * self.patch_size - border
+            big_tile = self.read_part(big_tile_from, big_tile_from + big_tiles_k * self.patch_size + 2 * border)
+            big_tile_to_world = None
+            for xi in range(big_tiles_k):
+                for yi in range(big_tiles_k):
+                    tile_x, tile_y = big_tiles_k * big_tile_x + xi, big_tiles_k * big_tile_y + yi
+                    if (tile_x, tile_y) in self.tiles_to_world:
+                        big_tile_to_world = self.add_pixel_shift(self.tiles_to_world[tile_x, tile_y], -(border + xi * self.patch_size), -(border + yi * self.patch_size))
+            assert big_tile_to_world is not None
+            return big_tile, big_tile_to_world
+
+        big_tile = np.zeros((border + big_tiles_k*self.patch_size + border, border + big_tiles_k*self.patch_size + border, 3), np.uint8)
+        big_tile[:, :, :] = 255
+        big_tile_to_world = None
+
+        for xi in range(-1, big_tiles_k + 1):
+            for yi in range(-1, big_tiles_k + 1):
+                tile_x, tile_y = big_tiles_k * big_tile_x + xi, big_tiles_k * big_tile_y + yi
+                if (tile_x, tile_y) not in self.tiles_paths:
+                    continue
+                part = self.read_tile(tile_x, tile_y)
+                if xi in [-1, big_tiles_k] or yi in [-1, big_tiles_k]:
+                    fromx, fromy = border + xi * self.patch_size, border + yi * self.patch_size
+                    tox, toy = fromx + self.patch_size, fromy + self.patch_size
+                    if xi == -1:
+                        part = part[:, self.patch_size - border:, :]
+                        fromx += self.patch_size - border
+                    if xi == big_tiles_k:
+                        part = part[:, :border, :]
+                        tox = fromx + border
+                    if yi == -1:
+                        part = part[self.patch_size - border:, :, :]
+                        fromy += self.patch_size - border
+                    if yi == big_tiles_k:
+                        part = part[:border, :, :]
+                        toy = fromy + border
+                    big_tile[fromy:toy, fromx:tox, :] = part
+                else:
+                    big_tile[border + yi * self.patch_size:, border + xi * self.patch_size:, :][:self.patch_size, :self.patch_size, :] = part
+                    big_tile_to_world = self.add_pixel_shift(self.tiles_to_world[tile_x, tile_y], -(border + xi * self.patch_size), -(border + yi * self.patch_size))
+
+        assert big_tile_to_world is not None
+        return big_tile, big_tile_to_world
+
+    def subtiles_grid(self, big_tile):
+        border = self.patch_inner_border
+        tile_inner_size = self.patch_size - 2*border
+        inner_tiles_nx = (big_tile.shape[1]-2*border+tile_inner_size-1)//tile_inner_size
+        inner_tiles_ny = (big_tile.shape[0]-2*border+tile_inner_size-1)//tile_inner_size
+        return tile_inner_size, inner_tiles_nx, inner_tiles_ny
+
+    def cut_subtiles(self, big_tile):
+        border = self.patch_inner_border
+        tile_inner_size, inner_tiles_nx, inner_tiles_ny = self.subtiles_grid(big_tile)
+
+        subtiles = []
+        for xi in range(inner_tiles_nx):
+            for yi in range(inner_tiles_ny):
+                tox, toy = min(big_tile.shape[1], 2*border+(xi + 1) * tile_inner_size), min(big_tile.shape[0], 2*border+(yi + 1) * tile_inner_size)
+                fromx, fromy = tox - self.patch_size, toy - self.patch_size
+                subtile = big_tile[fromy:toy, fromx:tox, :]
+                assert(subtile.shape == (self.patch_size, self.patch_size, 3))
+                subtiles.append((xi, yi, fromx, fromy, subtile))
+        return subtiles
+
+    def merge_subtiles(self, big_tile_x, big_tile_y, big_tile, big_tile_to_world, nodata_integral, subtiles, subtiles_predictions):
+        # Executed by post-processing worker - so it should not interact with GUI or with Metashape project
+        import cv2
+        import numpy as np
+
+        big_tiles_k = self.big_tiles_k
+        border = self.patch_inner_border
+        area_overlap_threshold = 0.60
+
+        subtiles_trees = {}
+        for (xi, yi, fromx, fromy, subtile), subtile_trees in zip(subtiles, subtiles_predictions):
+            white_pixels_fraction = nodata_fraction(nodata_integral, fromx, fromy, fromx + self.patch_size, fromy + self.patch_size)
+
+            subtile_inner_trees = DetectedBoxes()
+            if subtile_trees is not None:
+                assert np.all(subtile_trees.label == "Tree")
+                boxes, scores = trees_to_boxes(subtile_trees)
+                xmin, ymin, xmax, ymax = boxes.T
+                is_inner = ~((xmin >= self.patch_size - border) | (xmax <= border) | (ymin >= self.patch_size - border) | (ymax <= border))
+                if self.detection_score_threshold is not None:
+                    is_inner &= ~(scores < self.detection_score_threshold)
+                if white_pixels_fraction > 0.10:
+                    bxmin, bymin, bxmax, bymax = np.clip(boxes, 0, self.patch_size).T + np.int64([[fromx], [fromy], [fromx], [fromy]])
+                    bbox_white_pixels_fraction = nodata_fraction(nodata_integral, bxmin, bymin, bxmax, bymax)
+                    is_inner &= ~(bbox_white_pixels_fraction > 0.70)
+                subtile_inner_trees.append(boxes[is_inner] + [fromx, fromy, fromx, fromy], scores[is_inner])
+
+                if self.debug_tiles:
+                    img_with_trees = self.debug_draw_trees(subtile, subtile_trees)
+                    cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}.jpg".format(big_tile_x, big_tile_y, xi, yi), img_with_trees)
+                    subtile_inner_trees_debug = DetectedBoxes()
+                    subtile_inner_trees_debug.append(boxes[is_inner], scores[is_inner])
+                    img_with_inner_trees = self.debug_draw_trees(subtile, subtile_inner_trees_debug.to_dataframe())
+                    cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}_inner.jpg".format(big_tile_x, big_tile_y, xi, yi), img_with_inner_trees)
+            else:
+                if self.debug_tiles:
+                    cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}_empty.jpg".format(big_tile_x, big_tile_y, xi, yi), subtile)
+
+            subtiles_trees[xi, yi] = subtile_inner_trees
+
+        tile_inner_size, inner_tiles_nx, inner_tiles_ny = self.subtiles_grid(big_tile)
+
+        big_tile_trees = DetectedBoxes()
+        for xi, yi in sorted(subtiles_trees.keys()):
+            tox, toy = min(big_tile.shape[1], 2*border+(xi + 1) * tile_inner_size), min(big_tile.shape[0], 2*border+(yi + 1) * tile_inner_size)
+            fromx, fromy = tox - self.patch_size, toy - self.patch_size
+
+            a = subtiles_trees[xi, yi]
+            axmin, aymin, axmax, aymax = a.boxes.T
+
+            a_on_border = ~((axmin > fromx + border) & (axmax < tox - border) & (aymin > fromy + border) & (aymax < toy - border))
+
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    if dx == 0 and dy == 0:
+                        continue
+                    nx, ny = xi + dx, yi + dy
+                    if (nx, ny) not in subtiles_trees:
+                        continue
+                    b = subtiles_trees[nx, ny]
+
+                    to_check = a_on_border
+
+                    # because the last two columns/rows have much bigger overlap
+                    if    (xi == inner_tiles_nx - 2 and dx == 1) or (xi == inner_tiles_nx - 1 and dx == -1)\
+                       or (yi == inner_tiles_ny - 2 and dy == 1) or (yi == inner_tiles_ny - 1 and dy == -1):
+                        to_check = np.ones(len(a), bool)
+
+                    to_check = to_check & ~a.suppressed_mask
+                    a.suppressed_mask[to_check] = suppress_overlapping_boxes(a.boxes[to_check], a.scores[to_check], b.boxes, b.scores,
+                                                                             (xi, yi) < (nx, ny), area_overlap_threshold)
+
+            big_tile_trees.extend(a, ~a.suppressed_mask)
+
+        axmin, aymin, axmax, aymax = big_tile_trees.boxes.T
+        idx_on_borders = np.flatnonzero(~((axmin > 2*border) & (axmax < big_tiles_k * self.patch_size) & (aymin > 2*border) & (aymax < big_tiles_k * self.patch_size)))
+
+        if self.debug_tiles:
+            cv2.imwrite(self.dir_detection_results + "{}-{}_clean.jpg".format(big_tile_x, big_tile_y), big_tile)
+            img_with_trees = self.debug_draw_trees(big_tile, big_tile_trees.to_dataframe())
+            cv2.imwrite(self.dir_detection_results + "{}-{}_all_trees.jpg".format(big_tile_x, big_tile_y), img_with_trees)
+            img_with_border_trees = self.debug_draw_trees(big_tile, big_tile_trees.subset(idx_on_borders).to_dataframe())
+            cv2.imwrite(self.dir_detection_results + "{}-{}_border_trees.jpg".format(big_tile_x, big_tile_y), img_with_border_trees)
+
+        if self.dir_detection_checkpoint is not None:
+            save_big_tile_checkpoint(self.big_tile_checkpoint_path(big_tile_x, big_tile_y), big_tile_trees, idx_on_borders, big_tile_to_world,
+                                     self.big_tile_inputs_digest(big_tile_x, big_tile_y))
+
+        return big_tile_x, big_tile_y, big_tile_to_world, big_tile_trees, idx_on_borders
+
+    def suppress_on_big_tiles_borders(self, big_tile_x, big_tile_y, bigtiles_trees, bigtiles_idx_on_borders):
+        # Returns boxes of the big tile that are not suppressed by boxes on borders of neighboring big tiles
+        import numpy as np
+
+        big_tiles_k = self.big_tiles_k
+        area_overlap_threshold = 0.60
+
+        big_tile_trees = bigtiles_trees[big_tile_x, big_tile_y]
+
+        a_idx_on_borders = bigtiles_idx_on_borders[big_tile_x, big_tile_y]
+        a_boxes, a_scores = big_tile_trees.boxes[a_idx_on_borders], big_tile_trees.scores[a_idx_on_borders]
+        a_suppressed = np.zeros(len(a_idx_on_borders), bool)
+
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                if dx == 0 and dy == 0:
+                    continue
+                nx, ny = big_tile_x + dx, big_tile_y + dy
+                if (nx, ny) not in bigtiles_trees:
+                    continue
+                b = bigtiles_trees[nx, ny]
+
+                b_idx_on_borders = bigtiles_idx_on_borders[nx, ny]
+                b_boxes = b.boxes[b_idx_on_borders] + np.int64([dx, dy, dx, dy]) * big_tiles_k * self.patch_size
+                b_scores = b.scores[b_idx_on_borders]
+
+                to_check = ~a_suppressed
+                a_suppressed[to_check] = suppress_overlapping_boxes(a_boxes[to_check], a_scores[to_check], b_boxes, b_scores,
+                                                                    (big_tile_x, big_tile_y) < (nx, ny), area_overlap_threshold)
+
+        suppressed = np.zeros(len(big_tile_trees), bool)
+        suppressed[a_idx_on_borders[a_suppressed]] = True
+        return big_tile_trees.subset(~suppressed)
+
+    def predict_subtiles(self, subtiles):
+        import cv2
+
+        # DeepForest predict_image expects RGB float32 array. :contentReference[oaicite:6]{index=6}
+        if self.inference_client is not None:
+            return self.inference_client.predict([cv2.cvtColor(subtile, cv2.COLOR_BGR2RGB) for subtile in subtiles])
+
+        subtiles_rgb = [cv2.cvtColor(subtile, cv2.COLOR_BGR2RGB).astype("float32") for subtile in subtiles]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=UserWarning)
+            if self.exported_model is not None:
+                return self.exported_model.predict(subtiles_rgb)
+            if len(subtiles_rgb) == 1:
+                return [self.m.predict_image(image=subtiles_rgb[0])]
+            return predict_images_batch(self.m, subtiles_rgb)
+
+    def debug_draw_trees(self, img, trees):
+        import cv2
+        import numpy as np
+        import pandas as pd
+
+        img = img.copy()
+
+        if isinstance(trees, pd.DataFrame):
+            for row in trees.itertuples():
+                xmin, ymin, xmax, ymax, label = int(row.xmin), int(row.ymin), int(row.xmax), int(row.ymax), row.label
+                assert label == "Tree"
+                cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 0, 255), 2)
+        else:
+            h, w, cn = img.shape
+            for bbox_from, bbox_to in trees:
+                assert np.all(bbox_from >= np.int32([0, 0]))
+                assert np.all(bbox_to <= np.int32([w, h]))
+                (xmin, ymin), (xmax, ymax) = bbox_from, bbox_to
+                cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 0, 255), 2)
+
+        return img
+
+def load_deepforest_model(model_spec):
+    # model_spec is {"checkpoint": path} or {"hub": model name}
+    from deepforest import main
+
+    if "checkpoint" in model_spec:
+        print("Loading model checkpoint from '{}'...".format(model_spec["checkpoint"]))
+        return main.deepforest.load_from_checkpoint(model_spec["checkpoint"])
+
+    m = main.deepforest()
+    m.load_model(model_name=model_spec["hub"], revision="main")
+    return m
+
+def model_spec_key(model_spec):
+    # Checkpoint is identified by its path and content hash - so that overwritten checkpoint is reloaded
+    import hashlib
+
+    if "checkpoint" in model_spec:
+        digest = hashlib.sha1()
+        with open(model_spec["checkpoint"], "rb") as file:
+            for data in iter(lambda: file.read(2**24), b""):
+                digest.update(data)
+        return "checkpoint:{}:{}".format(os.path.abspath(model_spec["checkpoint"]), digest.hexdigest())
+    return "hub:{}".format(model_spec["hub"])
+
+def run_inference_daemon(info_path, idle_timeout, version, max_models=2):
+    # Background process that keeps loaded neural networks between runs of the script (and between chunks),
+    # clients connect to it on localhost - port and authentication key are written to info_path.
+    # Requests are tuples: ("load", model_spec) -> ("ok", model key, weights digest), ("predict", model key, images) -> ("ok", predictions), ("shutdown",)
+    import json
+    import secrets
+    import threading
+    import traceback
+    import collections
+    from multiprocessing.connection import Listener, AuthenticationError
+
+    authkey = secrets.token_bytes(32)
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    models = collections.OrderedDict()
+    last_request_time = [time.time()]
+
+    def exit_when_idle():
+        while True:
+            time.sleep(10)
+            if time.time() - last_request_time[0] > idle_timeout:
+                print("Exiting after {} seconds without requests".format(idle_timeout), flush=True)
+                os._exit(0)
+
+    threading.Thread(target=exit_when_idle, daemon=True).start()
+
+    # authentication key is readable only by the current user (its directory is private too, see InferenceDaemonClient)
+    if os.path.exists(info_path + ".tmp"):
+        os.remove(info_path + ".tmp")
+    with os.fdopen(os.open(info_path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as file:
+        json.dump({"port": listener.address[1], "authkey": authkey.hex(), "pid": os.getpid(), "version": version}, file)
+    os.replace(info_path + ".tmp", info_path)
+    print("Inference daemon is listening on port {}".format(listener.address[1]), flush=True)
+
+    while True:
+        try:
+            connection = listener.accept()
+        except (OSError, EOFError, AuthenticationError):
+            continue
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (OSError, EOFError):
+                    break
+                last_request_time[0] = time.time()
+                try:
+                    if request[0] == "load":
+                        key = model_spec_key(request[1])
+                        if key not in models:
+                            import torch
+
+                            m = load_deepforest_model(request[1])
+                            if torch.cuda.is_available():
+                                m.model.to("cuda")
+                            models[key] = (m, model_weights_digest(m.model))
+                            while len(models) > max_models:
+                                models.popitem(last=False)
+                        models.move_to_end(key)
+                        connection.send(("ok", key, models[key][1]))
+                    elif request[0] == "predict":
+                        _, key, images = request
+                        connection.send(("ok", predict_images_batch(models[key][0], list(images))))
+                    elif request[0] == "shutdown":
+                        connection.send(("ok",))
+                        return
+                    else:
+                        raise RuntimeError("Unknown request {}".format(request[0]))
+                except Exception:
+                    connection.send(("error", traceback.format_exc()))
+                last_request_time[0] = time.time()
+
+def remap_paths(value, roots):
+    # Replaces prefixes of paths (roots are pairs of old and new prefix) in nested dicts, lists and tuples,
+    # so that the job can be processed on other machine with different mount point of shared working dir
+    if isinstance(value, str):
+        for old_root, new_root in roots:
+            old_root, new_root = old_root.rstrip("/\\"), new_root.rstrip("/\\")
+            if value == old_root or (value.startswith(old_root) and value[len(old_root):len(old_root) + 1] in ["/", "\\"]):
+                return new_root + value[len(old_root):]
+        return value
+    if isinstance(value, dict):
+        return {key: remap_paths(item, roots) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(remap_paths(item, roots) for item in value)
+    return value
+
+def run_detection_shard(job_path, shard_i):
+    # Processes big tiles of the shard, results of each big tile are saved to detection checkpoint directory.
+    # Shard can be processed on other machine (node) with shared working dir - job file is expected in the working dir,
+    # so paths are remapped to its location on this node. In the end shard status is saved near checkpoints (see DetectionCore.shard_status_path)
+    import json
+    import pickle
+    import socket
+    import traceback
+
+    job_path = os.path.abspath(job_path)
+    with open(job_path, "rb") as file:
+        job = pickle.load(file)
+    working_dir = os.path.dirname(job_path)
+    roots = [(job["working_dir"], working_dir), (job["cache_dir"], os.path.normpath(os.path.join(working_dir, job["cache_dir_relative"])))]
+
+    core = DetectionCore.from_detection_state(remap_paths(job["state"], roots))
+    status = {"job_id": job["job_id"], "host": socket.gethostname(), "status": "failed"}
+    try:
+        import torch
+
+        if job["torch_threads"] is not None:
+            torch.set_num_threads(job["torch_threads"])
+        core.m = load_deepforest_model(remap_paths(job["model_spec"], roots))
+        if job["exported_model_path"] is not None:
+            core.exported_model = ExportedRetinaNet(core.m, remap_paths(job["exported_model_path"], roots))
+
+        big_tiles = job["shards"][shard_i]
+        time_start = time.time()
+        for i, (big_tile_x, big_tile_y) in enumerate(big_tiles):
+            checkpoint_path = core.big_tile_checkpoint_path(big_tile_x, big_tile_y)
+            if os.path.exists(checkpoint_path) and load_big_tile_checkpoint(checkpoint_path)[3] == core.big_tile_inputs_digest(big_tile_x, big_tile_y):
+                continue
+            _, nsubtiles_skipped = core.detect_big_tile(big_tile_x, big_tile_y)
+            print("Shard #{}: big tile {}-{} processed ({}/{}, {} empty subtiles skipped, {:.1f} sec)"
+                  .format(shard_i, big_tile_x, big_tile_y, i + 1, len(big_tiles), nsubtiles_skipped, time.time() - time_start), flush=True)
+        status["status"] = "done"
+    except BaseException:
+        status["error"] = traceback.format_exc()
+        raise
+    finally:
+        status_path = core.shard_status_path(shard_i)
+        with open(status_path + ".tmp", "w") as file:
+            json.dump(status, file)
+        os.replace(status_path + ".tmp", status_path)
+
+def worker_main(argv):
+    # Entry point of standalone worker script
+    if argv[0] == "daemon":
+        run_inference_daemon(argv[1], float(argv[2]), argv[3])
+    elif argv[0] == "shard":
+        run_detection_shard(argv[1], int(argv[2]))
     else:
-        raise RuntimeError("pandas_append: unsupported row type - {}".format(type(row)))
+        raise RuntimeError("Unknown worker command {}".format(argv[0]))
+
+# ==== Detection core (end) ====
+
+def detection_core_source():
+    import inspect
+
+    with open(inspect.getsourcefile(detection_core_source), "r", encoding="utf-8") as file:
+        source = file.read()
+    begin = source.index("\n" + DETECTION_CORE_BEGIN + "\n")
+    end = source.index("\n" + DETECTION_CORE_END + "\n")
+    return source[begin:end + 1]
+
+DETECTION_CORE_BEGIN = "# ==== Detection core (begin) ===="
+DETECTION_CORE_END = "# ==== Detection core (end) ===="
+
+def write_worker_script(path, core_source):
+    source = "import os, sys, time, warnings\n" + core_source + "\n\nif __name__ == \"__main__\":\n    worker_main(sys.argv[1:])\n"
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            if file.read() == source:
+                return
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        file.write(source)
+    os.replace(path + ".tmp", path)
+
+def worker_python_executable():
+    # sys.executable is Metashape itself, so worker processes are started with python interpreter bundled with Metashape
+    import sys
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    candidates = [os.path.join(sys.exec_prefix, "python.exe"),
+                  os.path.join(sys.exec_prefix, "bin", "python{}.{}".format(*sys.version_info[:2])),
+                  os.path.join(sys.exec_prefix, "bin", "python3")]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    raise RuntimeError("Python interpreter not found in {}".format(sys.exec_prefix))
+
+def available_memory_bytes():
+    # Physical memory that can be allocated without swapping, None if it is unknown
+    if os.name == "nt":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+
+    try:
+        with open("/proc/meminfo", "r") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    for pages in ["SC_AVPHYS_PAGES", "SC_PHYS_PAGES"]:  # there is no SC_AVPHYS_PAGES on macOS - so half of total memory is assumed to be available
+        try:
+            return os.sysconf(pages) * os.sysconf("SC_PAGE_SIZE") // (1 if pages == "SC_AVPHYS_PAGES" else 2)
+        except (ValueError, OSError, AttributeError):
+            pass
+    return None
+
+def start_worker_process(args, log_path, detached=False):
+    import sys
+    import subprocess
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([path for path in sys.path if len(path) > 0])  # so that packages installed by pip_install are found
+    kwargs = {}
+    if detached:
+        if os.name == "nt":
+            kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+    with open(log_path, "a") as log:
+        return subprocess.Popen([worker_python_executable()] + args, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+class InferenceDaemonClient:
+    # Connection to the background inference process (see run_inference_daemon), the process is started if it is not running yet
+
+    def __init__(self, idle_timeout=3600, start_timeout=180):
+        import hashlib
+        import tempfile
+
+        core_source = detection_core_source()
+        version = hashlib.sha1(core_source.encode()).hexdigest()
+        daemon_dir = self.private_dir(tempfile.gettempdir(), "metashape_detect_objects")
+        info_path = os.path.join(daemon_dir, "inference_daemon.json")
+
+        self.connection = self.connect(info_path, version)
+        if self.connection is None:
+            worker_script = os.path.join(daemon_dir, "detection_worker.py")
+            write_worker_script(worker_script, core_source)
+            if os.path.exists(info_path):
+                os.remove(info_path)
+            print("Starting inference daemon (log: {})...".format(os.path.join(daemon_dir, "inference_daemon.log")))
+            process = start_worker_process([worker_script, "daemon", info_path, str(idle_timeout), version], os.path.join(daemon_dir, "inference_daemon.log"), detached=True)
+            wait_start = time.time()
+            while self.connection is None:
+                if process.poll() is not None:
+                    raise RuntimeError("Inference daemon exited with code {}".format(process.returncode))
+                if time.time() - wait_start > start_timeout:
+                    raise RuntimeError("Inference daemon didn't start in {} seconds".format(start_timeout))
+                time.sleep(0.5)
+                self.connection = self.connect(info_path, version)
+        self.model_key = None
+        self.weights_digest = None
+
+    @staticmethod
+    def private_dir(parent_dir, name):
+        # Per-user directory accessible only by its owner - other local users shouldn't read authentication key of the daemon
+        import getpass
+
+        path = os.path.join(parent_dir, "{}_{}".format(name, getpass.getuser()))
+        pathlib.Path(path).mkdir(mode=0o700, parents=True, exist_ok=True)
+        if os.name != "nt":
+            if os.stat(path).st_uid != os.getuid():
+                raise RuntimeError("Directory {} belongs to other user".format(path))
+            os.chmod(path, 0o700)
+        return path
+
+    def connect(self, info_path, version):
+        import json
+        from multiprocessing.connection import Client, AuthenticationError
+
+        try:
+            with open(info_path, "r") as file:
+                info = json.load(file)
+            connection = Client(("127.0.0.1", info["port"]), authkey=bytes.fromhex(info["authkey"]))
+        except (OSError, ValueError, KeyError, EOFError, AuthenticationError):
+            return None
+        if info["version"] != version:
+            # daemon was started by other version of this script
+            connection.send(("shutdown",))
+            connection.close()
+            return None
+        return connection
+
+    def request(self, *request):
+        self.connection.send(request)
+        reply = self.connection.recv()
+        if reply[0] != "ok":
+            raise RuntimeError("Inference daemon failed:\n{}".format(reply[1]))
+        return reply[1:]
+
+    def load_model(self, model_spec):
+        self.model_key, self.weights_digest = self.request("load", model_spec)
+
+    def predict(self, images_rgb):
+        import numpy as np
+
+        return self.request("predict", self.model_key, np.stack(images_rgb))[0]
+
+    def close(self):
+        self.connection.close()
+
+def crs_is_geographic(crs):
+    # Coordinates are in degrees, also for compound coordinate system with geographic horizontal part (COMPD_CS[..., GEOGCS[...], VERT_CS[...]])
+    wkt = crs.wkt
+    return ("GEOGCS[" in wkt or "GEOGCRS[" in wkt) and not ("PROJCS[" in wkt or "PROJCRS[" in wkt)
+
+class CrsTransformer:
+    # Transforms Nx2 or Nx3 arrays of points from one coordinate system to another.
+    # Metashape.CoordinateSystem.transform is called per point only if coordinate systems are different
+    # and their relation can't be approximated by affine transformation (with given tolerance in destination units) over the points region.
+
+    def __init__(self, src_crs, dst_crs):
+        self.src_crs = src_crs
+        self.dst_crs = dst_crs
+        self.identical = (src_crs is None and dst_crs is None) or (src_crs is not None and dst_crs is not None and src_crs.wkt == dst_crs.wkt)
+        self.npoints_transformed_exactly = 0
+        self.npoints_transformed_linearly = 0
+
+    def transform(self, points, tolerance=0.0):
+        import numpy as np
+
+        points = np.float64(points)
+        assert points.ndim == 2 and points.shape[1] in [2, 3]
+        if self.identical:
+            return points.copy()
+        return self.transform_region(points, tolerance)
+
+    def transform_exact(self, points):
+        import numpy as np
+
+        self.npoints_transformed_exactly += len(points)
+        ndims = points.shape[1]
+        result = np.zeros_like(points)
+        for i, p in enumerate(points):
+            p = Metashape.CoordinateSystem.transform(Metashape.Vector(p.tolist()), self.src_crs, self.dst_crs)
+            result[i] = [p.x, p.y] if ndims == 2 else [p.x, p.y, p.z]
+        return result
+
+    def transform_region(self, points, tolerance):
+        import numpy as np
+
+        ndims = points.shape[1]
+        nsamples = 3 ** ndims + 2 ** ndims
+        if tolerance <= 0.0 or len(points) <= 2 * nsamples:
+            return self.transform_exact(points)
+
+        # affine transformation is fitted on 3x3(x3) grid in bounding box of points and is verified on the same samples
+        # and on held-out 2x2(x2) grid of midpoints of its cells (so that error between fitted samples is not missed)
+        points_min, points_max = np.min(points, axis=0), np.max(points, axis=0)
+
+        def grid(fractions):
+            return np.stack(np.meshgrid(*[points_min[d] + np.float64(fractions) * (points_max[d] - points_min[d]) for d in range(ndims)], indexing="ij"), axis=-1).reshape(-1, ndims)
+
+        samples, checks = grid([0.0, 0.5, 1.0]), grid([0.25, 0.75])
+        samples_transformed = self.transform_exact(np.vstack([samples, checks]))
+        samples_homogeneous = np.hstack([np.vstack([samples, checks]), np.ones((nsamples, 1))])
+        affine = np.linalg.lstsq(samples_homogeneous[:len(samples)], samples_transformed[:len(samples)], rcond=None)[0]
+        error = np.max(np.abs(samples_homogeneous @ affine - samples_transformed))
+        if error <= tolerance:
+            self.npoints_transformed_linearly += len(points)
+            return np.hstack([points, np.ones((len(points), 1))]) @ affine
+
+        # the region is too big to be linear - splitting it in cells, non-linearity error decreases quadratically with cell size
+        ncells_per_axis = 2 * int(np.ceil(np.sqrt(error / tolerance)))
+        if ncells_per_axis ** ndims * nsamples * 2 >= len(points):
+            return self.transform_exact(points)
+        cells = np.int64(np.minimum((points - points_min) / np.maximum(points_max - points_min, 1e-300) * ncells_per_axis, ncells_per_axis - 1))
+        cells_ids = np.ravel_multi_index(tuple(cells.T), (ncells_per_axis,) * ndims)
+        result = np.zeros_like(points)
+        for cell_id in np.unique(cells_ids):
+            is_in_cell = (cells_ids == cell_id)
+            result[is_in_cell] = self.transform_region(points[is_in_cell], tolerance)
+        return result
+
+class GeoPackageWriter:
+    # Minimal writer of polygons to GeoPackage (OGC GeoPackage 1.2 with standard geometry blobs) with python sqlite3,
+    # polygons are Nx4x2 arrays of corners (rings are closed by writer), attributes are columns of given SQLite types.
+    # Polygons are committed by each add_polygons call, so the file can be written incrementally.
+    # With spatial_index=True standard R-tree index (gpkg_rtree_index extension) is filled along with polygons
+
+    def __init__(self, path, table_name, crs, columns, spatial_index=False):
+        import sqlite3
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.table_name = table_name
+        self.columns = columns
+        self.spatial_index = spatial_index
+        self.nfeatures = 0
+        self.srs_id, organization, organization_id = -1, "NONE", -1
+        if crs is not None:
+            authority = crs.authority.split("::")
+            if len(authority) == 2 and authority[0] == "EPSG" and authority[1].isdigit():
+                self.srs_id, organization, organization_id = int(authority[1]), "EPSG", int(authority[1])
+            else:
+                self.srs_id = 100000
+        self.extent = None
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+        self.connection.execute("PRAGMA user_version = 10200")
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,"
+                                " organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)")
+        self.connection.executemany("INSERT OR REPLACE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ("WGS 84 geodetic", 4326, "EPSG", 4326, GEOPACKAGE_WGS84_WKT, None)])
+        if crs is not None:
+            self.connection.execute("INSERT OR REPLACE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", (crs.name, self.srs_id, organization, organization_id, crs.wkt, None))
+        self.connection.execute("CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '',"
+                                " last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,"
+                                " srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id))")
+        self.connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,"
+                                " srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys(srs_id), z TINYINT NOT NULL, m TINYINT NOT NULL, PRIMARY KEY (table_name, column_name))")
+        self.connection.execute("CREATE TABLE \"{}\" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom POLYGON{})"
+                                .format(table_name, "".join([", \"{}\" {}".format(name, sql_type) for name, sql_type in columns])))
+        self.connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)", (table_name, table_name, self.srs_id))
+        self.connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'POLYGON', ?, 0, 0)", (table_name, self.srs_id))
+        if spatial_index:
+            self.connection.execute("CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL,"
+                                    " scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))")
+            self.connection.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')", (table_name,))
+            self.connection.execute("CREATE VIRTUAL TABLE \"rtree_{}_geom\" USING rtree(id, minx, maxx, miny, maxy)".format(table_name))
+        self.connection.commit()
+
+    def add_polygons(self, polygons, attributes):
+        import numpy as np
+
+        polygons = np.float64(polygons).reshape(-1, 4, 2)
+        if len(polygons) == 0:
+            return
+        # GeoPackage binary header with XY envelope followed by little-endian WKB polygon with one closed ring of 5 points
+        blob_type = np.dtype([("magic", "S2"), ("version", "u1"), ("flags", "u1"), ("srs_id", "<i4"), ("envelope", "<f8", (4,)),
+                              ("byte_order", "u1"), ("wkb_type", "<u4"), ("nrings", "<u4"), ("npoints", "<u4"), ("points", "<f8", (5, 2))])
+        polygons_min, polygons_max = np.min(polygons, axis=1), np.max(polygons, axis=1)
+        blobs = np.zeros(len(polygons), blob_type)
+        blobs["magic"] = b"GP"
+        blobs["flags"] = 0b011  # XY envelope, little-endian
+        blobs["srs_id"] = self.srs_id
+        blobs["envelope"] = np.stack([polygons_min[:, 0], polygons_max[:, 0], polygons_min[:, 1], polygons_max[:, 1]], axis=1)
+        blobs["byte_order"] = 1
+        blobs["wkb_type"] = 3
+        blobs["nrings"] = 1
+        blobs["npoints"] = 5
+        blobs["points"][:, :4] = polygons
+        blobs["points"][:, 4] = polygons[:, 0]
+        blobs = blobs.view(np.uint8).reshape(len(polygons), blob_type.itemsize)
+
+        fids = list(range(self.nfeatures + 1, self.nfeatures + len(polygons) + 1))
+        self.nfeatures += len(polygons)
+        columns_values = [np.asarray(attributes[name]).tolist() for name, _ in self.columns]
+        rows = zip(fids, map(bytes, blobs), *columns_values)
+        self.connection.executemany("INSERT INTO \"{}\" (fid, geom{}) VALUES (?, ?{})".format(self.table_name, "".join([", \"{}\"".format(name) for name, _ in self.columns]), ", ?" * len(self.columns)), rows)
+        if self.spatial_index:
+            envelopes = np.stack([polygons_min[:, 0], polygons_max[:, 0], polygons_min[:, 1], polygons_max[:, 1]], axis=1).tolist()
+            self.connection.executemany("INSERT INTO \"rtree_{}_geom\" VALUES (?, ?, ?, ?, ?)".format(self.table_name), [[fid] + envelope for fid, envelope in zip(fids, envelopes)])
+
+        extent = np.concatenate([np.min(polygons_min, axis=0), np.max(polygons_max, axis=0)])
+        if self.extent is None:
+            self.extent = extent
+        else:
+            self.extent = np.concatenate([np.minimum(self.extent[:2], extent[:2]), np.maximum(self.extent[2:], extent[2:])])
+        self.connection.commit()
+
+    def close(self):
+        if self.extent is not None:
+            self.connection.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?", tuple(self.extent.tolist()) + (self.table_name,))
+        if self.spatial_index:
+            # triggers that keep the index up to date when other tools edit the file (ST_* functions are provided by GIS software),
+            # they are created in the end because this writer fills the index by itself
+            rtree = "\"rtree_{}_geom\"".format(self.table_name)
+            table = "\"{}\"".format(self.table_name)
+            trigger = "CREATE TRIGGER \"rtree_{}_geom_{{}}\" AFTER {{}} BEGIN {{}} END".format(self.table_name)
+            insert = "INSERT OR REPLACE INTO {} VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));".format(rtree)
+            for name, event, action in [
+                    ("insert", "INSERT ON {} WHEN (NEW.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom))".format(table), insert),
+                    ("update1", "UPDATE OF geom ON {} WHEN OLD.fid = NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))".format(table), insert),
+                    ("update2", "UPDATE OF geom ON {} WHEN OLD.fid = NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))".format(table), "DELETE FROM {} WHERE id = OLD.fid;".format(rtree)),
+                    ("update3", "UPDATE ON {} WHEN OLD.fid != NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))".format(table), "DELETE FROM {} WHERE id = OLD.fid; {}".format(rtree, insert)),
+                    ("update4", "UPDATE ON {} WHEN OLD.fid != NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))".format(table), "DELETE FROM {} WHERE id IN (OLD.fid, NEW.fid);".format(rtree)),
+                    ("delete", "DELETE ON {} WHEN OLD.geom NOT NULL".format(table), "DELETE FROM {} WHERE id = OLD.fid;".format(rtree))]:
+                self.connection.execute(trigger.format(name, event, action))
+        self.connection.commit()
+        self.connection.close()
+
+GEOPACKAGE_WGS84_WKT = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],' \
+                       'PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+
+def write_density_geotiff(path, density, xmin, ymax, cell_size, crs):
+    # Saves single-band float32 raster with top-left corner in (xmin, ymax) and square cells
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    height, width = density.shape
+    with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                       crs=rasterio.crs.CRS.from_wkt(crs.wkt) if crs is not None else None,
+                       transform=from_origin(xmin, ymax, cell_size, cell_size), compress="deflate") as dst:
+        dst.write(np.float32(density), 1)
+
+def markers_world_positions(chunk):
+    # Positions of markers in shapes coordinate system by marker key (None for markers without position),
+    # so that vertices of attached shapes are resolved without scanning all markers
+    T = chunk.transform.matrix
+    result = {}
+    for marker in chunk.markers:
+        if marker.position:
+            point = T.mulp(marker.position)
+            result[marker.key] = Metashape.CoordinateSystem.transform(point, chunk.world_crs, chunk.shapes.crs)
+        else:
+            result[marker.key] = None
     return result
 
-def getShapeVertices(shape):
+def getShapeVertices(shape, markers_positions=None):
     chunk = Metashape.app.document.chunk
     if (chunk == None):
         raise Exception("Null chunk")
 
-    T = chunk.transform.matrix
     result = []
 
     if shape.is_attached:
         assert(len(shape.geometry.coordinates) == 1)
+        if markers_positions is None:
+            markers_positions = markers_world_positions(chunk)
         for key in shape.geometry.coordinates[0]:
-            for marker in chunk.markers:
-                if marker.key == key:
-                    if (not marker.position):
-                        raise Exception("Invalid shape vertex")
-
-                    point = T.mulp(marker.position)
-                    point = Metashape.CoordinateSystem.transform(point, chunk.world_crs, chunk.shapes.crs)
-                    result.append(point)
+            if key in markers_positions:
+                point = markers_positions[key]
+                if point is None:
+                    raise Exception("Invalid shape vertex")
+                result.append(point)
     else:
         assert(len(shape.geometry.coordinates) == 1)
         for coord in shape.geometry.coordinates[0]:
@@ -130,7 +1751,69 @@ def getShapeVertices(shape):
 
     return result
 
-class DetectObjectsDlg(QtWidgets.QDialog):
+def vertices_in_crs(chunk, vertices, crs, tolerance):
+    # Transforms list of Metashape.Vector in shapes coordinate system to Nx2 array in given coordinate system.
+    # 2D and 3D vertices are transformed separately - 2D vertices shouldn't get zero altitude (it matters for vertical datums)
+    import numpy as np
+
+    is_3d = np.array([p.size == 3 for p in vertices], bool)
+    points = np.zeros((len(vertices), 2))
+    transformer = CrsTransformer(chunk.shapes.crs, crs)
+    for ndims, is_selected in [(2, ~is_3d), (3, is_3d)]:
+        if np.any(is_selected):
+            selected = np.float64([[p.x, p.y] if ndims == 2 else [p.x, p.y, p.z] for p, selected in zip(vertices, is_selected) if selected])
+            points[is_selected] = transformer.transform(selected, tolerance=tolerance)[:, :2]
+    return points
+
+def shapes_vertices_in_crs(chunk, shapes, crs, tolerance, markers_positions=None):
+    # Returns Nx2 vertices of all shapes (in given coordinate system) and offsets of each shape vertices in them
+    import numpy as np
+
+    vertices = []
+    offsets = [0]
+    for shape in shapes:
+        if shape.is_attached and markers_positions is None:
+            markers_positions = markers_world_positions(chunk)
+        vertices.extend(getShapeVertices(shape, markers_positions if shape.is_attached else None))
+        offsets.append(len(vertices))
+
+    return vertices_in_crs(chunk, vertices, crs, tolerance), np.int64(offsets)
+
+def shape_rings(shape, markers_positions=None):
+    # Returns rings (lists of vertices) of polygon or multipolygon shape - outer rings and holes, empty list for other geometry types
+    if shape.geometry.type not in [Metashape.Geometry.Type.PolygonType, Metashape.Geometry.Type.MultiPolygonType]:
+        return []
+    if shape.is_attached:
+        return [getShapeVertices(shape, markers_positions)]
+
+    rings = []
+    def collect_rings(coordinates):
+        if len(coordinates) > 0 and isinstance(coordinates[0], Metashape.Vector):
+            rings.append(list(coordinates))
+        else:
+            for part in coordinates:
+                collect_rings(part)
+    collect_rings(shape.geometry.coordinates)
+    return rings
+
+def shapes_rings_in_crs(chunk, shapes, crs, tolerance, markers_positions=None):
+    # Returns Nx2 vertices of all rings of polygon shapes (in given coordinate system), offsets of each ring vertices in them and index of shape of each ring
+    import numpy as np
+
+    vertices = []
+    offsets = [0]
+    rings_shapes = []
+    for shape_i, shape in enumerate(shapes):
+        if shape.is_attached and markers_positions is None:
+            markers_positions = markers_world_positions(chunk)
+        for ring in shape_rings(shape, markers_positions if shape.is_attached else None):
+            vertices.extend(ring)
+            offsets.append(len(vertices))
+            rings_shapes.append(shape_i)
+
+    return vertices_in_crs(chunk, vertices, crs, tolerance), np.int64(offsets), np.int64(rings_shapes)
+
+class DetectObjectsDlg(QtWidgets.QDialog, DetectionCore):
 
     def __init__(self, parent):
 
@@ -166,6 +1849,31 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         self.preferred_patch_size = 400  # 400 pixels
         self.preferred_resolution = 0.10  # 10 cm/pix
         self.detection_score_threshold = None  # can be from 0.0 to 1.0, for example it can be 0.98
+        self.train_streaming_dataset = False  # keep train tiles in memory and augment them on the fly instead of writing all augmented versions to disk
+        self.train_dataloader_workers = 0 if os.name == "nt" else 4  # worker processes for on the fly augmentation (on Windows Metashape can't spawn python worker processes)
+        self.train_cache_frozen_features = False  # evaluate frozen backbone layers only once per train tile and train only the rest of neural network on cached features (faster on CPU, requires disk space in train directory)
+        self.train_data_cache = False  # keep prepared (augmented) train tiles near working dir, so that the next run with the same zones, annotations and augmentation settings goes straight to training (can be enabled in dialog)
+        self.train_data_cache_entries = 3  # number of the most recently used prepared train data kept in cache
+        self.train_validation_fraction = 0.0  # fraction of train tiles of each zone (a strip on its side) held out of training to measure validation loss after each epoch (for early stopping), 0 - no validation, all tiles are used for training
+        self.train_early_stopping_patience = 3  # stop training if validation loss didn't improve during this number of epochs (the best epoch weights are kept)
+        self.detection_batch_size = 8  # number of subtiles passed to neural network at once (bigger batch is faster but requires more memory), 1 - process subtiles one by one
+        self.cpu_inference_backend = "eager"  # "eager" - PyTorch as is, "torchscript" - exported TorchScript, "int8" - TorchScript with int8 quantized backbone (used only without CUDA GPU and only if results are close to "eager")
+        self.detection_queue_depth = 2  # number of big tiles prepared in advance (and waiting for post-processing) during detection, bigger depth requires more memory
+        self.detection_memory_budget_mb = None  # memory for big tiles in flight during detection (size of big tiles and queue depth are reduced to fit it), None - half of available RAM
+        self.tiles_cache_size_mb = 1024  # memory limit for decoded orthomosaic tiles reused by neighboring big tiles and train tiles (shared by all local detection processes, each of them gets its part)
+        self.detection_skip_nodata_fraction = 1.0  # subtiles with bigger or equal fraction of no-data (white) pixels are not passed to neural network (1.0 - skip only empty subtiles)
+        self.detection_checkpoints = False  # save results of each big tile to <working dir>_cache until detection finishes, so that interrupted detection can be resumed by the next run with the same model and parameters
+        self.incremental_detection = False  # keep results of each big tile between runs and update the previous detection layer only where orthomosaic tiles changed (f.e. after seamlines editing)
+        self.detection_export_path = ""  # GeoPackage file to which detected objects are streamed (boxes in orthomosaic coordinate system with scores and spatial index), "" - no export
+        self.detection_export_only = False  # don't add detected objects to shape layer (for huge orthomosaics - results are only in export file)
+        self.detection_layer_batch_size = 100000  # detected objects are added to shape layer in batches of this size during detection, so that all results are never held in memory
+        self.orthomosaic_storage = "tiles"  # "tiles" - JPEG file per tile, "memmap" - single lossless raw file (faster, but requires width*height*3 bytes of disk space)
+        self.orthomosaic_export_cache = False  # keep exported orthomosaic tiles near working dir, so the next runs with the same orthomosaic, resolution and patch size skip export (can be enabled in dialog)
+        self.orthomosaic_export_cache_size_mb = 20 * 1024  # least recently used exported orthomosaics are deleted from the cache when it becomes bigger
+        self.inference_daemon = False  # keep neural network loaded in background process between runs of the script (not used with training on user data)
+        self.detection_processes = 1  # number of worker processes for detection on CPU (each with its own neural network and cpu_count/processes torch threads), 1 - detect in Metashape process
+        self.detection_nodes = 1  # number of shards of big tiles grid processed headless on other machines with shared working dir (commands for nodes are printed to console), 1 - no nodes
+        self.detection_nodes_local = False  # process shards of nodes by local processes (to test multi-node detection on a single machine)
 
         self.prefer_original_resolution = True
         self.use_neural_network_pretrained_on_birds = False
@@ -190,6 +1898,9 @@ class DetectObjectsDlg(QtWidgets.QDialog):
     def process(self):
         try:
             self.stopped = False
+            self.markers_positions = None
+            self.inference_client = None
+            self.exported_model = None
             self.btnRun.setEnabled(False)
             self.btnStop.setEnabled(True)
 
@@ -230,6 +1941,8 @@ class DetectObjectsDlg(QtWidgets.QDialog):
                                          "Please check the console.")
                 raise
         finally:
+            if self.inference_client is not None:
+                self.inference_client.close()
             if self.cleanup_working_dir:
                 shutil.rmtree(self.working_dir, ignore_errors=True)
             self.reject()
@@ -244,6 +1957,9 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         if self.working_dir == "":
             raise Exception("You should specify working directory (or save .psx project)")
 
+        # persistent data (like detection checkpoints) is stored near working dir, because working dir is removed in the end
+        self.cache_dir = str(pathlib.Path(self.working_dir).parent / (pathlib.Path(self.working_dir).name + "_cache"))
+
         print("Working dir: {}".format(self.working_dir))
         try:
             os.mkdir(self.working_dir)
@@ -275,26 +1991,47 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         if os.name == 'nt': # if Windows
             multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
 
+    def neural_network_spec(self):
+        # Description of the neural network that allows to load the same model in other process
+        if len(self.load_model_path) > 0:
+            return {"checkpoint": self.load_model_path}
+        elif self.use_neural_network_pretrained_on_birds:
+            return {"hub": "weecology/deepforest-bird"}
+        else:
+            return {"hub": "weecology/deepforest-tree"}
+
     def create_neural_network(self):
-        print("Neural network loading...")
-        import deepforest
-        from deepforest import main
+        self.inference_client = None
+        if len(self.load_model_path) == 0:
+            if self.use_neural_network_pretrained_on_birds:
+                print("Using the neural network pre-trained on birds...")
+            else:
+                print("Using the neural network pre-trained on trees...")
 
-        # Load from checkpoint if provided (Lightning checkpoint recommended).
-        if len(self.load_model_path) > 0:
-            print("Loading model checkpoint from '{}'...".format(self.load_model_path))
-            self.m = main.deepforest.load_from_checkpoint(self.load_model_path)
-            return
+        if self.inference_daemon and not self.train_on_user_data_enabled:
+            try:
+                print("Connecting to inference daemon...")
+                self.inference_client = InferenceDaemonClient()
+                self.inference_client.load_model(self.neural_network_spec())
+                self.m = None
+                return
+            except Exception as e:
+                print("Inference daemon is not available ({}), neural network will be loaded in Metashape".format(e))
+                if self.inference_client is not None:
+                    self.inference_client.close()
+                self.inference_client = None
 
-        self.m = main.deepforest()
-        if self.use_neural_network_pretrained_on_birds:
-            print("Using the neural network pre-trained on birds...")
-            self.m.load_model(model_name="weecology/deepforest-bird", revision="main")
-        else:
-            print("Using the neural network pre-trained on trees...")
-            self.m.load_model(model_name="weecology/deepforest-tree", revision="main")
+        print("Neural network loading...")
+        self.m = load_deepforest_model(self.neural_network_spec())
+
+    def neural_network_digest(self):
+        if self.inference_client is not None:
+            return self.inference_client.weights_digest
+        return model_weights_digest(self.m.model)
 
     def export_orthomosaic(self):
+        import hashlib
+        import json
         import numpy as np
 
         print("Prepairing orthomosaic...")
@@ -304,12 +2041,33 @@ class DetectObjectsDlg(QtWidgets.QDialog):
             kwargs["resolution"] = self.preferred_resolution
         else:
             print("no resolution downscaling required")
-        self.chunk.exportRaster(path=self.dir_tiles + "tile.jpg", source_data=Metashape.OrthomosaicData, image_format=Metashape.ImageFormat.ImageFormatJPEG, save_alpha=False, white_background=True,
-                                save_world=True,
-                                split_in_blocks=True, block_width=self.patch_size, block_height=self.patch_size,
-                                **kwargs)
-
-        tiles = os.listdir(self.dir_tiles)
+        if self.orthomosaic_storage == "memmap":
+            # lossless tiles, they will be converted to the single raw mosaic right after export
+            tile_ext, image_format = ".tif", Metashape.ImageFormat.ImageFormatTIFF
+        else:
+            tile_ext, image_format = ".jpg", Metashape.ImageFormat.ImageFormatJPEG
+
+        self.tiles_format = tile_ext  # lossless TIFF or JPEG tiles - their pixels differ
+        cache_entry = self.orthomosaic_export_cache_entry(kwargs, tile_ext)
+        self.tiles_from_export_cache = cache_entry is not None
+        if cache_entry is not None and os.path.exists(cache_entry + "complete.json"):
+            print("Reusing orthomosaic tiles exported by previous run: {}".format(cache_entry))
+            tiles_dir = cache_entry
+            self.evict_orthomosaic_export_cache(cache_entry)
+        else:
+            # in case of cache export goes to temporary dir which is renamed only when export is complete
+            tiles_dir = self.dir_tiles if cache_entry is None else cache_entry[:-1] + ".tmp_{}/".format(os.getpid())
+            if cache_entry is not None:
+                shutil.rmtree(tiles_dir, ignore_errors=True)
+                os.makedirs(tiles_dir)
+            self.chunk.exportRaster(path=tiles_dir + "tile" + tile_ext, source_data=Metashape.OrthomosaicData, image_format=image_format, save_alpha=False, white_background=True,
+                                    save_world=True,
+                                    split_in_blocks=True, block_width=self.patch_size, block_height=self.patch_size,
+                                    **kwargs)
+            if cache_entry is not None:
+                tiles_dir = self.add_to_orthomosaic_export_cache(tiles_dir, cache_entry)
+
+        tiles = [tile for tile in os.listdir(tiles_dir) if tile.startswith("tile-")]
         self.tiles_paths = {}
         self.tiles_to_world = {}
         for tile in sorted(tiles):
@@ -317,13 +2075,13 @@ class DetectObjectsDlg(QtWidgets.QDialog):
 
             _, tile_x, tile_y = tile.split(".")[0].split("-")
             tile_x, tile_y = map(int, [tile_x, tile_y])
-            if tile.endswith(".jgw") or tile.endswith(".pgw"):  # https://en.wikipedia.org/wiki/World_file
-                with open(self.dir_tiles + tile, "r") as file:
+            if tile.endswith(".jgw") or tile.endswith(".pgw") or tile.endswith(".tfw"):  # https://en.wikipedia.org/wiki/World_file
+                with open(tiles_dir + tile, "r") as file:
                     matrix2x3 = list(map(float, file.readlines()))
                 matrix2x3 = np.array(matrix2x3).reshape(3, 2).T
                 self.tiles_to_world[tile_x, tile_y] = matrix2x3
-            elif tile.endswith(".jpg"):
-                self.tiles_paths[tile_x, tile_y] = self.dir_tiles + tile
+            elif tile.endswith(tile_ext):
+                self.tiles_paths[tile_x, tile_y] = tiles_dir + tile
 
         assert(len(self.tiles_paths) == len(self.tiles_to_world))
         assert(self.tiles_paths.keys() == self.tiles_to_world.keys())
@@ -334,12 +2092,131 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         self.tile_max_y = max([key[1] for key in self.tiles_paths.keys()])
         print("{} tiles, tile_x in [{}; {}], tile_y in [{}; {}]".format(len(self.tiles_paths), self.tile_min_x, self.tile_max_x, self.tile_min_y, self.tile_max_y))
 
+        self.tiles_cache = DecodedTilesCache(self.tiles_cache_size_mb * 1024 * 1024)
+
+        # content hashes of exported tiles - to detect which big tiles should be re-processed by resumed or incremental detection
+        self.tiles_hashes = {}
+        if self.big_tiles_results_saved():
+            hashes_path = tiles_dir + "tiles_hashes.json"
+            if cache_entry is not None and os.path.exists(hashes_path):
+                with open(hashes_path, "r") as file:
+                    self.tiles_hashes = {tuple(map(int, tile_xy.split(","))): digest for tile_xy, digest in json.load(file).items()}
+            else:
+                for tile_xy, tile_path in self.tiles_paths.items():
+                    with open(tile_path, "rb") as file:
+                        self.tiles_hashes[tile_xy] = hashlib.sha1(file.read()).hexdigest()
+                if cache_entry is not None:
+                    with open(hashes_path + ".tmp", "w") as file:
+                        json.dump({"{},{}".format(*tile_xy): digest for tile_xy, digest in self.tiles_hashes.items()}, file)
+                    os.replace(hashes_path + ".tmp", hashes_path)
+
+        self.mosaic = None
+        if self.orthomosaic_storage == "memmap":
+            self.convert_tiles_to_mosaic()
+
+    def orthomosaic_modification_stamp(self):
+        # Orthomosaic key is kept when orthomosaic is rebuilt or edited (f.e. seamlines), so its extent, metadata
+        # and modification times of orthomosaic files in project data dir are used too.
+        # None - there is no reliable stamp: orthomosaic has unsaved changes, or its files weren't found (f.e. in .psz project),
+        # and extent with metadata don't change after seamlines or patches editing
+        orthomosaic = self.chunk.orthomosaic
+        if orthomosaic.modified or len(Metashape.app.document.path) == 0:
+            return None
+        meta = sorted((key, orthomosaic.meta[key]) for key in orthomosaic.meta.keys())
+        files_mtimes = []
+        for dirpath, dirnames, filenames in os.walk(os.path.splitext(Metashape.app.document.path)[0] + ".files"):
+            if os.path.basename(dirpath) == "orthomosaic":
+                files_mtimes.extend(os.path.getmtime(os.path.join(dirpath, filename)) for filename in filenames)
+        if len(files_mtimes) == 0:
+            return None
+        return [orthomosaic.width, orthomosaic.height, orthomosaic.left, orthomosaic.top, orthomosaic.right, orthomosaic.bottom,
+                orthomosaic.crs.wkt if orthomosaic.crs is not None else None, meta, max(files_mtimes)]
+
+    def orthomosaic_export_cache_entry(self, export_kwargs, tile_ext):
+        # Dir of exported tiles in cache (None if cache can't be used)
+        import hashlib
+
+        if not self.orthomosaic_export_cache:
+            return None
+        stamp = self.orthomosaic_modification_stamp()
+        if stamp is None:
+            print("Orthomosaic modification can't be detected (it has unsaved changes or project isn't saved in .psx format), exported tiles will not be cached")
+            return None
+        key = [self.chunk.key, self.chunk.orthomosaic.key, stamp, export_kwargs.get("resolution"), self.patch_size, tile_ext]
+        return self.cache_dir + "/orthomosaic_tiles/" + hashlib.sha1(repr(key).encode()).hexdigest() + "/"
+
+    def add_to_orthomosaic_export_cache(self, tiles_dir, cache_entry):
+        # Moves just exported tiles to cache entry and evicts least recently used entries if cache is too big, returns dir of tiles
+        import json
+
+        size = sum(entry.stat().st_size for entry in os.scandir(tiles_dir) if entry.is_file())
+        with open(tiles_dir + "complete.json", "w") as file:
+            json.dump({"size": size}, file)
+        try:
+            os.rename(tiles_dir, cache_entry)
+        except OSError:
+            # the same orthomosaic was exported by concurrent run
+            if not os.path.exists(cache_entry + "complete.json"):
+                raise
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+        self.evict_orthomosaic_export_cache(cache_entry)
+        return cache_entry
+
+    def evict_orthomosaic_export_cache(self, used_entry):
+        # Last usage time of entry is modification time of its complete.json
+        import json
+
+        os.utime(used_entry + "complete.json")
+        cache_root = self.cache_dir + "/orthomosaic_tiles/"
+        entries = []
+        for entry in os.scandir(cache_root):
+            marker_path = entry.path + "/complete.json"
+            if ".tmp_" in entry.name:
+                # leftovers of interrupted exports
+                if time.time() - entry.stat().st_mtime > 24 * 60 * 60:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif os.path.exists(marker_path):
+                with open(marker_path, "r") as file:
+                    entries.append((os.path.getmtime(marker_path), json.load(file)["size"], entry.path + "/"))
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.orthomosaic_export_cache_size_mb * 1024 * 1024:
+                break
+            if os.path.normpath(path) == os.path.normpath(used_entry):
+                continue
+            print("Removing exported orthomosaic from cache: {}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def convert_tiles_to_mosaic(self):
+        # Copies all exported tiles into a single raw memory-mapped file (tile files are deleted after that),
+        # so that any window of orthomosaic (train tile or big tile with its halo) is just a slice of the mosaic
+        import numpy as np
+
+        print("Converting tiles to memory-mapped mosaic...")
+        mosaic_shape = ((self.tile_max_y - self.tile_min_y + 1) * self.patch_size, (self.tile_max_x - self.tile_min_x + 1) * self.patch_size, 3)
+        mosaic_path = self.dir_tiles + "mosaic.raw"
+        mosaic = np.memmap(mosaic_path, dtype=np.uint8, mode="w+", shape=mosaic_shape)
+        for tile_x in range(self.tile_min_x, self.tile_max_x + 1):
+            for tile_y in range(self.tile_min_y, self.tile_max_y + 1):
+                fromx, fromy = (tile_x - self.tile_min_x) * self.patch_size, (tile_y - self.tile_min_y) * self.patch_size
+                part = mosaic[fromy:fromy + self.patch_size, fromx:fromx + self.patch_size, :]
+                if (tile_x, tile_y) in self.tiles_paths:
+                    part[:, :, :] = self.load_tile((tile_x, tile_y))
+                    if not self.tiles_from_export_cache:
+                        os.remove(self.tiles_paths[tile_x, tile_y])
+                else:
+                    part[:, :, :] = 255
+        mosaic.flush()
+        del mosaic
+
+        self.mosaic = np.memmap(mosaic_path, dtype=np.uint8, mode="r", shape=mosaic_shape)
+        self.mosaic_from = np.int32([self.tile_min_x, self.tile_min_y]) * self.patch_size
+        print("Mosaic {}x{} pixels ({:.2f} GB) prepared".format(mosaic_shape[1], mosaic_shape[0], self.mosaic.nbytes / 1024**3))
+
     def train_on_user_data(self):
-        import sys
-        import cv2
         import random
-        import numpy as np
-        import pandas as pd
+        import pickle
         import multiprocessing
         import torch
         from pytorch_lightning import Trainer
@@ -352,11 +2229,156 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         training_start = time.time()
         print("Neural network additional training on user data...")
 
+        # vertices of all zones and annotations are transformed to orthomosaic coordinate system only once
+        zones_vertices, zones_offsets = self.shapes_vertices_in_orthomosaic_crs(self.train_zones)
+        annotations_vertices, annotations_offsets = self.shapes_vertices_in_orthomosaic_crs(self.train_data)
+
+        self.colors_augmentation = create_colors_augmentation(self.augment_colors)
+
+        prepared_dir = self.train_data_cache_entry(zones_vertices, zones_offsets, annotations_vertices, annotations_offsets)
+        if prepared_dir is not None and os.path.exists(prepared_dir + "prepared.pkl"):
+            print("Reusing train data prepared by previous run: {}".format(prepared_dir))
+            with open(prepared_dir + "prepared.pkl", "rb") as file:
+                prepared = pickle.load(file)
+            self.evict_train_data_cache(prepared_dir)
+        else:
+            # in case of cache train tiles are saved to temporary dir which is renamed only when preparation is complete
+            train_subtiles_dir = self.dir_train_subtiles if prepared_dir is None else prepared_dir[:-1] + ".tmp_{}/".format(os.getpid())
+            if prepared_dir is not None:
+                shutil.rmtree(train_subtiles_dir, ignore_errors=True)
+                os.makedirs(train_subtiles_dir)
+            prepared = self.prepare_train_data(zones_vertices, zones_offsets, annotations_vertices, annotations_offsets, train_subtiles_dir)
+            if prepared_dir is None:
+                prepared_dir = train_subtiles_dir
+            else:
+                self.add_to_train_data_cache(train_subtiles_dir, prepared_dir, prepared)
+
+        # random state is restored as it was after preparation, so that training on cached train data is the same
+        random.setstate(prepared["random_state"])
+        self.train_nannotations_in_zones = prepared["nannotations_in_zones"]
+        validation_tiles, validation_tiles_boxes = prepared["validation_tiles"], prepared["validation_tiles_boxes"]
+        train_tiles, train_tiles_boxes, train_items = prepared["train_tiles"], prepared["train_tiles_boxes"], prepared["train_items"]
+        annotations_file = prepared_dir + "annotations.csv"
+
+        print("Training with {} epochs and x{} augmentations (augment colors: {})...".format(self.max_epochs, self.data_augmentation_multiplier, self.augment_colors))
+        # features can be cached only if train tiles are the same in all epochs - i.e. augmented tiles were saved to disk
+        use_features_cache = self.train_cache_frozen_features and not self.train_streaming_dataset
+        if self.train_cache_frozen_features and self.train_streaming_dataset:
+            print("Warning, frozen features can't be cached with streaming dataset (colors augmentation differs in each epoch)")
+        # the same layers are trained with and without features cache
+        self.freeze_layers()
+        if use_features_cache and len(frozen_backbone_prefix(self.m.model.backbone.body)) == 0:
+            print("Warning, frozen features can't be cached - the first layer of backbone is trainable")
+            use_features_cache = False
+
+        best_validation = {"loss": None, "epoch": None, "state_dict": None}
+        self.train_validation_loss = None  # of the last epoch
+
+        def validate_epoch(nepochs_done):
+            # Returns True if training should be stopped because validation loss stopped improving
+            if len(validation_tiles) == 0:
+                return False
+            validation_loss = self.validation_loss(validation_tiles, validation_tiles_boxes)
+            self.train_validation_loss = validation_loss
+            print("Epoch {}: validation loss {:.4f}".format(nepochs_done, validation_loss))
+            if best_validation["loss"] is None or validation_loss < best_validation["loss"]:
+                best_validation["loss"] = validation_loss
+                best_validation["epoch"] = nepochs_done
+                best_validation["state_dict"] = {key: value.detach().cpu().clone() for key, value in self.m.model.state_dict().items()}
+            return nepochs_done - best_validation["epoch"] >= self.train_early_stopping_patience
+
+        class MyCallback(Callback):
+            def __init__(self, thiz_dlg):
+                self.nepochs_done = 0
+                self.nepochs = thiz_dlg.max_epochs
+                self.pbar = thiz_dlg.trainPBar
+                self.thiz_dlg = thiz_dlg
+            def on_train_epoch_end(self, trainer, pl_module):
+                self.nepochs_done += 1
+                self.pbar.setValue(self.nepochs_done * 100 / self.nepochs)
+                if validate_epoch(self.nepochs_done):
+                    print("Early stopping after epoch {}".format(self.nepochs_done))
+                    trainer.should_stop = True
+                Metashape.app.update()
+                app.processEvents()
+                self.thiz_dlg.check_stopped()
+
+        if torch.cuda.device_count() > 0:
+            print("Using GPU...")
+            accelerator = "gpu"
+            devices = 1
+        else:
+            print("Using CPU (will be very slow)...")
+            accelerator = "cpu"
+            devices = 1
+            torch.set_num_threads(multiprocessing.cpu_count())
+
+        # DeepForest checks that config.train.csv_file is set at fit start.
+        self.m.config.train.csv_file = annotations_file
+        self.m.config.train.root_dir = os.path.dirname(annotations_file)
+        self.m.config.train.epochs = self.max_epochs
+
+        # Disable DF internal augmentations (we already generate augmented tiles ourselves).
+        try:
+            self.m.config.train.augmentations = None
+        except Exception:
+            pass
+
+        trainer = Trainer(
+            max_epochs=self.max_epochs,
+            accelerator=accelerator,
+            devices=devices,
+            logger=False,
+            enable_checkpointing=False,
+            callbacks=[MyCallback(self)],
+        )
+        self.m.trainer = trainer
+        if self.train_streaming_dataset:
+            import deepforest
+
+            # annotations.csv is still saved - for reference and for DeepForest check of config.train.csv_file, but images are streamed from memory
+            label_id = getattr(self.m, "label_dict", {"Tree": 0}).get("Tree", 0)
+            dataset = StreamingTrainDataset(train_tiles, train_tiles_boxes, train_items, self.augment_colors, label_id,
+                                            image_first=int(deepforest.__version__.split(".")[0]) >= 2)
+            train_dataloader = torch.utils.data.DataLoader(dataset, batch_size=self.m.config.batch_size, shuffle=True,
+                                                           num_workers=self.train_dataloader_workers, persistent_workers=self.train_dataloader_workers > 0,
+                                                           collate_fn=collate_tuples, worker_init_fn=seed_dataloader_worker)
+            print("Streaming {} train tiles versions from {} base tiles with {} dataloader workers...".format(len(train_items), len(train_tiles), self.train_dataloader_workers))
+            trainer.fit(self.m, train_dataloaders=train_dataloader)
+        elif use_features_cache:
+            self.train_on_cached_features(annotations_file, torch.device("cuda" if accelerator == "gpu" else "cpu"), validate_epoch)
+        else:
+            trainer.fit(self.m)
+
+        if best_validation["state_dict"] is not None:
+            print("Using weights from epoch {} with the best validation loss {:.4f}".format(best_validation["epoch"], best_validation["loss"]))
+            self.m.model.load_state_dict(best_validation["state_dict"])
+        self.trainPBar.setValue(100)
+
+        self.results_time_training = time.time() - training_start
+
+        if len(self.save_model_path) > 0:
+            # Save Lightning checkpoint (recommended for re-loading with load_from_checkpoint).
+            if use_features_cache:
+                save_lightning_checkpoint(self.m, self.save_model_path)  # trainer wasn't used, so it can't save checkpoint
+            else:
+                self.m.save_model(self.save_model_path)
+            print("Model trained on {} annotations with {} m/pix resolution saved to '{}'".format(self.train_nannotations_in_zones, self.orthomosaic_resolution, self.save_model_path))
+
+    def prepare_train_data(self, zones_vertices, zones_offsets, annotations_vertices, annotations_offsets, train_subtiles_dir):
+        # Splits train zones in tiles with annotations (augmented versions of tiles are saved to train_subtiles_dir
+        # if they are not streamed), saves annotations.csv to train_subtiles_dir and returns everything else needed for training
+        import sys
+        import cv2
+        import random
+        import numpy as np
+        import pandas as pd
+
         self.train_zones_on_ortho = []
 
         n_train_zone_shapes_out_of_orthomosaic = 0
         for zone_i, shape in enumerate(self.train_zones):
-            shape_vertices = getShapeVertices(shape)
+            shape_vertices = zones_vertices[zones_offsets[zone_i]:zones_offsets[zone_i + 1]]
             zone_from_world = None
             zone_from_world_best = None
             for tile_x in range(self.tile_min_x, self.tile_max_x + 1):
@@ -365,27 +2387,16 @@ class DetectObjectsDlg(QtWidgets.QDialog):
                         continue
                     to_world = self.tiles_to_world[tile_x, tile_y]
                     from_world = self.invert_matrix_2x3(to_world)
-                    for p in shape_vertices:
-                        p = Metashape.CoordinateSystem.transform(p, self.chunk.shapes.crs, self.chunk.orthomosaic.crs)
-                        p_in_tile = from_world @ [p.x, p.y, 1]
-                        distance2_to_tile_center = np.linalg.norm(p_in_tile - [self.patch_size/2, self.patch_size/2])
-                        if zone_from_world_best is None or distance2_to_tile_center < zone_from_world_best:
-                            zone_from_world_best = distance2_to_tile_center
-                            zone_from_world = self.invert_matrix_2x3(self.add_pixel_shift(to_world, -tile_x * self.patch_size, -tile_y * self.patch_size))
+                    p_in_tile = shape_vertices @ from_world[:, :2].T + from_world[:, 2]
+                    distance2_to_tile_center = np.min(np.linalg.norm(p_in_tile - [self.patch_size/2, self.patch_size/2], axis=1))
+                    if zone_from_world_best is None or distance2_to_tile_center < zone_from_world_best:
+                        zone_from_world_best = distance2_to_tile_center
+                        zone_from_world = self.invert_matrix_2x3(self.add_pixel_shift(to_world, -tile_x * self.patch_size, -tile_y * self.patch_size))
             if zone_from_world_best > 1.1 * (self.patch_size / 2)**2:
                 n_train_zone_shapes_out_of_orthomosaic += 1
 
-            zone_from = None
-            zone_to = None
-            for p in shape_vertices:
-                p = Metashape.CoordinateSystem.transform(p, self.chunk.shapes.crs, self.chunk.orthomosaic.crs)
-                p_in_ortho = np.int32(np.round(zone_from_world @ [p.x, p.y, 1]))
-                if zone_from is None:
-                    zone_from = p_in_ortho
-                if zone_to is None:
-                    zone_to = p_in_ortho
-                zone_from = np.minimum(zone_from, p_in_ortho)
-                zone_to = np.maximum(zone_to, p_in_ortho)
+            zone_box = polygons_bounding_boxes(shape_vertices, np.int64([0, len(shape_vertices)]), zone_from_world)[0]
+            zone_from, zone_to = np.int32(zone_box[:2]), np.int32(zone_box[2:])
             train_size = zone_to - zone_from
             train_size_m = np.int32(np.round(train_size * self.orthomosaic_resolution))
             if np.any(train_size < self.patch_size):
@@ -402,55 +2413,72 @@ class DetectObjectsDlg(QtWidgets.QDialog):
 
         area_threshold = 0.3
 
-        all_annotations = pd.DataFrame(columns=['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label'])
+        # for each zone annotations are projected to its pixels and indexed, so that each train tile checks only nearby annotations
+
+        all_annotations = []
         nannotated_tiles = 0
 
+        # not augmented tiles held out for validation loss after each epoch
+        validation_tiles = []
+        validation_tiles_boxes = []
+
+        # for streaming dataset
+        train_tiles = []
+        train_tiles_boxes = []
+        train_items = []
+
         if self.tiles_without_annotations_supported:
             empty_tile_name = "empty_tile.jpg"
             empty_tile = self.create_empty_tile()
-            cv2.imwrite(self.dir_train_subtiles + empty_tile_name, empty_tile)
+            if self.train_streaming_dataset:
+                train_tiles.append(empty_tile)
+                train_tiles_boxes.append(np.zeros((0, 4), np.int64))
+                train_items.append((len(train_tiles) - 1, 0, empty_tile_name))
+            else:
+                cv2.imwrite(train_subtiles_dir + empty_tile_name, empty_tile)
 
             # See https://github.com/weecology/DeepForest/issues/216
-            all_annotations = pandas_append(all_annotations, {'image_path': empty_tile_name, 'xmin': '0', 'ymin': '0', 'xmax': '0', 'ymax': '0', 'label': 'Tree'}, ignore_index=True)
+            all_annotations.append({'image_path': empty_tile_name, 'xmin': '0', 'ymin': '0', 'xmax': '0', 'ymax': '0', 'label': 'Tree'})
 
         nempty_tiles = 0
 
+        # validation tiles are a strip on a side of each zone. If no zone is big enough for that - the smallest zone is held out entirely
+        zones_layouts = {}
+        for zone_i, zone_on_ortho in enumerate(self.train_zones_on_ortho):
+            if zone_on_ortho is not None:
+                zone_from, zone_to, _ = zone_on_ortho
+                zones_layouts[zone_i] = self.train_zone_layout(zone_to - zone_from)
+        if self.train_validation_fraction > 0 and len(zones_layouts) >= 2 and all(layout[4] == len(layout[5]) for layout in zones_layouts.values()):
+            zone_i = min(zones_layouts.keys(), key=lambda zone_i: zones_layouts[zone_i][0] * zones_layouts[zone_i][1])
+            nx_tiles, ny_tiles, xy_step, validation_axis, _, is_gap_row = zones_layouts[zone_i]
+            zones_layouts[zone_i] = (nx_tiles, ny_tiles, xy_step, validation_axis, 0, np.zeros_like(is_gap_row))
+            print("Train zones are too small to hold out validation tiles in them, train zone #{} is used only for validation".format(zone_i + 1))
+
         self.train_nannotations_in_zones = 0
         for zone_i, shape in enumerate(self.train_zones):
             if self.train_zones_on_ortho[zone_i] is None:
                 continue
             zone_from, zone_to, zone_from_world = self.train_zones_on_ortho[zone_i]
-            annotations = []
-            for annotation in self.train_data:
-                annotation_vertices = getShapeVertices(annotation)
-                annotation_from = None
-                annotation_to = None
-                for p in annotation_vertices:
-                    p = Metashape.CoordinateSystem.transform(p, self.chunk.shapes.crs, self.chunk.orthomosaic.crs)
-                    p_in_ortho = np.int32(np.round(zone_from_world @ [p.x, p.y, 1]))
-                    if annotation_from is None:
-                        annotation_from = p_in_ortho
-                    if annotation_to is None:
-                        annotation_to = p_in_ortho
-                    annotation_from = np.minimum(annotation_from, p_in_ortho)
-                    annotation_to = np.maximum(annotation_to, p_in_ortho)
-                bbox_from, bbox_to = self.intersect(zone_from, zone_to, annotation_from, annotation_to)
-                if self.area(bbox_from, bbox_to) > self.area(annotation_from, annotation_to) * area_threshold:
-                    annotations.append((annotation_from, annotation_to))
+            annotations = np.zeros((0, 4), np.int64)
+            if len(self.train_data) > 0:
+                annotations = polygons_bounding_boxes(annotations_vertices, annotations_offsets, zone_from_world)
+            annotations_areas = (annotations[:, 2] - annotations[:, 0]) * (annotations[:, 3] - annotations[:, 1])
+            annotations = annotations[intersection_areas(annotations, *zone_from, *zone_to) > annotations_areas * area_threshold]
+            annotations_areas = (annotations[:, 2] - annotations[:, 0]) * (annotations[:, 3] - annotations[:, 1])
+            annotations_index = BoxesGridIndex(annotations, self.patch_size)
             self.train_nannotations_in_zones += len(annotations)
             print("Train zone #{}: {} annotations inside".format(zone_i + 1, len(annotations)))
 
-            border = self.patch_inner_border
-            inner_path_size = self.patch_size - 2 * border
-
-            zone_size = zone_to - zone_from
-            assert np.all(zone_size >= self.patch_size)
-            nx_tiles, ny_tiles = np.int32((zone_size - 2 * border + inner_path_size - 1) // inner_path_size)
-            assert nx_tiles >= 1 and ny_tiles >= 1
-            xy_step = np.int32(np.round((zone_size + [nx_tiles, ny_tiles] - 1) // [nx_tiles, ny_tiles]))
+            nx_tiles, ny_tiles, xy_step, validation_axis, first_validation_row, is_gap_row = zones_layouts[zone_i]
+            ngap_tiles = int(is_gap_row.sum()) * [nx_tiles, ny_tiles][1 - validation_axis]
             out_of_orthomosaic_train_tile = 0
+
             for x_tile in range(0, nx_tiles):
                 for y_tile in range(0, ny_tiles):
+                    row = [x_tile, y_tile][validation_axis]
+                    if is_gap_row[row]:
+                        continue
+
                     tile_to = zone_from + self.patch_size + xy_step * [x_tile, y_tile]
                     if x_tile == nx_tiles - 1 and y_tile == ny_tiles - 1:
                         assert np.all(tile_to >= zone_to)
@@ -468,10 +2496,17 @@ class DetectObjectsDlg(QtWidgets.QDialog):
                         continue
 
                     tile_annotations = []
-                    for annotation_from, annotation_to in annotations:
-                        bbox_from, bbox_to = self.intersect(tile_from, tile_to, annotation_from, annotation_to)
-                        if self.area(bbox_from, bbox_to) > self.area(annotation_from, annotation_to) * area_threshold:
-                            tile_annotations.append((bbox_from - tile_from, bbox_to - tile_from))
+                    nearby = annotations_index.query(*tile_from, *tile_to)
+                    nearby = nearby[intersection_areas(annotations[nearby], *tile_from, *tile_to) > annotations_areas[nearby] * area_threshold]
+                    for annotation in annotations[nearby]:
+                        bbox_from, bbox_to = self.intersect(tile_from, tile_to, np.int32(annotation[:2]), np.int32(annotation[2:]))
+                        tile_annotations.append((bbox_from - tile_from, bbox_to - tile_from))
+
+                    if row >= first_validation_row:
+                        if len(tile_annotations) > 0 or self.tiles_without_annotations_supported:
+                            validation_tiles.append(np.array(tile))
+                            validation_tiles_boxes.append(np.int64([[*bbox_from, *bbox_to] for bbox_from, bbox_to in tile_annotations]).reshape(-1, 4))
+                        continue
 
                     max_augmented_versions = 8
                     all_augmented_versions = list(range(max_augmented_versions))
@@ -488,6 +2523,25 @@ class DetectObjectsDlg(QtWidgets.QDialog):
                             augmented_versions.extend(all_augmented_versions)
                             augmented_versions_to_add -= max_augmented_versions
 
+                    if self.train_streaming_dataset:
+                        tile_boxes = np.int64([[*bbox_from, *bbox_to] for bbox_from, bbox_to in tile_annotations]).reshape(-1, 4)
+                        if len(tile_boxes) > 0 or self.tiles_without_annotations_supported:
+                            train_tiles.append(np.array(tile))  # copy, because it can be a view of memory-mapped mosaic
+                            train_tiles_boxes.append(tile_boxes)
+                        for version_i in augmented_versions:
+                            tile_name = "{}-{}-{}-{}.jpg".format((zone_i + 1), x_tile, y_tile, version_i)
+                            nannotated_tiles += 1
+                            _, tile_boxes_version = geometric_tile_version(tile, tile_boxes, version_i)
+                            for xmin, ymin, xmax, ymax in tile_boxes_version:
+                                all_annotations.append({'image_path': tile_name, 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'label': 'Tree'})
+                            if len(tile_boxes) == 0:
+                                if self.tiles_without_annotations_supported:
+                                    all_annotations.append({'image_path': tile_name, 'xmin': '0', 'ymin': '0', 'xmax': '0', 'ymax': '0', 'label': 'Tree'})
+                                nempty_tiles += 1
+                            if len(tile_boxes) > 0 or self.tiles_without_annotations_supported:
+                                train_items.append((len(train_tiles) - 1, version_i, tile_name))
+                        continue
+
                     for version_i in augmented_versions:
                         tile_version = tile
                         tile_annotations_version = tile_annotations
@@ -507,82 +2561,258 @@ class DetectObjectsDlg(QtWidgets.QDialog):
 
                         nannotated_tiles += 1
                         for (xmin, ymin), (xmax, ymax) in tile_annotations_version:
-                            all_annotations = pandas_append(all_annotations, {'image_path': tile_name, 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'label': 'Tree'}, ignore_index=True)
+                            all_annotations.append({'image_path': tile_name, 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'label': 'Tree'})
                         if len(tile_annotations_version) == 0:
-                            if self.tiles_without_annotations_supported:
-                                all_annotations = pandas_append(all_annotations, {'image_path': tile_name, 'xmin': '0', 'ymin': '0', 'xmax': '0', 'ymax': '0', 'label': 'Tree'}, ignore_index=True)
-                            nempty_tiles += 1
-
-                        cv2.imwrite(self.dir_train_subtiles + tile_name, tile_version)
-                        if self.debug_tiles:
-                            tile_with_trees = self.debug_draw_trees(tile_version, tile_annotations_version)
-                            cv2.imwrite(self.dir_train_subtiles_debug + tile_name, tile_with_trees)
-
-            if out_of_orthomosaic_train_tile == nx_tiles * ny_tiles:
-                raise RuntimeError("It seems that zone #{} has no orthomosaic data, please check zones, orthomosaic and its Outer Boundary.".format(zone_i + 1))
-            else:
-                if out_of_orthomosaic_train_tile > 0:
-                    print("{}/{} of tiles in zone #{} has no orthomosaic data".format(out_of_orthomosaic_train_tile, nx_tiles * ny_tiles, zone_i + 1))
-
-        print("{} tiles ({} empty{}) for training prepared with {} annotations"
-              .format(nannotated_tiles, nempty_tiles, " - they are not supported" if (nempty_tiles > 0 and not self.tiles_without_annotations_supported) else "", len(all_annotations)))
-        print("Training with {} epochs and x{} augmentations (augment colors: {})...".format(self.max_epochs, self.data_augmentation_multiplier, self.augment_colors))
-        self.freeze_layers()
-
-        annotations_file = self.dir_train_subtiles + "annotations.csv"
-        all_annotations.to_csv(annotations_file, header=True, index=False)
-
-        class MyCallback(Callback):
-            def __init__(self, thiz_dlg):
-                self.nepochs_done = 0
-                self.nepochs = thiz_dlg.max_epochs
-                self.pbar = thiz_dlg.trainPBar
-                self.thiz_dlg = thiz_dlg
-            def on_train_epoch_end(self, trainer, pl_module):
-                self.nepochs_done += 1
-                self.pbar.setValue(self.nepochs_done * 100 / self.nepochs)
-                Metashape.app.update()
-                app.processEvents()
-                self.thiz_dlg.check_stopped()
+                            if self.tiles_without_annotations_supported:
+                                all_annotations.append({'image_path': tile_name, 'xmin': '0', 'ymin': '0', 'xmax': '0', 'ymax': '0', 'label': 'Tree'})
+                            nempty_tiles += 1
 
-        if torch.cuda.device_count() > 0:
-            print("Using GPU...")
-            accelerator = "gpu"
-            devices = 1
-        else:
-            print("Using CPU (will be very slow)...")
-            accelerator = "cpu"
-            devices = 1
-            torch.set_num_threads(multiprocessing.cpu_count())
+                        cv2.imwrite(train_subtiles_dir + tile_name, tile_version)
+                        if self.debug_tiles:
+                            tile_with_trees = self.debug_draw_trees(tile_version, tile_annotations_version)
+                            cv2.imwrite(self.dir_train_subtiles_debug + tile_name, tile_with_trees)
 
-        # DeepForest checks that config.train.csv_file is set at fit start.
-        self.m.config.train.csv_file = annotations_file
-        self.m.config.train.root_dir = os.path.dirname(annotations_file)
-        self.m.config.train.epochs = self.max_epochs
+            if out_of_orthomosaic_train_tile == nx_tiles * ny_tiles - ngap_tiles:
+                raise RuntimeError("It seems that zone #{} has no orthomosaic data, please check zones, orthomosaic and its Outer Boundary.".format(zone_i + 1))
+            else:
+                if out_of_orthomosaic_train_tile > 0:
+                    print("{}/{} of tiles in zone #{} has no orthomosaic data".format(out_of_orthomosaic_train_tile, nx_tiles * ny_tiles, zone_i + 1))
 
-        # Disable DF internal augmentations (we already generate augmented tiles ourselves).
+        print("{} tiles ({} empty{}) for training prepared with {} annotations"
+              .format(nannotated_tiles, nempty_tiles, " - they are not supported" if (nempty_tiles > 0 and not self.tiles_without_annotations_supported) else "", len(all_annotations)))
+        print("{} tiles held out for validation".format(len(validation_tiles)))
+        if self.train_validation_fraction > 0 and len(validation_tiles) == 0:
+            print("Warning, there are no validation tiles (train zones are too small or not annotated) - early stopping is disabled")
+
+        all_annotations = pd.DataFrame(all_annotations, columns=['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label'])
+        all_annotations.to_csv(train_subtiles_dir + "annotations.csv", header=True, index=False)
+
+        return {"validation_tiles": validation_tiles, "validation_tiles_boxes": validation_tiles_boxes,
+                "train_tiles": train_tiles, "train_tiles_boxes": train_tiles_boxes, "train_items": train_items,
+                "nannotations_in_zones": self.train_nannotations_in_zones, "random_state": random.getstate()}
+
+    def train_zone_layout(self, zone_size):
+        # Returns grid of train tiles in zone (nx_tiles, ny_tiles, xy_step) and validation strip along the shorter side of zone
+        # (validation_axis, index of the first validation row along it and mask of gap rows). Validation strip overlaps as few train tiles
+        # as possible, and train tiles overlapping it are not used at all - otherwise annotations in the overlap would be validated after training on them.
+        # At least one row is held out if some train row remains not overlapped by it (first_validation_row = number of rows if nothing is held out)
+        import numpy as np
+
+        border = self.patch_inner_border
+        inner_path_size = self.patch_size - 2 * border
+
+        assert np.all(zone_size >= self.patch_size)
+        nx_tiles, ny_tiles = np.int32((zone_size - 2 * border + inner_path_size - 1) // inner_path_size)
+        assert nx_tiles >= 1 and ny_tiles >= 1
+        xy_step = np.int32(np.round((zone_size + [nx_tiles, ny_tiles] - 1) // [nx_tiles, ny_tiles]))
+
+        validation_axis = 0 if nx_tiles >= ny_tiles else 1
+        nrows = max(nx_tiles, ny_tiles)
+        rows_from = np.minimum(self.patch_size + xy_step[validation_axis] * np.arange(nrows), zone_size[validation_axis]) - self.patch_size
+        nvalidation_rows = 0
+        if self.train_validation_fraction > 0:
+            for nrows_to_hold_out in range(min(max(1, int(round(nrows * self.train_validation_fraction))), nrows - 1), 0, -1):
+                if np.any(rows_from[:nrows - nrows_to_hold_out] + self.patch_size <= rows_from[nrows - nrows_to_hold_out]):
+                    nvalidation_rows = nrows_to_hold_out
+                    break
+        first_validation_row = nrows - nvalidation_rows
+        is_gap_row = np.zeros(nrows, bool)
+        if nvalidation_rows > 0:
+            is_gap_row = (np.arange(nrows) < first_validation_row) & (rows_from + self.patch_size > rows_from[first_validation_row])
+        return nx_tiles, ny_tiles, xy_step, validation_axis, first_validation_row, is_gap_row
+
+    def train_data_cache_entry(self, zones_vertices, zones_offsets, annotations_vertices, annotations_offsets):
+        # Dir of prepared train data in cache (None if cache can't be used). Prepared data depends on train zones and annotations,
+        # orthomosaic and parameters of tiles preparation and augmentation (but not on training parameters like max_epochs)
+        import hashlib
+
+        if not self.train_data_cache or self.debug_tiles:
+            return None
+        stamp = self.orthomosaic_modification_stamp()
+        if stamp is None:
+            return None
+        geometry = hashlib.sha1()
+        for array in [zones_vertices, zones_offsets, annotations_vertices, annotations_offsets]:
+            geometry.update(repr(array.shape).encode())
+            geometry.update(array.tobytes())
+        # version of train data preparation - to not reuse train data prepared by previous versions of this script
+        version = 2
+        key = [version, self.chunk.key, self.chunk.orthomosaic.key, stamp, self.orthomosaic_storage, self.tiles_format, geometry.hexdigest(),
+               self.orthomosaic_resolution, self.patch_size, self.patch_inner_border, self.data_augmentation_multiplier, self.augment_colors, self.train_validation_fraction, self.train_streaming_dataset, self.tiles_without_annotations_supported]
+        return self.cache_dir + "/train_data/" + hashlib.sha1(repr(key).encode()).hexdigest() + "/"
+
+    def add_to_train_data_cache(self, train_subtiles_dir, cache_entry, prepared):
+        import pickle
+
+        with open(train_subtiles_dir + "prepared.pkl", "wb") as file:
+            pickle.dump(prepared, file, protocol=pickle.HIGHEST_PROTOCOL)
         try:
-            self.m.config.train.augmentations = None
-        except Exception:
-            pass
+            os.rename(train_subtiles_dir, cache_entry)
+        except OSError:
+            # the same train data was prepared by concurrent run
+            if not os.path.exists(cache_entry + "prepared.pkl"):
+                raise
+            shutil.rmtree(train_subtiles_dir, ignore_errors=True)
+        self.evict_train_data_cache(cache_entry)
+
+    def evict_train_data_cache(self, used_entry):
+        # Only the most recently used train data are kept (last usage time of entry is modification time of its prepared.pkl)
+        os.utime(used_entry + "prepared.pkl")
+        cache_root = self.cache_dir + "/train_data/"
+        entries = []
+        for entry in os.scandir(cache_root):
+            marker_path = entry.path + "/prepared.pkl"
+            if ".tmp_" in entry.name:
+                if time.time() - entry.stat().st_mtime > 24 * 60 * 60:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif os.path.exists(marker_path):
+                entries.append((os.path.getmtime(marker_path), entry.path + "/"))
+        for mtime, path in sorted(entries, reverse=True)[self.train_data_cache_entries:]:
+            if os.path.normpath(path) != os.path.normpath(used_entry):
+                print("Removing prepared train data from cache: {}".format(path))
+                shutil.rmtree(path, ignore_errors=True)
+
+    def train_on_cached_features(self, annotations_file, device, validate_epoch):
+        # Frozen prefix of the backbone (f.e. conv1 ... layer2) is evaluated only once per train tile (augmented tiles are the same in all epochs),
+        # its output is cached in memory-mapped file, and each epoch runs only the trainable layers, FPN and heads of RetinaNet
+        import cv2
+        import random
+        import collections
+        import numpy as np
+        import pandas as pd
+        import torch
+        from torchvision.models.detection.image_list import ImageList
 
-        trainer = Trainer(
-            max_epochs=self.max_epochs,
-            accelerator=accelerator,
-            devices=devices,
-            logger=False,
-            enable_checkpointing=False,
-            callbacks=[MyCallback(self)],
-        )
-        self.m.trainer = trainer
-        trainer.fit(self.m)
+        app = QtWidgets.QApplication.instance()
 
-        self.results_time_training = time.time() - training_start
+        model = self.m.model.to(device)
+        body = model.backbone.body
+        frozen_layers = frozen_backbone_prefix(body)
+        layers_names = list(body.keys())
+        assert len(frozen_layers) > 0
+        label_id = getattr(self.m, "label_dict", {"Tree": 0}).get("Tree", 0)
+
+        annotations = pd.read_csv(annotations_file)
+        images_names = list(dict.fromkeys(annotations.image_path))
+        images_boxes = {}
+        for image_name, image_annotations in annotations.groupby("image_path"):
+            boxes = image_annotations[['xmin', 'ymin', 'xmax', 'ymax']].to_numpy(np.float32)
+            images_boxes[image_name] = boxes[np.any(boxes != 0, axis=1)]  # all zeros - empty tile marker
+
+        print("Caching frozen features of {} train tiles...".format(len(images_names)))
+        features_cache = None
+        targets = []
+        image_sizes = []
+        padded_size = None
+        model.eval()
+        with torch.no_grad():
+            for i, image_name in enumerate(images_names):
+                image = cv2.cvtColor(cv2.imread(os.path.join(os.path.dirname(annotations_file), image_name)), cv2.COLOR_BGR2RGB)
+                image = torch.from_numpy(image).to(device).permute(2, 0, 1).float() / 255.0
+                target = {"boxes": torch.from_numpy(images_boxes[image_name]).to(device), "labels": torch.full((len(images_boxes[image_name]),), label_id, dtype=torch.int64, device=device)}
+                images, [target] = model.transform([image], [target])
+                x = images.tensors
+                for layer_name in frozen_layers:
+                    x = body[layer_name](x)
+                if features_cache is None:
+                    features_cache_path = self.dir_train_data + "frozen_features.raw"
+                    print("Frozen features cache: {:.1f} GB in {}".format(len(images_names) * x[0].numel() * 2 / 1024**3, features_cache_path))
+                    features_cache = np.memmap(features_cache_path, np.float16, "w+", shape=(len(images_names),) + tuple(x.shape[1:]))
+                    padded_size = tuple(images.tensors.shape[-2:])
+                assert tuple(images.tensors.shape[-2:]) == padded_size
+                features_cache[i] = x[0].cpu().numpy()
+                targets.append({key: value.cpu() for key, value in target.items()})
+                image_sizes.append(images.image_sizes[0])
+                if i % 10 == 0:
+                    Metashape.app.update()
+                    app.processEvents()
+                    self.check_stopped()
 
-        if len(self.save_model_path) > 0:
-            # Save Lightning checkpoint (recommended for re-loading with load_from_checkpoint).
-            self.m.save_model(self.save_model_path)
-            print("Model trained on {} annotations with {} m/pix resolution saved to '{}'".format(self.train_nannotations_in_zones, self.orthomosaic_resolution, self.save_model_path))
+        # LR scheduler (if configured) is stepped with the same interval and frequency as Trainer does
+        optimizer, scheduler_config = parse_optimizers_config(self.m.configure_optimizers())
+        nsteps_done = 0
+
+        batch_size = self.m.config.batch_size
+        for epoch in range(self.max_epochs):
+            model.train()
+            order = list(range(len(images_names)))
+            random.shuffle(order)
+            epoch_loss = 0.0
+            for batch_from in range(0, len(order), batch_size):
+                batch = sorted(order[batch_from:batch_from + batch_size])
+
+                x = torch.from_numpy(np.float32(features_cache[batch])).to(device)
+                features = collections.OrderedDict()
+                for layer_name in layers_names[len(frozen_layers) - 1:]:
+                    if layer_name != frozen_layers[-1]:
+                        x = body[layer_name](x)
+                    if layer_name in body.return_layers:
+                        features[body.return_layers[layer_name]] = x
+                features = list(model.backbone.fpn(features).values())
+
+                # anchors depend only on images sizes, so images tensor is just a zero-strided placeholder
+                images = ImageList(torch.zeros(1, device=device).expand(len(batch), 3, *padded_size), [image_sizes[i] for i in batch])
+                batch_targets = [{key: value.to(device) for key, value in targets[i].items()} for i in batch]
+                head_outputs = model.head(features)
+                anchors = model.anchor_generator(images, features)
+                losses = model.compute_loss(batch_targets, head_outputs, anchors)
+                loss = sum(losses.values())
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                epoch_loss += loss.item() * len(batch)
+                nsteps_done += 1
+                if scheduler_config is not None and scheduler_config["interval"] == "step" and nsteps_done % scheduler_config["frequency"] == 0:
+                    step_lr_scheduler(scheduler_config, {"train_loss": loss.item(), "val_loss": self.train_validation_loss})
+
+                Metashape.app.update()
+                app.processEvents()
+                self.check_stopped()
+
+            print("Epoch {}/{}: loss {:.4f}".format(epoch + 1, self.max_epochs, epoch_loss / len(order)))
+            self.trainPBar.setValue((epoch + 1) * 100 / self.max_epochs)
+            should_stop = validate_epoch(epoch + 1)
+            if scheduler_config is not None and scheduler_config["interval"] == "epoch" and (epoch + 1) % scheduler_config["frequency"] == 0:
+                step_lr_scheduler(scheduler_config, {"train_loss": epoch_loss / len(order), "val_loss": self.train_validation_loss})
+            if should_stop:
+                print("Early stopping after epoch {}".format(epoch + 1))
+                break
+
+        del features_cache
+        os.remove(features_cache_path)
+        model.eval()
+        model.to("cpu")  # like Lightning does after training
+
+    def validation_loss(self, validation_tiles, validation_tiles_boxes):
+        # Mean loss of neural network on validation tiles. RetinaNet returns losses only in training mode,
+        # so batch normalization layers are switched to evaluation mode to keep their statistics untouched
+        import numpy as np
+        import torch
+
+        model = self.m.model
+        device = next(model.parameters()).device
+        label_id = getattr(self.m, "label_dict", {"Tree": 0}).get("Tree", 0)
+        batch_size = self.m.config.batch_size
+
+        was_training = model.training
+        model.train()
+        for module in model.modules():
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+                module.eval()
+
+        total_loss = 0.0
+        with torch.no_grad():
+            for batch_from in range(0, len(validation_tiles), batch_size):
+                images, targets = [], []
+                for tile, boxes in zip(validation_tiles[batch_from:batch_from + batch_size], validation_tiles_boxes[batch_from:batch_from + batch_size]):
+                    images.append(torch.from_numpy(np.ascontiguousarray(tile[:, :, ::-1])).to(device).permute(2, 0, 1).float() / 255.0)
+                    targets.append({"boxes": torch.from_numpy(np.float32(boxes)).to(device), "labels": torch.full((len(boxes),), label_id, dtype=torch.int64, device=device)})
+                losses = model(images, targets)
+                total_loss += sum(losses.values()).item() * len(images)
+
+        model.train(was_training)
+        return total_loss / len(validation_tiles)
 
     def create_empty_tile(self):
         import numpy as np
@@ -647,53 +2877,12 @@ class DetectObjectsDlg(QtWidgets.QDialog):
 
     def random_augmentation(self, img):
         import cv2
-        import albumentations as A
-
-        stages = []
-        if self.augment_colors:
-            stages.append(A.HueSaturationValue(hue_shift_limit=360, sat_shift_limit=30, val_shift_limit=20, always_apply=True))
-        stages.append(A.ISONoise(p=0.5))
-        if self.augment_colors:
-            stages.append(A.RandomBrightnessContrast(brightness_limit=0.4, contrast_limit=0, p=0.5))
-
-        transform = A.Compose(stages)
 
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = transform(image=img)["image"]
+        img = self.colors_augmentation(image=img)["image"]
         img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
         return img
 
-    def read_part(self, res_from, res_to):
-        import cv2
-        import numpy as np
-
-        res_size = res_to - res_from
-        assert np.all(res_size >= [self.patch_size, self.patch_size])
-        res = np.zeros((res_size[1], res_size[0], 3), np.uint8)
-        res[:, :, :] = 255
-
-        tile_xy_from = np.int32(res_from // self.patch_size)
-        tile_xy_upto = np.int32((res_to - 1) // self.patch_size)
-        assert np.all(tile_xy_from <= tile_xy_upto)
-        for tile_x in range(tile_xy_from[0], tile_xy_upto[0] + 1):
-            for tile_y in range(tile_xy_from[1], tile_xy_upto[1] + 1):
-                if (tile_x, tile_y) not in self.tiles_paths:
-                    continue
-                part = cv2.imread(self.tiles_paths[tile_x, tile_y])
-                part = cv2.copyMakeBorder(part, 0, self.patch_size - part.shape[0], 0, self.patch_size - part.shape[1], cv2.BORDER_CONSTANT, value=[255, 255, 255])
-                part_from = np.int32([tile_x, tile_y]) * self.patch_size - res_from
-                part_to = part_from + self.patch_size
-
-                res_inner_from = np.int32([max(0, part_from[0]), max(0, part_from[1])])
-                res_inner_to = np.int32([min(part_to[0], res_size[0]), min(part_to[1], res_size[1])])
-
-                part_inner_from = res_inner_from - part_from
-                part_inner_to = part_inner_from + res_inner_to - res_inner_from
-
-                res[res_inner_from[1]:res_inner_to[1], res_inner_from[0]:res_inner_to[0], :] = part[part_inner_from[1]:part_inner_to[1], part_inner_from[0]:part_inner_to[0], :]
-
-        return res
-
     def intersect(self, a_from, a_to, b_from, b_to):
         import numpy as np
         c_from = np.maximum(a_from, b_from)
@@ -707,11 +2896,20 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         a_size = a_to - a_from
         return a_size[0] * a_size[1]
 
-    def add_pixel_shift(self, to_world, dx, dy):
-        to_world = to_world.copy()
-        to_world[0, 2] = to_world[0, :] @ [dx, dy, 1]
-        to_world[1, 2] = to_world[1, :] @ [dx, dy, 1]
-        return to_world
+    def get_markers_positions(self):
+        # computed once per run and reused by all attached shapes
+        if self.markers_positions is None:
+            self.markers_positions = markers_world_positions(self.chunk)
+        return self.markers_positions
+
+    def shapes_vertices_in_orthomosaic_crs(self, shapes):
+        # Returns Nx2 vertices of all shapes (in orthomosaic coordinate system) and offsets of each shape vertices in them
+        import numpy as np
+
+        any_to_world = next(iter(self.tiles_to_world.values()))
+        orthomosaic_pixel_size = np.min(np.linalg.norm(any_to_world[:, :2], axis=0))
+        markers_positions = self.get_markers_positions() if any(shape.is_attached for shape in shapes) else None
+        return shapes_vertices_in_crs(self.chunk, shapes, self.chunk.orthomosaic.crs, 0.01 * orthomosaic_pixel_size, markers_positions)
 
     def invert_matrix_2x3(self, to_world):
         import numpy as np
@@ -727,8 +2925,9 @@ class DetectObjectsDlg(QtWidgets.QDialog):
 
     def detect(self):
         import cv2
+        import collections
         import numpy as np
-        import pandas as pd
+        import concurrent.futures
 
         app = QtWidgets.QApplication.instance()
 
@@ -744,280 +2943,620 @@ class DetectObjectsDlg(QtWidgets.QDialog):
             detected_label += ", trained on {} shapes in {} zones".format(self.train_nannotations_in_zones, len(self.train_zones))
         detected_label += ")"
 
-        detected_shapes_layer = self.chunk.shapes.addGroup()
-        detected_shapes_layer.label = detected_label
-
         ntrees_detected = 0
+        self.orthomosaic_to_shapes = CrsTransformer(self.chunk.orthomosaic.crs, self.chunk.shapes.crs)
 
-        big_tiles_k = 8
-        border = self.patch_inner_border
-        area_overlap_threshold = 0.60
+        self.big_tiles_k, queue_depth = self.choose_big_tiles_layout()
 
         big_tiles = set()
         for tile_x in range(self.tile_min_x, self.tile_max_x + 1):
             for tile_y in range(self.tile_min_y, self.tile_max_y + 1):
                 if (tile_x, tile_y) not in self.tiles_paths:
                     continue
-                big_tile_x, big_tile_y = tile_x // big_tiles_k, tile_y // big_tiles_k
+                big_tile_x, big_tile_y = tile_x // self.big_tiles_k, tile_y // self.big_tiles_k
                 big_tiles.add((big_tile_x, big_tile_y))
+        big_tiles = sorted(big_tiles)
+
+        # serpentine order of columns - so that tiles of the halo shared with the previous big tile are still in decoded tiles cache
+        big_tiles_processing_order = sorted(big_tiles, key=lambda xy: (xy[0], xy[1] if xy[0] % 2 == 0 else -xy[1]))
 
         bigtiles_trees = {}
         bigtiles_to_world = {}
         bigtiles_idx_on_borders = {}
 
-        for big_tile_index, (big_tile_x, big_tile_y) in enumerate(sorted(big_tiles)):
-            big_tile = np.zeros((border + big_tiles_k*self.patch_size + border, border + big_tiles_k*self.patch_size + border, 3), np.uint8)
-            big_tile[:, :, :] = 255
-            big_tile_to_world = None
+        self.dir_detection_checkpoint = None
+        if self.big_tiles_results_saved():
+            self.dir_detection_checkpoint = self.detection_checkpoint_dir()
+            pathlib.Path(self.dir_detection_checkpoint).mkdir(parents=True, exist_ok=True)
+            for big_tile_x, big_tile_y in big_tiles:
+                checkpoint_path = self.big_tile_checkpoint_path(big_tile_x, big_tile_y)
+                if not os.path.exists(checkpoint_path):
+                    continue
+                big_tile_trees, idx_on_borders, big_tile_to_world, inputs_digest = load_big_tile_checkpoint(checkpoint_path)
+                if inputs_digest != self.big_tile_inputs_digest(big_tile_x, big_tile_y):
+                    continue  # some tiles of this big tile (or of its halo) were changed
+                bigtiles_trees[big_tile_x, big_tile_y] = big_tile_trees
+                bigtiles_idx_on_borders[big_tile_x, big_tile_y] = idx_on_borders
+                bigtiles_to_world[big_tile_x, big_tile_y] = big_tile_to_world
+            if len(bigtiles_trees) > 0:
+                print("Reusing results of {}/{} big tiles from {}".format(len(bigtiles_trees), len(big_tiles), self.dir_detection_checkpoint))
+            big_tiles_processing_order = [big_tile_xy for big_tile_xy in big_tiles_processing_order if big_tile_xy not in bigtiles_trees]
+
+        self.exported_model_path = None
+        if len(big_tiles_processing_order) > 0:
+            self.prepare_exported_model(big_tiles_processing_order)
+
+        if self.detection_shards_count() > 1 and len(big_tiles_processing_order) > 0:
+            self.detect_in_shards(big_tiles_processing_order)
+            for big_tile_x, big_tile_y in big_tiles_processing_order:
+                big_tile_trees, idx_on_borders, big_tile_to_world, inputs_digest = load_big_tile_checkpoint(self.big_tile_checkpoint_path(big_tile_x, big_tile_y))
+                assert inputs_digest == self.big_tile_inputs_digest(big_tile_x, big_tile_y)
+                bigtiles_trees[big_tile_x, big_tile_y] = big_tile_trees
+                bigtiles_idx_on_borders[big_tile_x, big_tile_y] = idx_on_borders
+                bigtiles_to_world[big_tile_x, big_tile_y] = big_tile_to_world
+            big_tiles_processing_order = []
+
+        # In incremental mode the detection layer of the previous run is updated (if it still exists):
+        # shapes of each big tile are marked with "big_tile" attribute, and state file remembers from which inputs they were obtained
+        export_only = self.detection_export_only and len(self.detection_export_path) > 0
+        detected_shapes_layer = None
+        layer_big_tiles_digests = {}
+        layer_shapes_index = None
+        if self.incremental_detection and not export_only:
+            detected_shapes_layer, layer_big_tiles_digests, layer_shapes_index = self.load_incremental_state()
+        if detected_shapes_layer is None and not export_only:
+            detected_shapes_layer = self.chunk.shapes.addGroup()
+            detected_shapes_layer.label = detected_label
+            layer_big_tiles_digests = {}
+            layer_shapes_index = None
+        elif detected_shapes_layer is not None:
+            print("Updating detection layer '{}'...".format(detected_shapes_layer.label))
+
+        # big tiles with changed results - and their neighbors, because suppression on big tiles borders depends on them too
+        big_tiles_changed = {big_tile_xy for big_tile_xy in big_tiles if layer_big_tiles_digests.get("{}-{}".format(*big_tile_xy)) != self.big_tile_inputs_digest(*big_tile_xy)}
+        big_tiles_changed |= {tuple(map(int, key.split("-"))) for key in layer_big_tiles_digests.keys()} - set(big_tiles)
+        big_tiles_to_update = set()
+        for big_tile_x, big_tile_y in big_tiles_changed:
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    big_tiles_to_update.add((big_tile_x + dx, big_tile_y + dy))
+        if len(layer_big_tiles_digests) > 0:
+            print("{}/{} big tiles changed, {} big tiles will be updated in detection layer".format(len(big_tiles_changed), len(big_tiles), len(big_tiles_to_update & set(big_tiles))))
+            # state is saved only after successful detection, so if detection is interrupted - the same big tiles will be updated by the next run
+            layer_shapes_index = self.remove_big_tiles_shapes(detected_shapes_layer, big_tiles_to_update, layer_shapes_index)
+        else:
+            layer_shapes_index = {"indices": [], "keys": [], "big_tiles": []}
+        nshapes_before_detection = len(self.chunk.shapes) if detected_shapes_layer is not None else 0
+
+        # Suppression on borders of big tile is final as soon as results of all its neighbors are known - then its objects are streamed to export file
+        # and to detection layer (in batches), while only objects on its borders are kept (they are still needed for suppression in its neighbors)
+        exporter = None
+        if len(self.detection_export_path) > 0:
+            print("Exporting detected objects to {}".format(self.detection_export_path))
+            exporter = GeoPackageWriter(self.detection_export_path, "detected_objects", self.chunk.orthomosaic.crs, [("score", "REAL"), ("big_tile", "TEXT")], spatial_index=True)
+        big_tiles_set = set(big_tiles)
+        big_tiles_finalized = set()
+        new_polygons = []
+        new_polygons_big_tiles = []
+        new_polygons_scores = []
+
+        def add_new_polygons_to_layer():
+            if len(new_polygons) > 0:
+                self.add_polygons(detected_shapes_layer, np.concatenate(new_polygons), new_polygons_big_tiles, new_polygons_scores)
+            new_polygons.clear()
+            new_polygons_big_tiles.clear()
+            new_polygons_scores.clear()
+
+        def big_tile_neighbors(big_tile_xy):
+            return [(big_tile_xy[0] + dx, big_tile_xy[1] + dy) for dx in [-1, 0, 1] for dy in [-1, 0, 1]]
+
+        def finalize_big_tile(big_tile_x, big_tile_y):
+            nonlocal ntrees_detected
+            big_tile_trees = self.suppress_on_big_tiles_borders(big_tile_x, big_tile_y, bigtiles_trees, bigtiles_idx_on_borders)
+            big_tile_trees = big_tile_trees.to_dataframe()
+
+            if self.debug_tiles and os.path.exists(self.dir_detection_results + "{}-{}_clean.jpg".format(big_tile_x, big_tile_y)):
+                big_tile = cv2.imread(self.dir_detection_results + "{}-{}_clean.jpg".format(big_tile_x, big_tile_y))
+                img_with_trees = self.debug_draw_trees(big_tile, big_tile_trees)
+                cv2.imwrite(self.dir_detection_results + "{}-{}_after_suppression.jpg".format(big_tile_x, big_tile_y), img_with_trees)
 
-            for xi in range(-1, big_tiles_k + 1):
-                for yi in range(-1, big_tiles_k + 1):
-                    tile_x, tile_y = big_tiles_k * big_tile_x + xi, big_tiles_k * big_tile_y + yi
-                    if (tile_x, tile_y) not in self.tiles_paths:
-                        continue
-                    part = cv2.imread(self.tiles_paths[tile_x, tile_y])
-                    part = cv2.copyMakeBorder(part, 0, self.patch_size - part.shape[0], 0, self.patch_size - part.shape[1], cv2.BORDER_CONSTANT, value=[255, 255, 255])
-                    if xi in [-1, big_tiles_k] or yi in [-1, big_tiles_k]:
-                        fromx, fromy = border + xi * self.patch_size, border + yi * self.patch_size
-                        tox, toy = fromx + self.patch_size, fromy + self.patch_size
-                        if xi == -1:
-                            part = part[:, self.patch_size - border:, :]
-                            fromx += self.patch_size - border
-                        if xi == big_tiles_k:
-                            part = part[:, :border, :]
-                            tox = fromx + border
-                        if yi == -1:
-                            part = part[self.patch_size - border:, :, :]
-                            fromy += self.patch_size - border
-                        if yi == big_tiles_k:
-                            part = part[:border, :, :]
-                            toy = fromy + border
-                        big_tile[fromy:toy, fromx:tox, :] = part
-                    else:
-                        big_tile[border + yi * self.patch_size:, border + xi * self.patch_size:, :][:self.patch_size, :self.patch_size, :] = part
-                        big_tile_to_world = self.add_pixel_shift(self.tiles_to_world[tile_x, tile_y], -(border + xi * self.patch_size), -(border + yi * self.patch_size))
+            ntrees_detected += len(big_tile_trees)
+            big_tile_key = "{}-{}".format(big_tile_x, big_tile_y)
+            if exporter is not None:
+                exporter.add_polygons(self.trees_world_polygons(bigtiles_to_world[big_tile_x, big_tile_y], big_tile_trees),
+                                      {"score": big_tile_trees.score, "big_tile": [big_tile_key] * len(big_tile_trees)})
+            if detected_shapes_layer is not None and (big_tile_x, big_tile_y) in big_tiles_to_update:
+                new_polygons.append(self.trees_polygons(bigtiles_to_world[big_tile_x, big_tile_y], big_tile_trees))
+                new_polygons_big_tiles.extend([big_tile_key] * len(big_tile_trees))
+                new_polygons_scores.extend(big_tile_trees.score.tolist())
+                if len(new_polygons_scores) >= self.detection_layer_batch_size:
+                    add_new_polygons_to_layer()
+
+            idx_on_borders = bigtiles_idx_on_borders[big_tile_x, big_tile_y]
+            bigtiles_trees[big_tile_x, big_tile_y] = bigtiles_trees[big_tile_x, big_tile_y].subset(idx_on_borders)
+            bigtiles_idx_on_borders[big_tile_x, big_tile_y] = np.arange(len(idx_on_borders))
+            big_tiles_finalized.add((big_tile_x, big_tile_y))
+
+        def finalize_ready_big_tiles(candidates):
+            for big_tile_xy in candidates:
+                if big_tile_xy not in big_tiles_set or big_tile_xy in big_tiles_finalized or big_tile_xy not in bigtiles_trees:
+                    continue
+                if all(neighbor not in big_tiles_set or neighbor in bigtiles_trees for neighbor in big_tile_neighbors(big_tile_xy)):
+                    finalize_big_tile(*big_tile_xy)
+
+        # Three stages are pipelined: big tiles are assembled from orthomosaic tiles by a thread pool,
+        # the neural network processes them in the main thread, and the post-processing worker merges detections from subtiles.
+        # Each queue is limited by queue_depth big tiles to limit memory usage.
+        assembling = collections.deque()
+        merging = collections.deque()
+        nbig_tiles_submitted = 0
+        nbig_tiles_merged = len(bigtiles_trees)
+        nsubtiles_skipped = 0
+
+        def update_gui():
+            Metashape.app.update()
+            app.processEvents()
+            self.check_stopped()
 
-            assert big_tile_to_world is not None
+        def collect_merged_big_tile():
+            nonlocal nbig_tiles_merged
+            big_tile_x, big_tile_y, big_tile_to_world, big_tile_trees, idx_on_borders = merging.popleft().result()
+            bigtiles_trees[big_tile_x, big_tile_y] = big_tile_trees
+            bigtiles_to_world[big_tile_x, big_tile_y] = big_tile_to_world
+            bigtiles_idx_on_borders[big_tile_x, big_tile_y] = idx_on_borders
+            finalize_ready_big_tiles(big_tile_neighbors((big_tile_x, big_tile_y)))
+            nbig_tiles_merged += 1
+            self.detectionPBar.setValue(nbig_tiles_merged * 100 / len(big_tiles))
 
-            subtiles_trees = {}
-            tile_inner_size = self.patch_size - 2*border
-            inner_tiles_nx = (big_tile.shape[1]-2*border+tile_inner_size-1)//tile_inner_size
-            inner_tiles_ny = (big_tile.shape[0]-2*border+tile_inner_size-1)//tile_inner_size
-            for xi in range(inner_tiles_nx):
-                for yi in range(inner_tiles_ny):
-                    tox, toy = min(big_tile.shape[1], 2*border+(xi + 1) * tile_inner_size), min(big_tile.shape[0], 2*border+(yi + 1) * tile_inner_size)
-                    fromx, fromy = tox - self.patch_size, toy - self.patch_size
-                    subtile = big_tile[fromy:toy, fromx:tox, :]
-
-                    white_pixels_fraction = np.sum(np.all(subtile == 255, axis=-1)) / (subtile.shape[0] * subtile.shape[1])
-
-                    assert(subtile.shape == (self.patch_size, self.patch_size, 3))
-                    # DeepForest predict_image expects RGB float32 array. :contentReference[oaicite:6]{index=6}
-                    subtile_rgb = cv2.cvtColor(subtile, cv2.COLOR_BGR2RGB).astype("float32")
-                    with warnings.catch_warnings():
-                        warnings.simplefilter("ignore", category=UserWarning)
-                        subtile_trees = self.m.predict_image(image=subtile_rgb)
-                    Metashape.app.update()
-                    app.processEvents()
-                    self.check_stopped()
-                    if subtile_trees is not None:
-                        subtile_inner_trees = pd.DataFrame(columns=['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label'])
-                        subtile_inner_trees_debug = pd.DataFrame(columns=['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label'])
-                        for idx, row in subtile_trees.iterrows():
-                            xmin, ymin, xmax, ymax, label, score = int(row.xmin), int(row.ymin), int(row.xmax), int(row.ymax), row.label, row.score
-                            assert (label == "Tree")
-                            if xmin >= self.patch_size - border or xmax <= border or ymin >= self.patch_size - border or ymax <= border:
-                                continue
-                            if self.detection_score_threshold is not None and score < self.detection_score_threshold:
-                                continue
-                            if white_pixels_fraction > 0.10:
-                                subtile_bbox = subtile[ymin:ymax, xmin:xmax, :]
-                                bbox_white_pixels_fraction = np.sum(np.all(subtile_bbox == 255, axis=-1)) / (subtile_bbox.shape[0] * subtile_bbox.shape[1])
-                                if bbox_white_pixels_fraction > 0.70:
-                                    continue
-                            xmin, xmax = map(lambda x: fromx + x, [xmin, xmax])
-                            ymin, ymax = map(lambda y: fromy + y, [ymin, ymax])
-                            subtile_inner_trees_debug = pandas_append(subtile_inner_trees_debug, row, ignore_index=True)
-                            row.xmin, row.ymin, row.xmax, row.ymax = xmin, ymin, xmax, ymax
-                            subtile_inner_trees = pandas_append(subtile_inner_trees, row, ignore_index=True)
+        try:
+            finalize_ready_big_tiles(big_tiles)  # big tiles with saved results
+
+            with concurrent.futures.ThreadPoolExecutor(queue_depth) as assembling_pool, concurrent.futures.ThreadPoolExecutor(1) as merging_pool:
+                try:
+                    for big_tile_x, big_tile_y in big_tiles_processing_order:
+                        while len(assembling) < queue_depth and nbig_tiles_submitted < len(big_tiles_processing_order):
+                            assembling.append(assembling_pool.submit(self.prepare_big_tile, *big_tiles_processing_order[nbig_tiles_submitted]))
+                            nbig_tiles_submitted += 1
+                        big_tile, big_tile_to_world, nodata_integral = assembling.popleft().result()
+
+                        subtiles = self.cut_subtiles(big_tile)
+                        subtiles_predictions, nsubtiles_skipped_in_big_tile = self.predict_big_tile_subtiles(subtiles, nodata_integral, on_batch_processed=update_gui)
+                        nsubtiles_skipped += nsubtiles_skipped_in_big_tile
+
+                        merging.append(merging_pool.submit(self.merge_subtiles, big_tile_x, big_tile_y, big_tile, big_tile_to_world, nodata_integral, subtiles, subtiles_predictions))
+                        while len(merging) > queue_depth or (len(merging) > 0 and merging[0].done()):
+                            collect_merged_big_tile()
+
+                    while len(merging) > 0:
+                        collect_merged_big_tile()
+                        Metashape.app.update()
+                        app.processEvents()
+                        self.check_stopped()
+                except:
+                    for future in list(assembling) + list(merging):
+                        future.cancel()
+                    raise
+            assert big_tiles_finalized == big_tiles_set
+        finally:
+            if exporter is not None:
+                exporter.close()
+
+        if detected_shapes_layer is not None:
+            add_new_polygons_to_layer()
+
+        if self.incremental_detection:
+            if detected_shapes_layer is not None:
+                # detected shapes were appended to the end of shapes, so the index is extended without scanning other shapes
+                shapes = self.chunk.shapes
+                for i in range(nshapes_before_detection, len(shapes)):
+                    layer_shapes_index["indices"].append(i)
+                    layer_shapes_index["keys"].append(shapes[i].key)
+                    layer_shapes_index["big_tiles"].append(shapes[i].attributes["big_tile"])
+                self.save_incremental_state(detected_shapes_layer, {"{}-{}".format(*big_tile_xy): self.big_tile_inputs_digest(*big_tile_xy) for big_tile_xy in big_tiles},
+                                            layer_shapes_index)
+        elif self.dir_detection_checkpoint is not None:
+            # checkpoint is needed only to resume interrupted detection, checkpoints dir and cache dir are removed too if nothing else is kept there
+            shutil.rmtree(self.dir_detection_checkpoint, ignore_errors=True)
+            for parent_dir in [os.path.dirname(self.dir_detection_checkpoint.rstrip("/")), self.cache_dir]:
+                try:
+                    os.rmdir(parent_dir)
+                except OSError:
+                    break
+
+        print("{} subtiles without orthomosaic data were skipped".format(nsubtiles_skipped))
+        self.results_ntrees_detected = ntrees_detected
+        self.results_time_detection = time.time() - time_start
 
-                        if self.debug_tiles:
-                            img_with_trees = self.debug_draw_trees(subtile, subtile_trees)
-                            cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}.jpg".format(big_tile_x, big_tile_y, xi, yi), img_with_trees)
-                            img_with_inner_trees = self.debug_draw_trees(subtile, subtile_inner_trees_debug)
-                            cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}_inner.jpg".format(big_tile_x, big_tile_y, xi, yi), img_with_inner_trees)
-                    else:
-                        subtile_inner_trees = pd.DataFrame(columns=['image_path', 'xmin', 'ymin', 'xmax', 'ymax', 'label'])
-                        if self.debug_tiles:
-                            cv2.imwrite(self.dir_subtiles_results + "{}-{}-{}-{}_empty.jpg".format(big_tile_x, big_tile_y, xi, yi), subtile)
+    def choose_big_tiles_layout(self):
+        # Returns big_tiles_k (size of big tiles in orthomosaic tiles) and detection queue depth, so that all big tiles in flight fit into memory budget.
+        # Big tiles are reduced first, queue depth is reduced only if even the smallest big tiles don't fit
+        max_big_tiles_k = 8
+        big_tiles_k_candidates = [max_big_tiles_k, 4, 2, 1]  # powers of two - so that small changes of available memory don't change big tiles
+
+        # saved results of the previous run (interrupted or incremental) are valid only for the same big tiles,
+        # so their size is kept even if available memory changed since then
+        saved_big_tiles_k = self.saved_big_tiles_k(big_tiles_k_candidates)
+        if saved_big_tiles_k is not None:
+            print("Big tiles of {}x{} tiles are used as in saved results of the previous run".format(saved_big_tiles_k, saved_big_tiles_k))
+            big_tiles_k_candidates = [saved_big_tiles_k]
+            max_big_tiles_k = saved_big_tiles_k
+
+        if self.detection_memory_budget_mb is not None:
+            budget = self.detection_memory_budget_mb * 1024 * 1024
+        else:
+            available = available_memory_bytes()
+            if available is None:
+                return max_big_tiles_k, self.detection_queue_depth
+            budget = available // 2
+
+        # decoded tiles cache limit is shared by all local worker processes (see detect_in_shards), each of them processes its big tiles one by one,
+        # while in Metashape process big tiles are in assembling queue, in neural network and in post-processing queue
+        in_worker_processes = self.detection_shards_count() > 1 and (self.detection_nodes <= 1 or self.detection_nodes_local)
+        nprocesses = self.detection_shards_count() if in_worker_processes else 1
+        budget -= self.tiles_cache_size_mb * 1024 * 1024
+
+        # big tile (3 bytes per pixel), its no-data integral image (4 bytes) and temporary masks during its computation (4 bytes),
+        # with debug_tiles - two more copies of big tile with drawn boxes
+        bytes_per_pixel = 11 + (6 if self.debug_tiles else 0)
+
+        def big_tile_bytes(big_tiles_k):
+            return (big_tiles_k * self.patch_size + 2 * self.patch_inner_border) ** 2 * bytes_per_pixel
+
+        layout = None
+        for queue_depth in range(self.detection_queue_depth, 0, -1):
+            nbig_tiles_in_flight = nprocesses if in_worker_processes else 2 * queue_depth + 2
+            for big_tiles_k in big_tiles_k_candidates:
+                if nbig_tiles_in_flight * big_tile_bytes(big_tiles_k) <= budget:
+                    layout = big_tiles_k, queue_depth
+                    break
+            if layout is not None:
+                break
+        if layout is None:
+            layout = big_tiles_k_candidates[-1], 1
+            print("Warning: big tiles don't fit into memory budget of {} MB (even {}x{} tiles with queue depth 1)".format(max(0, budget) // (1024 * 1024), layout[0], layout[0]))
+
+        big_tiles_k, queue_depth = layout
+        if layout != (max_big_tiles_k, self.detection_queue_depth):
+            print("Big tiles of {}x{} tiles ({} MB each) with queue depth {} are used to fit into memory budget of {} MB"
+                  .format(big_tiles_k, big_tiles_k, big_tile_bytes(big_tiles_k) // (1024 * 1024), queue_depth, max(0, budget) // (1024 * 1024)))
+        return layout
+
+    def saved_big_tiles_k(self, big_tiles_k_candidates):
+        # Size of big tiles of detection checkpoint or incremental detection state saved by previous run (None if there is no such results)
+        if not self.big_tiles_results_saved():
+            return None
+        for big_tiles_k in big_tiles_k_candidates:
+            self.big_tiles_k = big_tiles_k
+            if os.path.isdir(self.detection_checkpoint_dir()):
+                return big_tiles_k
+        return None
+
+    def prepare_exported_model(self, big_tiles):
+        # Exported neural network is cached next to the loaded checkpoint (or in cache dir if it is not available)
+        # and is used only if its results on sample subtiles are close to results of eager neural network
+        import cv2
+        import hashlib
+        import torch
 
-                    subtiles_trees[xi, yi] = subtile_inner_trees
+        self.exported_model = None
+        if self.cpu_inference_backend == "eager" or self.m is None or torch.cuda.is_available():
+            return
+        assert self.cpu_inference_backend in ["torchscript", "int8"]
 
-            big_tile_trees = None
-            for xi, yi in sorted(subtiles_trees.keys()):
-                tox, toy = min(big_tile.shape[1], 2*border+(xi + 1) * tile_inner_size), min(big_tile.shape[0], 2*border+(yi + 1) * tile_inner_size)
-                fromx, fromy = tox - self.patch_size, toy - self.patch_size
+        key = [self.neural_network_digest(), self.cpu_inference_backend, self.detection_batch_size, self.patch_size, torch.__version__]
+        key = hashlib.sha1(repr(key).encode()).hexdigest()
+        if len(self.load_model_path) > 0 and not self.train_on_user_data_enabled and os.access(os.path.dirname(os.path.abspath(self.load_model_path)), os.W_OK):
+            path = "{}.{}-{}.pt".format(self.load_model_path, self.cpu_inference_backend, key[:16])
+        else:
+            pathlib.Path(self.cache_dir + "/exported_models").mkdir(parents=True, exist_ok=True)
+            path = self.cache_dir + "/exported_models/{}-{}.pt".format(self.cpu_inference_backend, key)
+        if os.path.exists(path + ".rejected"):
+            print("Eager neural network is used - results of '{}' backend were too different earlier (see {})".format(self.cpu_inference_backend, path + ".rejected"))
+            return
 
-                a = subtiles_trees[xi, yi]
+        # subtiles with orthomosaic data from the first big tiles are used for int8 calibration and for comparison with eager results
+        nsamples = 4 * self.detection_batch_size
+        samples = []
+        for big_tile_x, big_tile_y in big_tiles:
+            big_tile, _, nodata_integral = self.prepare_big_tile(big_tile_x, big_tile_y)
+            for xi, yi, fromx, fromy, subtile in self.cut_subtiles(big_tile):
+                if nodata_fraction(nodata_integral, fromx, fromy, fromx + self.patch_size, fromy + self.patch_size) < 0.5:
+                    samples.append(cv2.cvtColor(subtile, cv2.COLOR_BGR2RGB).astype("float32"))
+            if len(samples) >= nsamples:
+                break
+        samples = samples[:nsamples]
+        if len(samples) == 0:
+            return
 
-                a_idx_on_border = []
-                for idx, rowA in a.iterrows():
-                    axmin, aymin, axmax, aymax, ascore = int(rowA.xmin), int(rowA.ymin), int(rowA.xmax), int(rowA.ymax), rowA.score
-                    if axmin > fromx + border and axmax < tox - border and aymin > fromy + border and aymax < toy - border:
-                        continue
-                    a_idx_on_border.append(idx)
-
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx == 0 and dy == 0:
-                            continue
-                        nx, ny = xi + dx, yi + dy
-                        if (nx, ny) not in subtiles_trees:
-                            continue
-                        b = subtiles_trees[nx, ny]
-
-                        indices_to_check = a_idx_on_border
-
-                        # because the last two columns/rows have much bigger overlap
-                        if    (xi == inner_tiles_nx - 2 and dx == 1) or (xi == inner_tiles_nx - 1 and dx == -1)\
-                           or (yi == inner_tiles_ny - 2 and dy == 1) or (yi == inner_tiles_ny - 1 and dy == -1):
-                            indices_to_check = a.index
-
-                        for idx in indices_to_check:
-                            rowA = a.loc[idx]
-                            if rowA.label == "Suppressed":
-                                continue
-                            axmin, aymin, axmax, aymax, ascore = int(rowA.xmin), int(rowA.ymin), int(rowA.xmax), int(rowA.ymax), rowA.score
-                            areaA = (axmax - axmin) * (aymax - aymin)
-                            for _, rowB in b.iterrows():
-                                bxmin, bymin, bxmax, bymax, bscore = int(rowB.xmin), int(rowB.ymin), int(rowB.xmax), int(rowB.ymax), rowB.score
-                                areaB = (bxmax - bxmin) * (bymax - bymin)
-
-                                intersectionx = max(0, min(axmax, bxmax) - max(axmin, bxmin))
-                                intersectiony = max(0, min(aymax, bymax) - max(aymin, bymin))
-                                intersectionArea = intersectionx * intersectiony
-                                if intersectionArea > min(areaA, areaB) * area_overlap_threshold:
-                                    if ascore + 0.2 < bscore:
-                                        a.loc[idx, 'label'] = "Suppressed"
-                                    elif not (bscore + 0.2 < ascore):
-                                        if areaA < areaB:
-                                            a.loc[idx, 'label'] = "Suppressed"
-                                        elif not (areaB < areaA) and (xi, yi) < (nx, ny):
-                                            assert not ((nx, ny) < (xi, yi))
-                                            a.loc[idx, 'label'] = "Suppressed"
-
-                if big_tile_trees is None:
-                    big_tile_trees = pd.DataFrame(columns=a.columns)
-                for idx, row in a.iterrows():
-                    if row.label == "Suppressed":
-                        continue
-                    big_tile_trees = pandas_append(big_tile_trees, row, ignore_index=True)
+        try:
+            if not os.path.exists(path):
+                print("Exporting neural network for CPU ({} backend)...".format(self.cpu_inference_backend))
+                export_retinanet_dense(self.m, path, samples, self.detection_batch_size, quantize=(self.cpu_inference_backend == "int8"))
+            exported_model = ExportedRetinaNet(self.m, path)
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=UserWarning)
+                time_start = time.time()
+                eager_predictions = []
+                for batch_from in range(0, len(samples), self.detection_batch_size):
+                    eager_predictions += predict_images_batch(self.m, samples[batch_from:batch_from + self.detection_batch_size])
+                time_eager = time.time() - time_start
+                exported_predictions = exported_model.predict(samples)
+                time_exported = time.time() - time_start - time_eager
+        except Exception as e:
+            print("Eager neural network is used - '{}' backend failed: {}".format(self.cpu_inference_backend, e))
+            return
 
-            idx_on_borders = []
-            for idx, rowA in big_tile_trees.iterrows():
-                axmin, aymin, axmax, aymax, ascore = int(rowA.xmin), int(rowA.ymin), int(rowA.xmax), int(rowA.ymax), rowA.score
-                if axmin > 2*border and axmax < big_tiles_k * self.patch_size and aymin > 2*border and aymax < big_tiles_k * self.patch_size:
-                    continue
-                idx_on_borders.append(idx)
+        min_score = self.detection_score_threshold if self.detection_score_threshold is not None else self.m.model.score_thresh
+        nmismatched = sum([not predictions_match(a, b, min_score) for a, b in zip(eager_predictions, exported_predictions)])
+        if nmismatched > 0:
+            print("Eager neural network is used - results of '{}' backend differ on {}/{} sample subtiles".format(self.cpu_inference_backend, nmismatched, len(samples)))
+            with open(path + ".rejected", "w") as file:
+                file.write("{}/{} sample subtiles have different results\n".format(nmismatched, len(samples)))
+            return
 
-            bigtiles_trees[big_tile_x, big_tile_y] = big_tile_trees
-            bigtiles_to_world[big_tile_x, big_tile_y] = big_tile_to_world
-            bigtiles_idx_on_borders[big_tile_x, big_tile_y] = idx_on_borders
+        print("Using '{}' backend on CPU: {:.2f} sec per subtile instead of {:.2f} sec".format(self.cpu_inference_backend, time_exported / len(samples), time_eager / len(samples)))
+        self.exported_model = exported_model
+        self.exported_model_path = path
 
-            if self.debug_tiles:
-                cv2.imwrite(self.dir_detection_results + "{}-{}_clean.jpg".format(big_tile_x, big_tile_y), big_tile)
-                img_with_trees = self.debug_draw_trees(big_tile, big_tile_trees)
-                cv2.imwrite(self.dir_detection_results + "{}-{}_all_trees.jpg".format(big_tile_x, big_tile_y), img_with_trees)
-                img_with_border_trees = self.debug_draw_trees(big_tile, big_tile_trees.loc[idx_on_borders])
-                cv2.imwrite(self.dir_detection_results + "{}-{}_border_trees.jpg".format(big_tile_x, big_tile_y), img_with_border_trees)
+    def big_tiles_results_saved(self):
+        # results of each big tile are saved to detection checkpoint directory (worker processes return results in the same way)
+        return self.detection_checkpoints or self.incremental_detection or self.detection_shards_count() > 1
 
-            self.detectionPBar.setValue((big_tile_index + 1) * 100 / len(big_tiles))
-            Metashape.app.update()
-            app.processEvents()
-            self.check_stopped()
+    def detection_shards_count(self):
+        return self.detection_nodes if self.detection_nodes > 1 else self.detection_processes
 
-        for big_tile_x, big_tile_y in sorted(big_tiles):
-            big_tile_trees = bigtiles_trees[big_tile_x, big_tile_y]
-            if big_tile_trees is None:
-                continue
+    def detect_in_shards(self, big_tiles_to_process):
+        # Big tiles are split in contiguous shards of processing order (i.e. spatial strips of big tile columns - so that halo tiles are reused),
+        # each shard is processed by a worker process with its own neural network - on this machine (detection_processes)
+        # or on other machines with shared working dir (detection_nodes). Workers save results of each big tile to detection checkpoint directory,
+        # suppression on borders of big tiles (including seams between shards) is done afterwards by detect() as usual
+        import pickle
+        import secrets
+        import multiprocessing
 
-            big_tile_to_world = bigtiles_to_world[big_tile_x, big_tile_y]
+        app = QtWidgets.QApplication.instance()
 
-            a_idx_on_borders = bigtiles_idx_on_borders[big_tile_x, big_tile_y]
+        on_nodes = self.detection_nodes > 1
+        start_locally = not on_nodes or self.detection_nodes_local
+        nshards = min(self.detection_shards_count(), len(big_tiles_to_process))
+        shards = [big_tiles_to_process[i * len(big_tiles_to_process) // nshards:(i + 1) * len(big_tiles_to_process) // nshards] for i in range(nshards)]
 
-            for dx in [-1, 0, 1]:
-                for dy in [-1, 0, 1]:
-                    if dx == 0 and dy == 0:
-                        continue
-                    nx, ny = big_tile_x + dx, big_tile_y + dy
-                    if (nx, ny) not in bigtiles_trees:
+        if self.m is not None and (self.train_on_user_data_enabled or on_nodes):
+            # trained model is passed to workers via checkpoint, and nodes can access only files in shared working dir
+            model_path = self.working_dir + "/detection_model.ckpt"
+            save_lightning_checkpoint(self.m, model_path)
+            model_spec = {"checkpoint": model_path}
+        else:
+            model_spec = self.neural_network_spec()
+
+        exported_model_path = self.exported_model_path
+        if exported_model_path is not None and on_nodes and not exported_model_path.startswith(self.cache_dir + "/"):
+            exported_model_path = self.working_dir + "/" + os.path.basename(exported_model_path)
+            shutil.copyfile(self.exported_model_path, exported_model_path)
+
+        job_id = secrets.token_hex(8)
+        state = self.detection_state()
+        if start_locally:
+            # decoded tiles cache limit is shared by all local worker processes
+            state["tiles_cache_size_mb"] = max(1, self.tiles_cache_size_mb // nshards)
+        job = {"job_id": job_id, "working_dir": self.working_dir, "cache_dir": self.cache_dir, "cache_dir_relative": os.path.relpath(self.cache_dir, self.working_dir),
+               "state": state, "model_spec": model_spec, "exported_model_path": exported_model_path, "shards": shards,
+               "torch_threads": max(1, multiprocessing.cpu_count() // nshards) if start_locally else None}  # nodes use all their cores
+        job_path = self.working_dir + "/detection_job.pkl"
+        with open(job_path + ".tmp", "wb") as file:
+            pickle.dump(job, file)
+        os.replace(job_path + ".tmp", job_path)
+        worker_script = self.working_dir + "/detection_worker.py"
+        write_worker_script(worker_script, detection_core_source())
+
+        def log_path(shard_i):
+            return self.working_dir + "/detection_worker_{}.log".format(shard_i)
+
+        processes = []
+        if start_locally:
+            print("Detection in {} worker processes with {} torch threads each...".format(nshards, job["torch_threads"]))
+            processes = [start_worker_process([worker_script, "shard", job_path, str(shard_i)], log_path(shard_i)) for shard_i in range(nshards)]
+        else:
+            print("Waiting for detection on {} nodes, run on each node (path to shared working dir can be different there, python with packages installed by this script is required):".format(nshards))
+            for shard_i in range(nshards):
+                print("  python \"{}\" shard \"{}\" {}".format(worker_script, job_path, shard_i))
+
+        def checkpoint_mtime(big_tile_xy):
+            checkpoint_path = self.big_tile_checkpoint_path(*big_tile_xy)
+            return os.path.getmtime(checkpoint_path) if os.path.exists(checkpoint_path) else None
+
+        # progress is measured by checkpoints that appeared or were updated (clocks of nodes and file server can differ from local clock)
+        initial_mtimes = {big_tile_xy: checkpoint_mtime(big_tile_xy) for big_tile_xy in big_tiles_to_process}
+        progress_interval = 1.0 if start_locally else 10.0  # checking thousands of files on network storage is not free
+        progress_time = 0.0
+        shards_statuses = {}
+        try:
+            while len(shards_statuses) < nshards:
+                for shard_i in range(nshards):
+                    if shard_i in shards_statuses:
                         continue
-                    b = bigtiles_trees[nx, ny]
-                    if b is None:
+                    process_exited = start_locally and processes[shard_i].poll() is not None
+                    status = self.read_shard_status(shard_i, job_id)
+                    if status is None and process_exited:
+                        raise RuntimeError("Detection worker #{} failed, see {}".format(shard_i, log_path(shard_i)))
+                    if status is None:
                         continue
+                    if status["status"] != "done":
+                        raise RuntimeError("Detection shard #{} failed on {}:\n{}".format(shard_i, status["host"], status.get("error")))
+                    shards_statuses[shard_i] = status
+                    if not start_locally:
+                        print("Shard #{} processed on {}".format(shard_i, status["host"]))
+
+                if time.time() - progress_time > progress_interval:
+                    progress_time = time.time()
+                    nbig_tiles_done = sum([checkpoint_mtime(big_tile_xy) not in [None, initial_mtimes[big_tile_xy]] for big_tile_xy in big_tiles_to_process])
+                    self.detectionPBar.setValue(nbig_tiles_done * 100 / len(big_tiles_to_process))
+                Metashape.app.update()
+                app.processEvents()
+                self.check_stopped()
+                time.sleep(0.5)
+        except:
+            for process in processes:
+                process.kill()
+            raise
+        for process in processes:
+            process.wait()
 
-                    b_idx_on_borders = bigtiles_idx_on_borders[nx, ny]
-
-                    for idxA in a_idx_on_borders:
-                        rowA = big_tile_trees.loc[idxA]
-                        if rowA.label == "Suppressed":
-                            continue
-                        axmin, aymin, axmax, aymax, ascore = int(rowA.xmin), int(rowA.ymin), int(rowA.xmax), int(rowA.ymax), rowA.score
-                        areaA = (axmax - axmin) * (aymax - aymin)
-                        for idxB in b_idx_on_borders:
-                            rowB = b.loc[idxB]
-                            bxmin, bymin, bxmax, bymax, bscore = int(rowB.xmin), int(rowB.ymin), int(rowB.xmax), int(rowB.ymax), rowB.score
-                            bxmin, bxmax = map(lambda x: x + dx * big_tiles_k * self.patch_size, [bxmin, bxmax])
-                            bymin, bymax = map(lambda y: y + dy * big_tiles_k * self.patch_size, [bymin, bymax])
-                            areaB = (bxmax - bxmin) * (bymax - bymin)
-
-                            intersectionx = max(0, min(axmax, bxmax) - max(axmin, bxmin))
-                            intersectiony = max(0, min(aymax, bymax) - max(aymin, bymin))
-                            intersectionArea = intersectionx * intersectiony
-                            if intersectionArea > min(areaA, areaB) * area_overlap_threshold:
-                                if ascore + 0.2 < bscore:
-                                    big_tile_trees.loc[idxA, 'label'] = "Suppressed"
-                                elif not (bscore + 0.2 < ascore):
-                                    if areaA < areaB:
-                                        big_tile_trees.loc[idxA, 'label'] = "Suppressed"
-                                    elif not (areaB < areaA) and (big_tile_x, big_tile_y) < (nx, ny):
-                                        assert not ((nx, ny) < (big_tile_x, big_tile_y))
-                                        big_tile_trees.loc[idxA, 'label'] = "Suppressed"
-
-            big_tile_trees = big_tile_trees[big_tile_trees.label != "Suppressed"]
-
-            if self.debug_tiles:
-                big_tile = cv2.imread(self.dir_detection_results + "{}-{}_clean.jpg".format(big_tile_x, big_tile_y))
-                img_with_trees = self.debug_draw_trees(big_tile, big_tile_trees)
-                cv2.imwrite(self.dir_detection_results + "{}-{}_after_suppression.jpg".format(big_tile_x, big_tile_y), img_with_trees)
+    def read_shard_status(self, shard_i, job_id):
+        import json
 
-            ntrees_detected += len(big_tile_trees)
-            self.add_trees(big_tile_to_world, big_tile_trees, detected_shapes_layer)
+        try:
+            with open(self.shard_status_path(shard_i), "r") as file:
+                status = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return status if status["job_id"] == job_id else None  # status of previous job with the same checkpoint directory is ignored
+
+    def detection_checkpoint_dir(self):
+        # Checkpoint is valid only for the same neural network weights, orthomosaic and detection parameters,
+        # each big tile result is valid only for the same content of its tiles (see big_tile_inputs_digest)
+        import hashlib
+
+        orthomosaic = self.chunk.orthomosaic
+        key = [self.neural_network_digest(), self.chunk.key, orthomosaic.key, orthomosaic.width, orthomosaic.height,
+               self.orthomosaic_resolution, self.patch_size, self.patch_inner_border, self.big_tiles_k, self.orthomosaic_storage,
+               self.detection_score_threshold, self.detection_skip_nodata_fraction]
+        key = hashlib.sha1(repr(key).encode()).hexdigest()
+        # incremental results are kept between runs, while checkpoints are deleted after successful detection
+        subdir = "incremental_detection" if self.incremental_detection else "detection_checkpoints"
+        return self.cache_dir + "/" + subdir + "/" + key + "/"
+
+    def load_incremental_state(self):
+        # Returns detection layer of the previous run, digests of its big tiles and index of its shapes (see remove_big_tiles_shapes)
+        import json
+
+        state_path = self.dir_detection_checkpoint + "state.json"
+        if not os.path.exists(state_path):
+            return None, {}, None
+        with open(state_path, "r") as file:
+            state = json.load(file)
+        for group in self.chunk.shapes.groups:
+            if group.key == state["layer_key"]:
+                return group, state["big_tiles"], state.get("shapes")
+        print("Detection layer of the previous run was not found, new layer will be created")
+        return None, {}, None
+
+    def save_incremental_state(self, shapes_layer, big_tiles_digests, shapes_index):
+        import json
+
+        state_path = self.dir_detection_checkpoint + "state.json"
+        with open(state_path + ".tmp", "w") as file:
+            json.dump({"layer_key": shapes_layer.key, "big_tiles": big_tiles_digests, "shapes": shapes_index}, file)
+        os.replace(state_path + ".tmp", state_path)
+
+    def indexed_layer_shapes(self, shapes_layer, shapes_index):
+        # Shapes of detection layer by index saved with incremental state - positions of layer shapes in chunk shapes with their keys and big tiles,
+        # None if index is not available or shapes were changed since then (f.e. removed shapes shifted positions)
+        shapes = self.chunk.shapes
+        if shapes_index is None or (len(shapes_index["indices"]) > 0 and shapes_index["indices"][-1] >= len(shapes)):
+            return None
+        layer_shapes = []
+        for i, key, big_tile in zip(shapes_index["indices"], shapes_index["keys"], shapes_index["big_tiles"]):
+            shape = shapes[i]
+            if shape.key != key or shape.group is None or shape.group.key != shapes_layer.key:
+                return None
+            layer_shapes.append((i, shape, big_tile))
+        return layer_shapes
+
+    def remove_big_tiles_shapes(self, shapes_layer, big_tiles_xy, shapes_index):
+        # Returns index of the remaining shapes of detection layer (their positions are shifted by removed shapes)
+        import numpy as np
 
-        self.results_ntrees_detected = ntrees_detected
-        self.results_time_detection = time.time() - time_start
+        big_tiles_keys = {"{}-{}".format(*big_tile_xy) for big_tile_xy in big_tiles_xy}
+        shapes = self.chunk.shapes
+        layer_shapes = self.indexed_layer_shapes(shapes_layer, shapes_index)
+        if layer_shapes is None:
+            if shapes_index is not None:
+                print("Shapes were changed since the previous run, searching for detection layer shapes among all shapes...")
+            layer_shapes = [(i, shape, shape.attributes["big_tile"] if "big_tile" in shape.attributes.keys() else None)
+                            for i, shape in enumerate(shapes) if shape.group is not None and shape.group.key == shapes_layer.key]
+        # shapes without big tile mark can't be matched with new results
+        is_removed = [big_tile is None or big_tile in big_tiles_keys for i, shape, big_tile in layer_shapes]
+        shapes.remove([shape for (i, shape, big_tile), removed in zip(layer_shapes, is_removed) if removed])
+
+        removed_indices = np.int64([i for (i, shape, big_tile), removed in zip(layer_shapes, is_removed) if removed])
+        kept_shapes = [layer_shape for layer_shape, removed in zip(layer_shapes, is_removed) if not removed]
+        kept_indices = np.int64([i for i, shape, big_tile in kept_shapes])
+        return {"indices": (kept_indices - np.searchsorted(removed_indices, kept_indices)).tolist(),
+                "keys": [shape.key for i, shape, big_tile in kept_shapes], "big_tiles": [big_tile for i, shape, big_tile in kept_shapes]}
+
+    def trees_world_polygons(self, to_world, tile_trees):
+        # Returns Nx4x2 corners of boxes in orthomosaic coordinate system
+        import numpy as np
 
-    def add_trees(self, to_world, tile_trees, shapes_group):
+        assert np.all(tile_trees.label == "Tree")
+        boxes, _ = trees_to_boxes(tile_trees)
+        corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 2) + 0.5
+        return apply_affine_2x3(to_world, corners).reshape(-1, 4, 2)
+
+    def trees_polygons(self, to_world, tile_trees):
+        # Returns Nx4x2 corners of boxes in shapes coordinate system
         import numpy as np
 
-        for row in tile_trees.itertuples():
-            xmin, ymin, xmax, ymax, label = int(row.xmin), int(row.ymin), int(row.xmax), int(row.ymax), row.label
-            assert (label == "Tree")
+        # corners of all boxes are transformed at once, with tolerance of 1% of orthomosaic pixel
+        corners = self.trees_world_polygons(to_world, tile_trees).reshape(-1, 2)
+        pixel = self.orthomosaic_to_shapes.transform(apply_affine_2x3(to_world, [[0, 0], [1, 0], [0, 1]]))
+        pixel_size = min(np.linalg.norm(pixel[1] - pixel[0]), np.linalg.norm(pixel[2] - pixel[0]))
+        return self.orthomosaic_to_shapes.transform(corners, tolerance=0.01 * pixel_size).reshape(-1, 4, 2)
 
-            corners = []
-            for x, y in [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]:
-                x, y = to_world @ np.array([x+0.5, y+0.5, 1]).reshape(3, 1)
-                p = Metashape.Vector([x, y])
-                p = Metashape.CoordinateSystem.transform(p, self.chunk.orthomosaic.crs, self.chunk.shapes.crs)
-                corners.append([p.x, p.y])
+    def add_polygons(self, shapes_group, polygons, big_tiles_keys, scores):
+        # Polygons are imported at once from temporary GeoPackage (much faster than creation of shapes one by one),
+        # shapes are added one by one only if import is not possible
+        if len(polygons) == 0:
+            return
+        if self.chunk.shapes.crs is not None:
+            try:
+                self.import_polygons(shapes_group, polygons, big_tiles_keys, scores)
+                return
+            except Exception as e:
+                print("Shapes will be added one by one - import from GeoPackage failed: {}".format(e))
 
+        for shape_corners, big_tile_key, score in zip(polygons, big_tiles_keys, scores):
             shape = self.chunk.shapes.addShape()
             shape.group = shapes_group
-            shape.geometry = Metashape.Geometry.Polygon(corners)
+            shape.geometry = Metashape.Geometry.Polygon(shape_corners.tolist())
+            shape.attributes["big_tile"] = big_tile_key
+            shape.attributes["score"] = "{:.4f}".format(score)
+
+    def import_polygons(self, shapes_group, polygons, big_tiles_keys, scores):
+        # Imported shapes are appended to the end of shapes (in their own new group), so they are found without scanning all shapes of project
+        shapes = self.chunk.shapes
+        nshapes_before = len(shapes)
+        existing_groups = {group.key for group in shapes.groups}
+
+        path = self.working_dir + "/detected_shapes.gpkg"
+        writer = GeoPackageWriter(path, "detected_shapes", shapes.crs, [("big_tile", "TEXT"), ("score", "REAL")])
+        writer.add_polygons(polygons, {"big_tile": big_tiles_keys, "score": scores})
+        writer.close()
+        self.chunk.importShapes(path=path, replace=False, format=Metashape.ShapesFormatGeoPackage, crs=shapes.crs)
+
+        imported_groups = [group for group in shapes.groups if group.key not in existing_groups]
+        imported_groups_keys = {group.key for group in imported_groups}
+        imported_shapes = [shapes[i] for i in range(nshapes_before, len(shapes))]
+        is_imported = [shape.group is not None and shape.group.key in imported_groups_keys for shape in imported_shapes]
+        is_valid = len(imported_shapes) == writer.nfeatures and all(is_imported)\
+                   and all("big_tile" in shape.attributes.keys() and "score" in shape.attributes.keys() for shape in imported_shapes)
+        if not is_valid:
+            # only shapes of imported groups are removed - shapes of other groups at the end (if any) existed before
+            shapes.remove([shape for shape, imported in zip(imported_shapes, is_imported) if imported] + imported_groups)
+            raise RuntimeError("{}/{} shapes imported with attributes".format(len(imported_shapes), writer.nfeatures))
+        for shape in imported_shapes:
+            shape.group = shapes_group
+        if len(imported_groups) > 0:
+            shapes.remove(imported_groups)
+        os.remove(path)
 
     def show_results_dialog(self):
         message = "Finished in {:.2f} sec:\n".format(self.results_time_total)\
-                   + "{} trees detected.".format(self.results_ntrees_detected)
+                   + "{} trees detected.\n".format(self.results_ntrees_detected)\
+                   + ("Exported to {}\n".format(self.detection_export_path) if len(self.detection_export_path) > 0 else "")\
+                   + "Decoded tiles cache: {} hits, {} misses.".format(self.tiles_cache.hits, self.tiles_cache.misses)
 
         print(message)
         Metashape.app.messageBox(message)
@@ -1109,7 +3648,13 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         generalLayout.addWidget(self.edtWorkingDir, 0, 1)
         generalLayout.addWidget(self.btnWorkingDir, 0, 2)
 
+        self.chkOrthomosaicExportCache = QtWidgets.QCheckBox("Keep exported orthomosaic for next runs (up to {} GB of disk space)".format(self.orthomosaic_export_cache_size_mb // 1024))
+        self.chkOrthomosaicExportCache.setToolTip("Exported orthomosaic tiles are kept in '<working dir>_cache' dir, so the next runs with the same orthomosaic and resolution skip export.\n"
+                                                  "The least recently used orthomosaics are deleted when the limit is exceeded.")
+        self.chkOrthomosaicExportCache.setChecked(self.orthomosaic_export_cache)
+
         generalLayout.addWidget(self.chkUse10cmResolution, 1, 1)
+        generalLayout.addWidget(self.chkOrthomosaicExportCache, 2, 1)
         self.groupBoxGeneral.setLayout(generalLayout)
 
         self.groupBoxModelTraining = QtWidgets.QGroupBox("Additional model training (recommended to train at least on a 50x50m zone)")
@@ -1121,6 +3666,12 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         trainingLayout.addWidget(self.labelTrainDataLayer, 1, 0)
         trainingLayout.addWidget(self.trainDataLayer, 1, 1, 1, 2)
 
+        self.chkTrainDataCache = QtWidgets.QCheckBox("Keep prepared train data for next runs (up to {} last trainings)".format(self.train_data_cache_entries))
+        self.chkTrainDataCache.setToolTip("Augmented train tiles are kept in '<working dir>_cache' dir, so the next runs with the same train zones and annotations go straight to training.\n"
+                                          "The least recently used train data is deleted when the limit is exceeded.")
+        self.chkTrainDataCache.setChecked(self.train_data_cache)
+        trainingLayout.addWidget(self.chkTrainDataCache, 2, 1, 1, 2)
+
         self.groupBoxModelTraining.setLayout(trainingLayout)
 
         self.groupBoxModelSaveLoad = QtWidgets.QGroupBox("Save/Load trained model (optional, note that orthomosaic resolution should be the same)")
@@ -1234,6 +3785,8 @@ class DetectObjectsDlg(QtWidgets.QDialog):
         import sys
 
         self.prefer_original_resolution = not self.chkUse10cmResolution.isChecked()
+        self.orthomosaic_export_cache = self.chkOrthomosaicExportCache.isChecked()
+        self.train_data_cache = self.chkTrainDataCache.isChecked()
 
         # self.use_neural_network_pretrained_on_birds = self.chkUseBirdsPretrainedModel.isChecked()
 
@@ -1280,27 +3833,193 @@ class DetectObjectsDlg(QtWidgets.QDialog):
                     self.train_data.append(shape)
             print("{} train zones and {} train data loaded in {:.2f} sec".format(len(self.train_zones), len(self.train_data), time.time() - loading_train_shapes_start))
 
-    def debug_draw_trees(self, img, trees):
-        import cv2
+
+class CountObjectsInZonesDlg(QtWidgets.QDialog):
+    # Counts detected objects (centers of their boxes) in polygons of zones layer, results are saved in attributes of zones:
+    # objects_count, objects_mean_score and objects_density (objects per hectare). Detected objects are taken from shapes layer
+    # or from GeoPackage exported by detection (so that millions of objects don't have to be loaded as shapes).
+    # Optionally density of objects (per hectare) is saved as GeoTIFF raster covering zones
+
+    def __init__(self, parent):
+        self.density_cell_size = 10.0  # size of density raster cell in meters (in orthomosaic coordinate system units)
+        self.attribute_count = "objects_count"
+        self.attribute_mean_score = "objects_mean_score"
+        self.attribute_density = "objects_density"
+
+        QtWidgets.QDialog.__init__(self, parent)
+        self.setWindowTitle("Count detected objects in zones")
+
+        self.chunk = Metashape.app.document.chunk
+        self.create_gui()
+        self.exec()
+
+    def create_gui(self):
+        self.layers = []
+        if self.chunk.shapes is not None:
+            for layer in self.chunk.shapes.groups:
+                self.layers.append((layer.key, layer.label if layer.label != '' else 'Layer'))
+        self.geopackageChoice = (None, "GeoPackage file")
+
+        layout = QtWidgets.QGridLayout()
+        row = 0
+
+        self.labelZonesLayer = QtWidgets.QLabel("Zones:")
+        self.zonesLayer = QtWidgets.QComboBox()
+        for key, label in self.layers:
+            self.zonesLayer.addItem(label)
+        layout.addWidget(self.labelZonesLayer, row, 0)
+        layout.addWidget(self.zonesLayer, row, 1, 1, 2)
+        row += 1
+
+        self.labelObjectsSource = QtWidgets.QLabel("Detected objects:")
+        self.objectsSource = QtWidgets.QComboBox()
+        for key, label in self.layers + [self.geopackageChoice]:
+            self.objectsSource.addItem(label)
+        for i, (key, label) in enumerate(self.layers):
+            if label.startswith("Detected"):
+                self.objectsSource.setCurrentIndex(i)
+        layout.addWidget(self.labelObjectsSource, row, 0)
+        layout.addWidget(self.objectsSource, row, 1, 1, 2)
+        row += 1
+
+        self.edtGeoPackagePath = QtWidgets.QLineEdit()
+        self.edtGeoPackagePath.setPlaceholderText("Path to GeoPackage exported by detection")
+        self.btnGeoPackagePath = QtWidgets.QPushButton("...")
+        self.btnGeoPackagePath.setFixedSize(25, 25)
+        QtCore.QObject.connect(self.btnGeoPackagePath, QtCore.SIGNAL("clicked()"), lambda: self.choose_geopackage_path())
+        layout.addWidget(self.edtGeoPackagePath, row, 1)
+        layout.addWidget(self.btnGeoPackagePath, row, 2)
+        row += 1
+
+        self.labelDensityPath = QtWidgets.QLabel("Density raster:")
+        self.edtDensityPath = QtWidgets.QLineEdit()
+        self.edtDensityPath.setPlaceholderText("Optional path to GeoTIFF with objects per hectare")
+        self.btnDensityPath = QtWidgets.QPushButton("...")
+        self.btnDensityPath.setFixedSize(25, 25)
+        QtCore.QObject.connect(self.btnDensityPath, QtCore.SIGNAL("clicked()"), lambda: self.choose_density_path())
+        layout.addWidget(self.labelDensityPath, row, 0)
+        layout.addWidget(self.edtDensityPath, row, 1)
+        layout.addWidget(self.btnDensityPath, row, 2)
+        row += 1
+
+        self.labelDensityCellSize = QtWidgets.QLabel("Density cell size:")
+        self.spinDensityCellSize = QtWidgets.QDoubleSpinBox()
+        self.spinDensityCellSize.setRange(0.1, 10000.0)
+        self.spinDensityCellSize.setValue(self.density_cell_size)
+        layout.addWidget(self.labelDensityCellSize, row, 0)
+        layout.addWidget(self.spinDensityCellSize, row, 1, 1, 2)
+        row += 1
+
+        self.btnRun = QtWidgets.QPushButton("Run")
+        layout.addWidget(self.btnRun, row, 1)
+        row += 1
+
+        self.setLayout(layout)
+
+        QtCore.QObject.connect(self.btnRun, QtCore.SIGNAL("clicked()"), lambda: self.process())
+
+    def choose_geopackage_path(self):
+        path = Metashape.app.getOpenFileName("Detected objects", "", "GeoPackage (*.gpkg);;All Files (*.*)")
+        self.edtGeoPackagePath.setText(path)
+        self.objectsSource.setCurrentIndex(len(self.layers))
+
+    def choose_density_path(self):
+        path = Metashape.app.getSaveFileName("Density raster", "", "GeoTIFF (*.tif);;All Files (*.*)")
+        if len(path) > 0 and path.split(".")[-1].lower() not in ["tif", "tiff"]:
+            path += ".tif"
+        self.edtDensityPath.setText(path)
+
+    def load_detected_objects(self, crs, tolerance):
+        # Returns centers of detected objects (in given coordinate system) and their scores (NaN if unknown)
         import numpy as np
-        import pandas as pd
 
-        img = img.copy()
+        source = (self.layers + [self.geopackageChoice])[self.objectsSource.currentIndex()]
+        if source == self.geopackageChoice:
+            path = self.edtGeoPackagePath.text()
+            if len(path) == 0 or not os.path.exists(path):
+                raise Exception("GeoPackage file not found: {}".format(path))
+            centers, scores, definition = read_geopackage_boxes_centers(path)
+            if definition is not None and crs is not None and len(centers) > 0:
+                src_crs = Metashape.CoordinateSystem()
+                src_crs.init(definition)
+                centers = CrsTransformer(src_crs, crs).transform(centers, tolerance=tolerance)
+            print("{} objects loaded from {}".format(len(centers), path))
+            return centers, scores
+
+        objects = [shape for shape in self.chunk.shapes if shape.group.key == source[0]]
+        points, offsets, rings_objects = shapes_rings_in_crs(self.chunk, objects, crs, tolerance)
+        objects_min = np.full((len(objects), 2), np.inf)
+        objects_max = np.full((len(objects), 2), -np.inf)
+        for ring_i, object_i in enumerate(rings_objects):
+            vertices = points[offsets[ring_i]:offsets[ring_i + 1]]
+            if len(vertices) > 0:
+                objects_min[object_i] = np.minimum(objects_min[object_i], vertices.min(axis=0))
+                objects_max[object_i] = np.maximum(objects_max[object_i], vertices.max(axis=0))
+        is_polygon = np.all(objects_min <= objects_max, axis=1)
+        if not np.all(is_polygon):
+            print("{} objects are not polygons and are not counted".format(np.sum(~is_polygon)))
+        centers = ((objects_min + objects_max) / 2)[is_polygon]
+        scores = np.full(len(objects), np.nan)
+        for i, shape in enumerate(objects):
+            if "score" in shape.attributes.keys():
+                try:
+                    scores[i] = float(shape.attributes["score"])
+                except ValueError:
+                    pass
+        print("{} objects loaded from layer {}".format(len(centers), source[1]))
+        return centers, scores[is_polygon]
 
-        if isinstance(trees, pd.DataFrame):
-            for row in trees.itertuples():
-                xmin, ymin, xmax, ymax, label = int(row.xmin), int(row.ymin), int(row.xmax), int(row.ymax), row.label
-                assert label == "Tree"
-                cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 0, 255), 2)
-        else:
-            h, w, cn = img.shape
-            for bbox_from, bbox_to in trees:
-                assert np.all(bbox_from >= np.int32([0, 0]))
-                assert np.all(bbox_to <= np.int32([w, h]))
-                (xmin, ymin), (xmax, ymax) = bbox_from, bbox_to
-                cv2.rectangle(img, (xmin, ymin), (xmax, ymax), (0, 0, 255), 2)
+    def process(self):
+        import numpy as np
 
-        return img
+        time_start = time.time()
+        if len(self.layers) == 0:
+            raise Exception("No shapes layers.")
+
+        orthomosaic = self.chunk.orthomosaic
+        crs = orthomosaic.crs if orthomosaic is not None else self.chunk.shapes.crs
+        tolerance = 0.0
+        if orthomosaic is not None:
+            # 1% of orthomosaic pixel in units of its coordinate system (degrees for geographic one)
+            pixel_size = min(abs(orthomosaic.right - orthomosaic.left) / orthomosaic.width, abs(orthomosaic.top - orthomosaic.bottom) / orthomosaic.height)
+            tolerance = 0.01 * pixel_size
+        is_metric = crs is None or not crs_is_geographic(crs)
+        if not is_metric:
+            print("Warning: coordinate system is not projected, densities are computed per square degree")
+
+        zones_key, zones_label = self.layers[self.zonesLayer.currentIndex()]
+        zones = [shape for shape in self.chunk.shapes if shape.group.key == zones_key]
+        # holes and parts of multipolygons are rings of zone, zones that are not polygons are skipped
+        zones_points, zones_offsets, rings_zones = shapes_rings_in_crs(self.chunk, zones, crs, tolerance)
+        is_polygon = np.zeros(len(zones), bool)
+        is_polygon[rings_zones] = True
+        if not np.all(is_polygon):
+            print("{} zones are not polygons and are skipped".format(np.sum(~is_polygon)))
+        centers, scores = self.load_detected_objects(crs, tolerance)
+
+        counts, mean_scores, areas = zonal_statistics(centers, scores, zones_points, zones_offsets, rings_zones, len(zones))
+        area_unit = 10000.0 if is_metric else 1.0
+        for shape, shape_is_polygon, count, mean_score, area in zip(zones, is_polygon, counts, mean_scores, areas):
+            if not shape_is_polygon:
+                continue
+            shape.attributes[self.attribute_count] = str(count)
+            shape.attributes[self.attribute_mean_score] = "{:.4f}".format(mean_score) if not np.isnan(mean_score) else ""
+            shape.attributes[self.attribute_density] = "{:.2f}".format(count * area_unit / area) if area > 0 else ""
+
+        density_path = self.edtDensityPath.text()
+        if len(density_path) > 0 and len(zones_points) > 0:
+            cell_size = self.spinDensityCellSize.value()
+            xmin, ymin = zones_points.min(axis=0)
+            xmax, ymax = zones_points.max(axis=0)
+            density = points_density_grid(centers, xmin, ymin, xmax, ymax, cell_size) * (area_unit / cell_size ** 2)
+            write_density_geotiff(density_path, density, xmin, ymax, cell_size, crs)
+
+        message = "Finished in {:.2f} sec:\n".format(time.time() - time_start)\
+                  + "{} objects counted in {} zones of layer {}.\n".format(int(counts.sum()), int(is_polygon.sum()), zones_label)\
+                  + ("Density raster saved to {}".format(density_path) if len(density_path) > 0 else "")
+        print(message)
+        Metashape.app.messageBox(message)
+        self.accept()
 
 
 def detect_objects():
@@ -1321,3 +4040,20 @@ def detect_objects():
 label = "Scripts/Detect objects"
 Metashape.app.addMenuItem(label, detect_objects)
 print("To execute this script press {}".format(label))
+
+
+def count_objects_in_zones():
+    chunk = Metashape.app.document.chunk
+
+    if chunk is None or chunk.shapes is None:
+        raise Exception("No shapes in active chunk.")
+
+    app = QtWidgets.QApplication.instance()
+    parent = app.activeWindow()
+
+    CountObjectsInZonesDlg(parent)
+
+
+label = "Scripts/Count detected objects in zones"
+Metashape.app.addMenuItem(label, count_objects_in_zones)
+print("To count detected objects in zones press {}".format(label))
@@ -0,0 +1,288 @@
+# Tests of the detection core of src/detect_objects.py. The core section doesn't use Metashape and Qt (it is saved as a standalone
+# worker script by the script itself), so it is loaded the same way here - without Metashape, PySide2 and neural network packages.
+
+import os
+
+import numpy as np
+import pytest
+
+DETECT_OBJECTS_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "src", "detect_objects.py")
+
+
+def load_detection_core():
+    with open(DETECT_OBJECTS_PATH, "r", encoding="utf-8") as file:
+        source = file.read()
+    begin = source.index("\n# ==== Detection core (begin) ====\n")
+    end = source.index("\n# ==== Detection core (end) ====\n")
+    namespace = {"__name__": "detection_core"}
+    exec(compile("import os, sys, time, warnings\n" + source[begin:end + 1], DETECT_OBJECTS_PATH, "exec"), namespace)
+    return namespace
+
+
+def load_definitions(names, namespace):
+    # Code outside of the detection core uses Metashape and Qt, so only given top-level definitions and methods ("Class.method") are loaded,
+    # each method becomes a plain function. Names used by them (f.e. Metashape) are provided by test in namespace
+    import ast
+
+    with open(DETECT_OBJECTS_PATH, "r", encoding="utf-8") as file:
+        module = ast.parse(file.read(), DETECT_OBJECTS_PATH)
+    nodes = {}
+    for node in module.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            nodes[node.name] = node
+            if isinstance(node, ast.ClassDef):
+                nodes.update({node.name + "." + method.name: method for method in node.body if isinstance(method, ast.FunctionDef)})
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            nodes[node.targets[0].id] = node
+    selected = ast.Module(body=[nodes[name] for name in names], type_ignores=[])
+    exec(compile(selected, DETECT_OBJECTS_PATH, "exec"), namespace)
+    return namespace
+
+
+@pytest.fixture(scope="module")
+def core():
+    return load_detection_core()
+
+
+def suppress_overlapping_boxes_loop(a_boxes, a_scores, b_boxes, b_scores, suppress_ties, area_overlap_threshold):
+    # Per-pair loop of the original implementation (iterrows over both neighbouring subtiles), without early exit on suppression
+    suppressed = np.zeros(len(a_boxes), bool)
+    for i, ((axmin, aymin, axmax, aymax), ascore) in enumerate(zip(a_boxes.tolist(), a_scores.tolist())):
+        areaA = (axmax - axmin) * (aymax - aymin)
+        for (bxmin, bymin, bxmax, bymax), bscore in zip(b_boxes.tolist(), b_scores.tolist()):
+            areaB = (bxmax - bxmin) * (bymax - bymin)
+
+            intersectionx = max(0, min(axmax, bxmax) - max(axmin, bxmin))
+            intersectiony = max(0, min(aymax, bymax) - max(aymin, bymin))
+            intersectionArea = intersectionx * intersectiony
+            if intersectionArea > min(areaA, areaB) * area_overlap_threshold:
+                if ascore + 0.2 < bscore:
+                    suppressed[i] = True
+                elif not (bscore + 0.2 < ascore):
+                    if areaA < areaB:
+                        suppressed[i] = True
+                    elif not (areaB < areaA) and suppress_ties:
+                        suppressed[i] = True
+    return suppressed
+
+
+def random_boxes(rng, n, extent, max_size):
+    xy = rng.integers(0, extent, size=(n, 2))
+    size = rng.integers(1, max_size, size=(n, 2))
+    if n > 1:
+        # duplicates of other boxes - to check equal areas and ties
+        duplicates = rng.random(n) < 0.2
+        size[duplicates] = size[rng.integers(0, n, size=duplicates.sum())]
+    boxes = np.int64(np.hstack([xy, xy + size]))
+    scores = np.round(rng.random(n), 1)  # rounded - so that score differences are often exactly on the margin
+    return boxes, scores
+
+
+def test_suppress_overlapping_boxes_matches_loop(core):
+    rng = np.random.default_rng(1291)
+    for case_i in range(3000):
+        a_boxes, a_scores = random_boxes(rng, int(rng.integers(0, 12)), 60, 30)
+        b_boxes, b_scores = random_boxes(rng, int(rng.integers(0, 12)), 60, 30)
+        suppress_ties = bool(rng.integers(0, 2))
+        area_overlap_threshold = float(rng.choice([0.0, 0.3, 0.5]))
+        max_pairs_per_batch = int(rng.choice([1, 7, 2**20]))
+
+        expected = suppress_overlapping_boxes_loop(a_boxes, a_scores, b_boxes, b_scores, suppress_ties, area_overlap_threshold)
+        result = core["suppress_overlapping_boxes"](a_boxes, a_scores, b_boxes, b_scores, suppress_ties, area_overlap_threshold,
+                                                    max_pairs_per_batch=max_pairs_per_batch)
+        assert result.dtype == bool
+        np.testing.assert_array_equal(result, expected, err_msg="case #{}".format(case_i))
+
+
+def test_suppress_overlapping_boxes_empty(core):
+    boxes = np.int64([[0, 0, 10, 10]])
+    empty = np.zeros((0, 4), np.int64)
+    assert len(core["suppress_overlapping_boxes"](empty, np.zeros(0), boxes, [0.5], True, 0.3)) == 0
+    np.testing.assert_array_equal(core["suppress_overlapping_boxes"](boxes, [0.5], empty, np.zeros(0), True, 0.3), [False])
+
+
+def test_parse_optimizers_config(core):
+    parse = core["parse_optimizers_config"]
+    optimizer, scheduler = object(), object()
+    assert parse(optimizer) == (optimizer, None)
+    assert parse([optimizer]) == (optimizer, None)
+    assert parse({"optimizer": optimizer}) == (optimizer, None)
+    assert parse(([optimizer], [scheduler])) == (optimizer, {"scheduler": scheduler, "interval": "epoch", "frequency": 1, "monitor": None})
+    assert parse({"optimizer": optimizer, "lr_scheduler": scheduler, "monitor": "val_classification"})[1]["monitor"] == "val_classification"
+    assert parse({"optimizer": optimizer, "lr_scheduler": {"scheduler": scheduler, "interval": "step", "frequency": 2}})[1] == \
+        {"scheduler": scheduler, "interval": "step", "frequency": 2, "monitor": None}
+
+
+def test_zonal_statistics_rings(core):
+    points = np.float64([[1, 1], [5, 5], [9, 9], [21, 21], [50, 50]])
+    scores = np.float64([0.2, 0.4, 0.6, 0.8, 1.0])
+    square = lambda xmin, ymin, size: np.float64([[xmin, ymin], [xmin + size, ymin], [xmin + size, ymin + size], [xmin, ymin + size]])
+    # polygon with hole, multipolygon of two squares, polygon without points, zone that is not a polygon
+    rings = [square(0, 0, 10), square(4, 4, 2), square(0, 0, 2), square(20, 20, 2), square(100, 100, 10)]
+    rings_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    rings_polygons = np.int64([0, 0, 1, 1, 2])
+
+    counts, mean_scores, areas = core["zonal_statistics"](points, scores, np.concatenate(rings), rings_offsets, rings_polygons, 4)
+    np.testing.assert_array_equal(counts, [2, 2, 0, 0])
+    np.testing.assert_allclose(mean_scores[:2], [0.4, 0.5])
+    assert np.all(np.isnan(mean_scores[2:]))
+    np.testing.assert_allclose(areas, [96, 8, 100, 0])
+
+
+def test_zonal_statistics_matches_brute_force(core):
+    rng = np.random.default_rng(7)
+    points = rng.uniform(0, 1000, (20000, 2))
+    rings, rings_polygons = [], []
+    for polygon_i in range(200):
+        center, radius = rng.uniform(50, 950, 2), rng.uniform(5, 60)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, int(rng.integers(3, 12))))
+        rings.append(center + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1))
+        rings_polygons.append(polygon_i)
+    rings_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+
+    counts, _, _ = core["zonal_statistics"](points, None, np.concatenate(rings), rings_offsets, np.int64(rings_polygons), len(rings))
+    expected = [core["points_in_polygon"](points, ring).sum() for ring in rings]
+    np.testing.assert_array_equal(counts, expected)
+
+
+def test_choose_big_tiles_layout(core):
+    namespace = load_definitions(["DetectObjectsDlg.choose_big_tiles_layout", "DetectObjectsDlg.detection_shards_count"], dict(core))
+
+    class LayoutChooser:
+        choose_big_tiles_layout = namespace["choose_big_tiles_layout"]
+        detection_shards_count = namespace["detection_shards_count"]
+
+        def saved_big_tiles_k(self, big_tiles_k_candidates):
+            return None
+
+    chooser = LayoutChooser()
+    chooser.patch_size, chooser.patch_inner_border, chooser.debug_tiles = 400, 100, False
+    chooser.detection_queue_depth, chooser.detection_nodes, chooser.detection_nodes_local = 2, 1, False
+    # 1024 MB are left for big tiles, big tiles of 8x8, 4x4, 2x2 and 1x1 tiles take 127.16, 35.64, 11.0 and 3.96 MB (11 bytes per pixel)
+    chooser.detection_memory_budget_mb, chooser.tiles_cache_size_mb = 2048, 1024
+    for detection_processes, expected_layout in [(1, (8, 2)), (8, (8, 2)), (16, (4, 2)), (64, (2, 2)), (200, (1, 2))]:
+        chooser.detection_processes = detection_processes
+        assert chooser.choose_big_tiles_layout() == expected_layout, detection_processes
+
+
+def test_crs_is_geographic():
+    crs_is_geographic = load_definitions(["crs_is_geographic"], {})["crs_is_geographic"]
+    wgs84 = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]'
+    utm = 'PROJCS["WGS 84 / UTM zone 37N",{},PROJECTION["Transverse_Mercator"],UNIT["metre",1]]'.format(wgs84)
+    egm96 = 'VERT_CS["EGM96 height",VERT_DATUM["EGM96 geoid",2005],UNIT["metre",1]]'
+    for wkt, expected in [(wgs84, True), ('COMPD_CS["WGS 84 + EGM96 height",{},{}]'.format(wgs84, egm96), True),
+                          (utm, False), ('COMPD_CS["WGS 84 / UTM zone 37N + EGM96 height",{},{}]'.format(utm, egm96), False),
+                          ('LOCAL_CS["Local Coordinates (m)",LOCAL_DATUM["Local Datum",0],UNIT["metre",1]]', False)]:
+        assert crs_is_geographic(type("CoordinateSystem", (), {"wkt": wkt})) == expected, wkt
+
+
+def test_cached_features_train_the_same_parameters(core):
+    pytest.importorskip("torchvision")
+    from torchvision.models.detection.backbone_utils import resnet_fpn_backbone
+
+    namespace = load_definitions(["DetectObjectsDlg.freeze_low_layers", "DetectObjectsDlg.freeze_layers"], {})
+
+    class Trainer:
+        freeze_low_layers = namespace["freeze_low_layers"]
+        freeze_layers = namespace["freeze_layers"]
+
+    for trainable_layers, expected_prefix in [(3, ["conv1", "bn1", "relu", "maxpool", "layer1", "layer2"]), (5, [])]:
+        backbone = resnet_fpn_backbone(backbone_name="resnet18", weights=None, trainable_layers=trainable_layers, returned_layers=[2, 3, 4])  # as in RetinaNet
+        trainer = Trainer()
+        trainer.m = type("DeepForest", (), {"model": type("RetinaNet", (), {"backbone": backbone})})
+        trainer.freeze_layers()
+
+        # without features cache all parameters with requires_grad are trained, with cache - only parameters of layers after cached prefix and of FPN
+        prefix = core["frozen_backbone_prefix"](backbone.body)
+        assert prefix == expected_prefix
+        trained_directly = {name for name, p in backbone.named_parameters() if p.requires_grad}
+        trained_on_cache = {"body." + layer_name + "." + name for layer_name, layer in backbone.body.named_children() if layer_name not in prefix
+                            for name, p in layer.named_parameters() if p.requires_grad}
+        trained_on_cache |= {"fpn." + name for name, p in backbone.fpn.named_parameters() if p.requires_grad}
+        assert trained_on_cache == trained_directly
+
+
+def stub_metashape(transform):
+    # Metashape.CoordinateSystem.transform with given function of Nx2 points instead of real coordinate systems
+    import types
+
+    def vector(coordinates):
+        return types.SimpleNamespace(**dict(zip("xyz", coordinates)))
+
+    def transform_vector(point, src_crs, dst_crs):
+        return vector(transform(np.float64([[point.x, point.y]]))[0].tolist())
+
+    return types.SimpleNamespace(Vector=vector, CoordinateSystem=types.SimpleNamespace(transform=transform_vector))
+
+
+def test_crs_transformer_checks_affine_approximation_between_samples():
+    extent = 1000.0
+
+    def wavy(points):
+        # affine fit on 3x3 grid of samples over the whole extent is exact in samples, but is 1 unit wrong at quarters
+        return points + np.sin(2 * np.pi * points / extent)[:, ::-1]
+
+    def shifted(points):
+        return 2.0 * points + [10.0, -5.0]
+
+    rng = np.random.default_rng(3)
+    points = np.vstack([[[0, 0], [extent, extent]], rng.uniform(0, extent, (10000, 2))])
+    for transform, exactly_transformed_points in [(wavy, None), (shifted, 9 + 4)]:
+        namespace = load_definitions(["CrsTransformer"], {"Metashape": stub_metashape(transform)})
+        transformer = namespace["CrsTransformer"](type("CoordinateSystem", (), {"wkt": "A"}), type("CoordinateSystem", (), {"wkt": "B"}))
+        result = transformer.transform(points, tolerance=0.01)
+        assert np.max(np.abs(result - transform(points))) <= 0.01
+        if exactly_transformed_points is not None:
+            assert transformer.npoints_transformed_exactly == exactly_transformed_points
+
+
+def test_geopackage_writer_round_trip(core, tmp_path):
+    import sqlite3
+
+    namespace = load_definitions(["GeoPackageWriter", "GEOPACKAGE_WGS84_WKT"], dict(core))
+    crs = type("CoordinateSystem", (), {"authority": "EPSG::32637", "name": "WGS 84 / UTM zone 37N",
+                                        "wkt": 'PROJCS["WGS 84 / UTM zone 37N",GEOGCS["WGS 84"],PROJECTION["Transverse_Mercator"],UNIT["metre",1]]'})
+    rng = np.random.default_rng(5)
+    xy = rng.uniform(400000, 401000, (50, 2))
+    size = rng.uniform(1, 5, (50, 2))
+    polygons = np.stack([xy, xy + [1, 0] * size, xy + size, xy + [0, 1] * size], axis=1)
+    scores = np.round(rng.random(50), 3)
+    big_tiles = ["{}-{}".format(i % 3, i % 2) for i in range(50)]
+
+    for spatial_index in [True, False]:
+        path = str(tmp_path / "boxes_{}.gpkg".format(spatial_index))
+        writer = namespace["GeoPackageWriter"](path, "boxes", crs, [("score", "REAL"), ("big_tile", "TEXT")], spatial_index=spatial_index)
+        for batch in [slice(0, 20), slice(20, 20), slice(20, 50)]:  # polygons are written incrementally (including empty batch)
+            writer.add_polygons(polygons[batch], {"score": scores[batch], "big_tile": big_tiles[batch]})
+        writer.close()
+        assert writer.nfeatures == 50
+
+        centers, read_scores, definition = core["read_geopackage_boxes_centers"](path)
+        order = np.lexsort(centers.T)
+        expected_order = np.lexsort((xy + size / 2).T)
+        np.testing.assert_allclose(centers[order], (xy + size / 2)[expected_order], atol=0.1)  # R-tree bounds are 32-bit floats
+        np.testing.assert_allclose(read_scores[order], scores[expected_order])
+        assert definition == crs.wkt
+
+        connection = sqlite3.connect(path)
+        rows = connection.execute("SELECT fid, geom, score, big_tile FROM boxes ORDER BY fid").fetchall()
+        assert [row[0] for row in rows] == list(range(1, 51))
+        assert [row[3] for row in rows] == big_tiles
+        np.testing.assert_allclose([row[2] for row in rows], scores)
+        for (fid, blob, score, big_tile), polygon in zip(rows, polygons):
+            # GeoPackage header with XY envelope (40 bytes), then WKB polygon header (13 bytes) and closed ring of 5 points
+            assert blob[:2] == b"GP" and np.frombuffer(blob, "<i4", 1, 4)[0] == 32637
+            np.testing.assert_allclose(core["geopackage_geometry_bounds"](blob), [polygon[:, 0].min(), polygon[:, 0].max(), polygon[:, 1].min(), polygon[:, 1].max()])
+            np.testing.assert_allclose(np.frombuffer(blob, "<f8", 10, 40 + 13).reshape(5, 2), np.vstack([polygon, polygon[:1]]))
+        extent = connection.execute("SELECT min_x, min_y, max_x, max_y FROM gpkg_contents WHERE table_name = 'boxes'").fetchone()
+        np.testing.assert_allclose(extent, np.concatenate([polygons.min(axis=(0, 1)), polygons.max(axis=(0, 1))]))
+        has_rtree = connection.execute("SELECT count(*) FROM sqlite_master WHERE name = 'rtree_boxes_geom'").fetchone()[0] > 0
+        assert has_rtree == spatial_index
+        if spatial_index:
+            rtree = np.float64(connection.execute("SELECT id, minx, maxx, miny, maxy FROM rtree_boxes_geom ORDER BY id").fetchall())
+            np.testing.assert_array_equal(rtree[:, 0], np.arange(1, 51))
+            # R-tree keeps 32-bit floats - rounded outwards
+            bounds = np.stack([polygons[:, :, 0].min(axis=1), polygons[:, :, 0].max(axis=1), polygons[:, :, 1].min(axis=1), polygons[:, :, 1].max(axis=1)], axis=1)
+            assert np.all(rtree[:, [1, 3]] <= bounds[:, [0, 2]]) and np.all(rtree[:, [2, 4]] >= bounds[:, [1, 3]])
+            np.testing.assert_allclose(rtree[:, 1:], bounds, atol=0.1)
+        connection.close()